@@ -1,12 +1,36 @@
 import os
 import telebot
 from telebot import types
-import gspread
-from google.oauth2.service_account import Credentials
 import datetime
 import logging
-from flask import Flask, request
-import json
+from flask import Flask, request, send_file
+import atexit
+import functools
+import hashlib
+import hmac
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sheets_writer import SheetsWriter
+from sheet_sync import SheetSync
+from sheet_registry import ORDER_HEADERS as SHEET_HEADERS, SheetArchiver, WorksheetRegistry, authorize
+from outbox import Outbox, OutboxReplayer
+from metrics import metrics
+from workers import KeyedWorkerPool
+from dedup import UpdateDeduplicator
+# Клавиатуры собираются один раз и передаются в reply_markup готовым JSON
+from keyboards import KEYBOARDS
+from photos import PhotoStore
+from journal import JournalWriter
+from order_store import FILTERS as ORDER_FILTERS, MAX_LIMIT as ORDER_SEARCH_MAX_LIMIT, OrderStore
+from validation import budget_cell, display, validate
+from dialog_steps import CONFIRM_STEP, CORRECTION_STEPS, NEXT_STEP, PREV_STEP, STEPS
+from state_store import StateSweeper, UserData, create_state_store
+from startup import Startup
+import http_pool
+from ratelimit import FloodGuard, RateLimiter
+from send_scheduler import BULK, NOTIFY, SendScheduler
 
 # ========== НАСТРОЙКА ЛОГГИРОВАНИЯ ==========
 logging.basicConfig(
@@ -22,153 +46,410 @@ app = Flask(__name__)
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 MANAGER_CHAT_IDS = [int(x.strip()) for x in os.environ.get('MANAGER_CHAT_IDS', '508551392,475363648').split(',')]
 SPREADSHEET_ID = os.environ.get('SPREADSHEET_ID', '1AbgMLiQVYfLPcROOm1UMq0evFdYuRk760HhY0cI3LH8')
+SHEETS_BATCH_SIZE = int(os.environ.get('SHEETS_BATCH_SIZE', 20))
+SHEETS_FLUSH_INTERVAL = float(os.environ.get('SHEETS_FLUSH_INTERVAL', 2.0))
+OUTBOX_PATH = os.environ.get('OUTBOX_PATH', 'outbox.db')
+# После стольких неудачных повторов запись журнала уходит в карантин
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 10))
+ORDERS_DB_PATH = os.environ.get('ORDERS_DB_PATH', 'orders.db')
+# Если не задан, /api/orders отключён
+ORDERS_API_TOKEN = os.environ.get('ORDERS_API_TOKEN')
+# Запасной журнал заявок и уведомлений (JSON Lines, сегменты сжимаются gzip)
+JOURNAL_DIR = os.environ.get('JOURNAL_DIR', 'journal')
+JOURNAL_SEGMENT_BYTES = int(os.environ.get('JOURNAL_SEGMENT_BYTES', 64 * 1024 * 1024))
+JOURNAL_SEGMENT_SECONDS = int(os.environ.get('JOURNAL_SEGMENT_SECONDS', 24 * 3600))
+JOURNAL_COMPRESS = os.environ.get('JOURNAL_COMPRESS', '1') == '1'
+# Синхронизация статусов с таблицей: как часто и за сколько последних дней
+SHEET_SYNC_INTERVAL = int(os.environ.get('SHEET_SYNC_INTERVAL', 60))
+SHEET_SYNC_WINDOW_DAYS = int(os.environ.get('SHEET_SYNC_WINDOW_DAYS', 30))
+# Заявки с этими статусами больше не проверяются
+SHEET_CLOSED_STATUSES = [x.strip() for x in os.environ.get('SHEET_CLOSED_STATUSES', 'Выполнена,Отменена').split(',') if x.strip()]
+# Листы для записи: month — лист на месяц, size — новый лист каждые
+# SHEET_MAX_ROWS строк, off (по умолчанию) — всё в первый лист
+SHEET_ROLLOVER = os.environ.get('SHEET_ROLLOVER', 'off')
+SHEET_PREFIX = os.environ.get('SHEET_PREFIX', 'Заявки')
+SHEET_MAX_ROWS = int(os.environ.get('SHEET_MAX_ROWS', 50000))
+# Сколько последних листов не трогает обслуживание; более старые сжимаются
+# и, если задана архивная таблица, переносятся в неё
+SHEET_ARCHIVE_KEEP = int(os.environ.get('SHEET_ARCHIVE_KEEP', 3))
+SHEET_ARCHIVE_SPREADSHEET_ID = os.environ.get('SHEET_ARCHIVE_SPREADSHEET_ID')
+SHEET_ARCHIVE_INTERVAL = int(os.environ.get('SHEET_ARCHIVE_INTERVAL', 24 * 3600))
+# memory://, sqlite:///states.db или redis://host:6379/0
+STATE_STORE_URL = os.environ.get('STATE_STORE_URL', 'memory://')
+STATE_TTL = int(os.environ.get('STATE_TTL', 24 * 3600))
+STATE_MAX_ENTRIES = int(os.environ.get('STATE_MAX_ENTRIES', 100000))
+STATE_MAX_BYTES = int(os.environ.get('STATE_MAX_BYTES', 64 * 1024 * 1024))
+STATE_SWEEP_INTERVAL = int(os.environ.get('STATE_SWEEP_INTERVAL', 300))
+PHOTO_DIR = os.environ.get('PHOTO_DIR', 'photos')
+PHOTO_STORE_MAX_BYTES = int(os.environ.get('PHOTO_STORE_MAX_BYTES', 512 * 1024 * 1024))
+# Скачивать ли фото заявок в локальный архив (по умолчанию хранится только file_id)
+PHOTO_ARCHIVE = os.environ.get('PHOTO_ARCHIVE', '0') == '1'
+# Пережатие фото и миниатюры (нужен Pillow), обработка идёт в фоне отдельными
+# процессами, не больше PHOTO_PROCESS_WORKERS одновременно
+PHOTO_PROCESSING = os.environ.get('PHOTO_PROCESSING', '0') == '1'
+PHOTO_PROCESS_WORKERS = int(os.environ.get('PHOTO_PROCESS_WORKERS', os.cpu_count() or 1))
+# Публичный адрес сервиса для ссылок на фото в таблице (по умолчанию — адрес webhook)
+PUBLIC_URL = os.environ.get('PUBLIC_URL', os.environ.get('WEBHOOK_URL', '')).rstrip('/')
+# Ключ подписи ссылок на фото. Если не задан, ключ выводится из BOT_TOKEN (см. ниже)
+PHOTO_URL_SECRET = os.environ.get('PHOTO_URL_SECRET')
+# Сколько ждать остальные фото альбома после последнего полученного (сек)
+PHOTO_ALBUM_WINDOW = float(os.environ.get('PHOTO_ALBUM_WINDOW', 1.5))
+PHOTO_MAX_PER_ORDER = int(os.environ.get('PHOTO_MAX_PER_ORDER', 20))
+MANAGER_SEND_WORKERS = int(os.environ.get('MANAGER_SEND_WORKERS', 8))
+PIPELINE_WORKERS = int(os.environ.get('PIPELINE_WORKERS', 4))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 1000))
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 500))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+# Если задан, /metrics отдаётся только с заголовком Authorization: Bearer <токен>
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# sync — TeleBot и Flask, async — приём обновлений через AsyncTeleBot и aiohttp
+# (запуск через start_bot.py); обработчики и отправка в обоих режимах синхронные
+BOT_ENGINE = os.environ.get('BOT_ENGINE', 'sync')
+UPDATE_DEDUP_CAPACITY = int(os.environ.get('UPDATE_DEDUP_CAPACITY', 10000))
+UPDATE_HWM_PATH = os.environ.get('UPDATE_HWM_PATH', 'update_hwm.json')
+# Ограничение входящих сообщений: на чат и на весь бот (сообщений в секунду)
+FLOOD_RATE = float(os.environ.get('FLOOD_RATE', 1.0))
+FLOOD_BURST = int(os.environ.get('FLOOD_BURST', 5))
+FLOOD_GLOBAL_RATE = float(os.environ.get('FLOOD_GLOBAL_RATE', 200))
+FLOOD_GLOBAL_BURST = int(os.environ.get('FLOOD_GLOBAL_BURST', 400))
+# Что делать с сообщениями сверх лимита: drop, coalesce или delay
+FLOOD_POLICY = os.environ.get('FLOOD_POLICY', 'delay')
+FLOOD_MAX_DEFERRED = int(os.environ.get('FLOOD_MAX_DEFERRED', 10))
+# Потоки отправки сообщений в Telegram (лимиты Telegram соблюдает планировщик)
+SEND_WORKERS = int(os.environ.get('SEND_WORKERS', 8))
+# Размеры пулов HTTP-соединений: по числу потоков, которые ходят в API одновременно
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', SEND_WORKERS + PIPELINE_WORKERS + 2))
+SHEETS_POOL_SIZE = int(os.environ.get('SHEETS_POOL_SIZE', 4))
 
 if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN не установлен в переменных окружения")
     raise ValueError("BOT_TOKEN не установлен")
 
+if PHOTO_URL_SECRET:
+    PHOTO_URL_KEY = PHOTO_URL_SECRET.encode()
+else:
+    # Производный ключ: токен бота сам ключом не служит. При смене токена
+    # старые ссылки на фото перестанут открываться — задайте PHOTO_URL_SECRET
+    PHOTO_URL_KEY = hmac.new(BOT_TOKEN.encode(), b'photo-url-signature', hashlib.sha256).digest()
+    logger.warning("⚠️ PHOTO_URL_SECRET не установлен: ключ подписи ссылок на фото выведен из BOT_TOKEN")
+
+# ========== ОЧЕРЕДЬ ВХОДЯЩИХ ОБНОВЛЕНИЙ ==========
+# Обновления одного чата обрабатываются по порядку, разных чатов — параллельно
+update_pool = KeyedWorkerPool("updates", workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE).start()
+
+# Telegram повторяет доставку, если не дождался ответа — такие повторы отсеиваем
+update_dedup = UpdateDeduplicator(capacity=UPDATE_DEDUP_CAPACITY, state_path=UPDATE_HWM_PATH)
+atexit.register(update_dedup.persist)
+
+def update_chat_id(update):
+    """Чат, к которому относится обновление (для упорядочивания)"""
+    message = update.message or update.edited_message
+    if message:
+        return message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    return update.update_id
+
+def update_media_group(update):
+    """media_group_id альбома, частью которого является обновление"""
+    message = update.message
+    return message.media_group_id if message else None
+
+def handle_update(update):
+    """Обработка одного обновления в потоке пула"""
+    telebot.TeleBot.process_new_updates(bot, [update])
+
+# Защита от потока сообщений: token bucket на чат и общий
+flood_guard = FloodGuard(
+    RateLimiter(FLOOD_RATE, FLOOD_BURST),
+    RateLimiter(FLOOD_GLOBAL_RATE, FLOOD_GLOBAL_BURST, max_keys=1),
+    policy=FLOOD_POLICY,
+    max_deferred=FLOOD_MAX_DEFERRED,
+)
+# Предупреждение об отброшенных сообщениях — не чаще раза в 30 секунд на чат
+flood_notices = RateLimiter(1 / 30, 1)
+
+def submit_update(update, timeout=None):
+    """Передаёт обновление в пул обработчиков. False — очередь переполнена"""
+    accepted = update_pool.submit(update_chat_id(update), handle_update, update, timeout=timeout)
+    if not accepted:
+        # Telegram доставит его снова — тогда оно не должно считаться повтором
+        update_dedup.forget(update.update_id)
+    metrics.set('update_queue_depth', update_pool.queue_depth())
+    return accepted
+
+def enqueue_update(update, timeout=None):
+    """Ставит обновление в очередь. False — очередь переполнена
+    
+    Повторно доставленные обновления молча пропускаются (и считаются принятыми),
+    как и отброшенные или отложенные ограничителем частоты.
+    """
+    if not update_dedup.check(update.update_id):
+        logger.info(f"🔁 Повторное обновление {update.update_id} пропущено")
+        return True
+    chat_id = update_chat_id(update)
+    if chat_id in MANAGER_CHAT_IDS:
+        return submit_update(update, timeout)
+    
+    result = {'accepted': True, 'timeout': timeout}
+    def deliver(update):
+        result['accepted'] = submit_update(update, result['timeout'])
+    action = flood_guard.admit(chat_id, update, deliver, group=update_media_group(update))
+    # Отложенные обновления передаются позже из потока ограничителя и не
+    # ждут места в очереди: при переполнении они отбрасываются
+    # (update_pool.rejected)
+    result['timeout'] = 0
+    
+    warn_flood(chat_id, action)
+    return result['accepted']
+
+def warn_flood(chat_id, action):
+    """Сообщает пользователю, что его сообщения отбрасываются"""
+    if action == 'drop' and flood_notices.try_acquire(chat_id):
+        # Не ждём отправки; одинаковые предупреждения в очереди объединяются
+        send_scheduler.submit(chat_id, telebot.TeleBot.send_message, bot, chat_id,
+                              "⏳ Слишком много сообщений. Подождите немного и повторите.",
+                              priority=BULK, coalesce_key='flood-notice')
+
+# Все исходящие сообщения идут через планировщик с лимитами Telegram
+send_scheduler = SendScheduler(workers=SEND_WORKERS).start()
+atexit.register(send_scheduler.stop)
+
+class DeliveryBot(telebot.TeleBot):
+    """TeleBot, который передаёт обновления в пул обработчиков
+    
+    Отправка сообщений проходит через send_scheduler: вызов ждёт своей
+    очереди и возвращает результат, как обычный метод TeleBot.
+    """
+
+    def process_new_updates(self, updates):
+        # В режиме polling при переполнении очереди ждём — это и есть backpressure
+        for update in updates:
+            enqueue_update(update)
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return send_scheduler.call(chat_id, super().send_message, chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return send_scheduler.call(chat_id, super().send_photo, chat_id, *args, **kwargs)
+
+    def send_media_group(self, chat_id, *args, **kwargs):
+        return send_scheduler.call(chat_id, super().send_media_group, chat_id, *args, **kwargs)
+
 # ========== ИНИЦИАЛИЗАЦИЯ БОТА ==========
-try:
-    bot = telebot.TeleBot(BOT_TOKEN)
+# Обработчики выполняются в пуле update_pool, собственный пул TeleBot не нужен.
+# Проверка токена (get_me) идёт в фоне вместе с подключением к таблице
+bot = DeliveryBot(BOT_TOKEN, threaded=False)
+
+# Одна сессия с пулом keep-alive соединений на все потоки вместо сессии на поток
+telegram_session = http_pool.create_session('telegram', TELEGRAM_POOL_SIZE)
+telebot.apihelper.session = telegram_session
+telebot.apihelper.SESSION_TIME_TO_LIVE = None
+
+# Сетевые рукопожатия при запуске выполняются параллельно и не блокируют импорт
+startup = Startup()
+
+def check_telegram():
     bot_info = bot.get_me()
     logger.info(f"✅ Бот @{bot_info.username} инициализирован")
-except Exception as e:
-    logger.error(f"❌ Ошибка инициализации бота: {e}")
-    raise
+
+startup.add('telegram', check_telegram, attempts=5)
+
+# Фото хранятся как file_id Telegram и скачиваются только при необходимости
+photo_store = PhotoStore(bot, PHOTO_DIR, max_bytes=PHOTO_STORE_MAX_BYTES,
+                         processing=PHOTO_PROCESSING, workers=PHOTO_PROCESS_WORKERS,
+                         session=telegram_session)
+atexit.register(photo_store.close)
+
+def photo_signature(unique_id):
+    """Подпись ссылки на фото: без неё фото по адресу не отдаётся"""
+    return hmac.new(PHOTO_URL_KEY, unique_id.encode(), hashlib.sha256).hexdigest()[:16]
+
+def photo_url(unique_id):
+    """Постоянная ссылка на фото заявки"""
+    return f"{PUBLIC_URL}/photos/{unique_id}?sig={photo_signature(unique_id)}"
+
+def resolve_photo(unique_id, signature, thumb=False):
+    """Путь к файлу фото по ссылке. Возвращает (путь, HTTP-статус)"""
+    if not hmac.compare_digest(signature or '', photo_signature(unique_id)):
+        return None, 403
+    try:
+        path = photo_store.get(unique_id, thumb=thumb)
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения фото {unique_id}: {e}")
+        return None, 502
+    if path is None:
+        return None, 404
+    return os.path.abspath(path), 200
 
 # ========== ИНИЦИАЛИЗАЦИЯ GOOGLE SHEETS ==========
+
 def init_google_sheets():
     """Инициализация Google Sheets с использованием Service Account"""
     try:
         # Получаем credentials из переменной окружения
-        credentials_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
-        
-        if not credentials_json:
-            logger.warning("❌ GOOGLE_CREDENTIALS_JSON не установлен. Google Sheets отключен.")
-            return None
-        
-        SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-        
-        # Создаем credentials из JSON строки
-        credentials_info = json.loads(credentials_json)
-        credentials = Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
-        gc = gspread.authorize(credentials)
+        gc = authorize(os.environ.get('GOOGLE_CREDENTIALS_JSON'))
+        http_pool.mount(gc.http_client.session, 'sheets', SHEETS_POOL_SIZE)
         
         # Открываем таблицу по ID
         spreadsheet = gc.open_by_key(SPREADSHEET_ID)
-        sheet = spreadsheet.sheet1
+        sheets = WorksheetRegistry(spreadsheet, SHEET_HEADERS, mode=SHEET_ROLLOVER,
+                                   prefix=SHEET_PREFIX, max_rows=SHEET_MAX_ROWS)
         
-        # Проверяем структуру таблицы
+        # Проверяем структуру таблицы (новые листы создаются с заголовком)
+        sheet = sheets.current()
         if sheet.row_count == 0:
-            headers = [
-                "Статус",                    # A
-                "Дата создания",             # B
-                "User ID",                   # C
-                "Username",                  # D
-                "Имя",                       # E
-                "Телефон",                   # F
-                "Город назначения",          # G
-                "Описание груза",            # H
-                "Ссылка на сайт",            # I
-                "Фото",                      # J
-                "Вес (кг)",                  # K
-                "Объем (м³)",                # L
-                "Способ доставки",           # M
-                "Бюджет",                    # N
-                "Комментарий"                # O
-            ]
-            sheet.append_row(headers)
+            sheet.append_row(SHEET_HEADERS)
         
-        logger.info("✅ Google Sheets подключен успешно")
-        return sheet
+        logger.info(f"✅ Google Sheets подключен успешно, запись в лист «{sheet.title}»")
+        return sheets
         
     except Exception as e:
         logger.error(f"❌ Ошибка подключения к Google Sheets: {e}")
+        raise
+
+SHEETS_CONFIGURED = bool(os.environ.get('GOOGLE_CREDENTIALS_JSON'))
+if not SHEETS_CONFIGURED:
+    logger.warning("❌ GOOGLE_CREDENTIALS_JSON не установлен. Google Sheets отключен.")
+
+# Таблица подключается в фоне (см. connect_sheets), до этого строки копятся в sheet_writer.
+# sheet — WorksheetRegistry: пишет в текущий лист и кэширует остальные
+sheet = None
+
+# Пул для параллельной рассылки уведомлений менеджерам
+manager_pool = ThreadPoolExecutor(max_workers=MANAGER_SEND_WORKERS, thread_name_prefix="manager-send")
+
+# ========== ЖУРНАЛ ИСХОДЯЩИХ ЗАПИСЕЙ ==========
+# Все заявки и уведомления сначала попадают в журнал на диске и удаляются
+# из очереди на повтор только после подтверждённой доставки
+outbox = Outbox(OUTBOX_PATH, max_attempts=OUTBOX_MAX_ATTEMPTS)
+atexit.register(outbox.close)
+
+# Заявки, которые не удалось поставить в запись в таблицу, и архив уведомлений
+journal = JournalWriter(JOURNAL_DIR, max_bytes=JOURNAL_SEGMENT_BYTES, max_age=JOURNAL_SEGMENT_SECONDS,
+                        compress=JOURNAL_COMPRESS).start()
+atexit.register(journal.close)
+
+# ========== ЛОКАЛЬНЫЙ ИНДЕКС ЗАЯВОК ==========
+# Копия заявок с индексами для поиска менеджерами без чтения таблицы
+order_store = OrderStore(ORDERS_DB_PATH)
+atexit.register(order_store.close)
+
+# Фоновая пакетная запись в таблицу, чтобы обработчики не ждали Google Sheets
+sheet_writer = None
+if SHEETS_CONFIGURED:
+    sheet_writer = SheetsWriter(
+        None,
+        batch_size=SHEETS_BATCH_SIZE,
+        flush_interval=SHEETS_FLUSH_INTERVAL,
+        on_success=outbox.mark_delivered,
+        on_failure=lambda keys, rows: outbox.note_attempt(keys, 'sheet_row'),
+        on_placed=order_store.place,
+    ).start()
+    atexit.register(sheet_writer.stop)
+
+def connect_sheets():
+    global sheet
+    sheet = init_google_sheets()
+    sheet_writer.attach(sheet)
+    archiver = SheetArchiver(sheet, keep=SHEET_ARCHIVE_KEEP, interval=SHEET_ARCHIVE_INTERVAL,
+                             archive_spreadsheet_id=SHEET_ARCHIVE_SPREADSHEET_ID).start()
+    atexit.register(archiver.stop)
+
+def worksheet_by_title(title):
+    """Лист таблицы по названию (None — текущий); None, пока таблица не подключена"""
+    if sheet is None:
         return None
+    return sheet.worksheet(title)
+
+def sheets_enabled():
+    """Таблица подключена или ещё подключается"""
+    return sheet_writer is not None and not sheet_writer.unavailable
+
+if SHEETS_CONFIGURED:
+    # Пока таблица недоступна, заявки не теряются: строки ждут в очереди
+    # писателя и в журнале исходящих (outbox). Если подключиться так и не
+    # удалось, они остаются в outbox, а новые заявки пишутся в запасной
+    # JSONL-журнал (journal.py)
+    startup.add('google_sheets', connect_sheets, attempts=5,
+                on_failure=lambda error: sheet_writer.abandon())
+
+# ========== СИНХРОНИЗАЦИЯ СТАТУСОВ С ТАБЛИЦЕЙ ==========
+def notify_status_change(order, old_status, new_status):
+    """Сообщает клиенту о новом статусе заявки"""
+    user_id = order.get('user_id')
+    if not user_id:
+        return
+    text = f"""
+📦 Статус вашей заявки изменён
 
-sheet = init_google_sheets()
-
-# ========== СЛОВАРЬ ДЛЯ ВРЕМЕННОГО ХРАНЕНИЯ ДАННЫХ ==========
-user_data = {}
-
-# ========== КЛАВИАТУРЫ ==========
-def phone_keyboard():
-    keyboard = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
-    button_phone = types.KeyboardButton(text="📞 Отправить номер", request_contact=True)
-    button_back = types.KeyboardButton(text="⬅️ Назад")
-    button_manager = types.KeyboardButton(text="👨‍💼 Связаться с менеджером")
-    button_main = types.KeyboardButton(text="🏠 В начало")
-    keyboard.add(button_phone)
-    keyboard.add(button_back, button_manager, button_main)
-    return keyboard
-
-def delivery_keyboard():
-    keyboard = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    buttons = ["✈️ Авиа", "🚢 Море", "🚛 Авто", "🔀 Комбинированное", "❓ Не знаю"]
-    keyboard.add(*buttons)
-    button_back = types.KeyboardButton(text="⬅️ Назад")
-    button_manager = types.KeyboardButton(text="👨‍💼 Связаться с менеджером")
-    button_main = types.KeyboardButton(text="🏠 В начало")
-    keyboard.add(button_back, button_manager, button_main)
-    return keyboard
-
-def skip_photo_keyboard():
-    keyboard = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
-    keyboard.add("📷 Пропустить фото")
-    button_back = types.KeyboardButton(text="⬅️ Назад")
-    button_manager = types.KeyboardButton(text="👨‍💼 Связаться с менеджером")
-    button_main = types.KeyboardButton(text="🏠 В начало")
-    keyboard.add(button_back, button_manager, button_main)
-    return keyboard
-
-def cancel_keyboard():
-    keyboard = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
-    button_cancel = types.KeyboardButton(text="❌ Отменить")
-    button_manager = types.KeyboardButton(text="👨‍💼 Связаться с менеджером")
-    button_main = types.KeyboardButton(text="🏠 В начало")
-    keyboard.add(button_cancel, button_manager, button_main)
-    return keyboard
-
-def main_menu_keyboard():
-    keyboard = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
-    button_new = types.KeyboardButton(text="📦 Новая заявка")
-    button_manager = types.KeyboardButton(text="👨‍💼 Связаться с менеджером")
-    keyboard.add(button_new, button_manager)
-    return keyboard
-
-def confirm_keyboard():
-    keyboard = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    button_yes = types.KeyboardButton(text="✅ Подтвердить")
-    button_no = types.KeyboardButton(text="✏️ Исправить")
-    button_manager = types.KeyboardButton(text="👨‍💼 Связаться с менеджером")
-    button_main = types.KeyboardButton(text="🏠 В начало")
-    keyboard.add(button_yes, button_no, button_manager, button_main)
-    return keyboard
-
-def correction_keyboard():
-    """Клавиатура для выбора поля исправления"""
-    keyboard = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    buttons = [
-        "👤 Имя", "📞 Телефон", "🏙️ Город", "📦 Груз",
-        "🔗 Ссылка", "🖼️ Фото", "⚖️ Вес", "📏 Объем",
-        "🚚 Доставка", "💰 Бюджет", "💬 Комментарий"
-    ]
-    keyboard.add(*buttons)
-    button_back = types.KeyboardButton(text="⬅️ Назад к подтверждению")
-    keyboard.add(button_back)
-    return keyboard
-
-def standard_keyboard():
-    """Стандартная клавиатура с кнопками Назад, Менеджер, В начало"""
-    keyboard = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
-    button_back = types.KeyboardButton(text="⬅️ Назад")
-    button_manager = types.KeyboardButton(text="👨‍💼 Связаться с менеджером")
-    button_main = types.KeyboardButton(text="🏠 В начало")
-    keyboard.add(button_back, button_manager, button_main)
-    return keyboard
+📅 Заявка от: {order.get('timestamp', '')}
+🌍 Город: {order.get('destination', '')}
+📌 Новый статус: {new_status}
+"""
+    # Если клиент ещё не получил предыдущий статус, он получит только последний
+    send_scheduler.submit(user_id, telebot.TeleBot.send_message, bot, user_id, text,
+                          priority=NOTIFY, coalesce_key=f"status-{order['order_id']}")
+
+sheet_sync = None
+if SHEETS_CONFIGURED:
+    sheet_sync = SheetSync(
+        order_store, worksheet_by_title,
+        interval=SHEET_SYNC_INTERVAL,
+        window_days=SHEET_SYNC_WINDOW_DAYS,
+        closed_statuses=SHEET_CLOSED_STATUSES,
+        on_change=notify_status_change,
+    ).start()
+    atexit.register(sheet_sync.stop)
+
+# ========== КОНВЕЙЕР ОБРАБОТКИ ЗАЯВОК ==========
+# Запись в таблицу и рассылка менеджерам выполняются в фоне; задачи одного
+# чата идут по порядку, разных чатов — параллельно
+order_pipeline = KeyedWorkerPool(
+    "order-pipeline", workers=PIPELINE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE
+).start()
+atexit.register(order_pipeline.join)
+
+def submit_job(chat_id, func, *args):
+    """Ставит задачу в конвейер, а при переполнении выполняет её сразу"""
+    if not order_pipeline.submit(chat_id, func, *args, timeout=1):
+        func(*args)
+
+def queue_sheet_row(key, row):
+    """Записывает строку в журнал и ставит её в очередь записи в таблицу"""
+    outbox.record('sheet_row', key, row)
+    if sheet_writer:
+        sheet_writer.append(row, key)
+
+# ========== ХРАНИЛИЩЕ СОСТОЯНИЙ ДИАЛОГОВ ==========
+state_store = create_state_store(
+    STATE_STORE_URL, ttl=STATE_TTL, max_entries=STATE_MAX_ENTRIES, max_bytes=STATE_MAX_BYTES
+)
+atexit.register(state_store.close)
+
+# Диалоги, в которых пользователь ещё ничего не заполнил, живут меньше
+STEP_TTLS = {
+    'start': 3600,
+    'manager_contact': 2 * 3600,
+}
+
+def dialog_ttl(state):
+    return STEP_TTLS.get(state.get('step'), STATE_TTL)
+
+user_data = UserData(state_store, ttl_policy=dialog_ttl)
+state_sweeper = StateSweeper(state_store, interval=STATE_SWEEP_INTERVAL).start()
+logger.info(f"✅ Хранилище состояний: {STATE_STORE_URL}")
+
+def with_user_state(handler):
+    """Загружает состояние чата на время обработки сообщения и сохраняет изменения"""
+    @functools.wraps(handler)
+    def wrapper(message):
+        with user_data.session(message.chat.id):
+            return handler(message)
+    return wrapper
 
 # ========== КОМАНДЫ ==========
-@bot.message_handler(commands=['start'])
 def start_command(message):
     chat_id = message.chat.id
     user_data[chat_id] = {'step': 'start'}
@@ -182,9 +463,23 @@ def start_command(message):
 
                               ⬇️
     """
-    bot.send_message(chat_id, text, reply_markup=main_menu_keyboard())
+    bot.send_message(chat_id, text, reply_markup=KEYBOARDS['main_menu'])
+
+def reset_dialog(message):
+    """Возвращает в начало чат без состояния, предупреждая об истёкшей сессии"""
+    chat_id = message.chat.id
+    if not state_store.pop_expired(chat_id):
+        start_command(message)
+        return
+    
+    user_data[chat_id] = {'step': 'start'}
+    text = """
+⌛ Сессия истекла: заявка долго оставалась незавершённой, и введённые данные были удалены.
+
+Чтобы продолжить, начните новую заявку ⬇️
+"""
+    bot.send_message(chat_id, text, reply_markup=KEYBOARDS['main_menu'])
 
-@bot.message_handler(commands=['admin'])
 def admin_command(message):
     """Команда для администраторов"""
     chat_id = message.chat.id
@@ -193,159 +488,253 @@ def admin_command(message):
 
 Ваш ID: {chat_id}
 Текущие менеджеры: {MANAGER_CHAT_IDS}
+Активных диалогов: {len(user_data)}
+Вытеснено диалогов: {metrics.total('state_evictions_total')}
+Заявок в локальном индексе: {order_store.count()} (поиск: /orders help)
+"""
+    admin_text += f"\n🚀 Запуск ({'готов' if startup.ready() else 'не готов'}):\n"
+    for name, component in startup.status().items():
+        seconds = f", {component['seconds']:.2f} с" if component['seconds'] is not None else ""
+        admin_text += f"├ {name}: {component['state']}{seconds}\n"
+    admin_text += "\n📨 Рассылка менеджерам:\n"
+    for manager_id in MANAGER_CHAT_IDS:
+        sent = metrics.get('manager_send_total', manager=manager_id, result='ok')
+        failed = metrics.get('manager_send_total', manager=manager_id, result='error')
+        _, _, total_time, count = metrics.histogram('manager_send_seconds', manager=manager_id).snapshot()
+        average = total_time / count if count else 0
+        admin_text += f"├ {manager_id}: отправлено {sent}, ошибок {failed}, среднее время {average:.2f} с\n"
+    updates = update_pool.stats()
+    admin_text += f"""
+📥 Входящие обновления ({updates['workers']} потоков):
+├ В очереди: {updates['queue_depth']}, обрабатывается: {updates['busy']}
+├ Обработано: {updates['completed']}, ошибок: {updates['failed']}, отклонено: {updates['rejected']}
+├ Отсеяно повторов: {metrics.get('updates_duplicate_total')}
+└ Ограничено частотой: отложено {metrics.get('flood_limited_total', action='delay')}, \
+объединено {metrics.get('flood_limited_total', action='coalesce')}, \
+отброшено {metrics.get('flood_limited_total', action='drop')}
+"""
+    pipeline = order_pipeline.stats()
+    admin_text += f"""
+⚙️ Конвейер заявок ({pipeline['workers']} потоков):
+├ В очереди: {pipeline['queue_depth']}, выполняется: {pipeline['busy']}
+├ Выполнено: {pipeline['completed']}, ошибок: {pipeline['failed']}, отклонено: {pipeline['rejected']}
+└ Время от постановки до завершения: {pipeline['last_latency']:.2f} с
+"""
+    sends = send_scheduler.stats()
+    admin_text += f"""
+📤 Отправка в Telegram ({sends['workers']} потоков):
+├ В очереди: {sends['queue_depth']}, отправлено: {sends['sent']}, ошибок: {sends['failed']}
+└ Повторов после 429: {sends['retried']}, объединено: {sends['coalesced']}
 """
+    admin_text += "\n🔌 HTTP-соединения:\n"
+    for client, (sent, opened, reuse) in http_pool.stats().items():
+        admin_text += f"├ {client}: запросов {sent}, новых соединений {opened}, переиспользование {reuse:.0%}\n"
+    pending = outbox.stats()
+    admin_text += f"""
+📮 Журнал недоставленных записей:
+├ Строки таблицы: {pending.get('sheet_row', 0)}
+├ Уведомления: {pending.get('notification', 0)}
+└ В карантине: {sum(outbox.dead_stats().values())}
+"""
+    if sheet_writer:
+        stats = sheet_writer.stats()
+        admin_text += f"""
+📊 Запись в Google Sheets:
+├ Лист: {sheet.title if sheet is not None else 'не подключена'} (листов-шардов: {len(sheet.shards()) if sheet is not None else 0})
+├ В очереди: {stats['queue_depth']}
+├ Записано строк: {stats['rows_written']}
+├ Ошибок записи: {stats['failed_rows']}
+└ Задержка записи: {stats['last_flush_latency']:.2f} с (макс. {stats['max_flush_latency']:.2f} с)
+"""
+    if sheet_sync:
+        sync = sheet_sync.stats()
+        last_sync = time.strftime('%H:%M:%S', time.localtime(sync['last_sync'])) if sync['last_sync'] else "ещё не было"
+        admin_text += f"""
+🔄 Синхронизация статусов (последняя: {last_sync}):
+└ Из таблицы: {sync['pulled']}, в таблицу: {sync['pushed']}, конфликтов: {sync['conflicts']}
+"""
+    admin_text += f"\n🖼️ Фото (архив {'включён' if PHOTO_ARCHIVE else 'выключен'}), скачано / сохранено:\n"
+    for hour, (downloaded, stored) in photo_store.hourly_stats():
+        admin_text += f"├ {hour}: {downloaded / 1024:.0f} / {stored / 1024:.0f} КБ\n"
+    admin_text += f"├ Повторов без записи: {metrics.get('photo_dedup_total')}\n"
+    admin_text += (f"└ Обработано: {metrics.get('photos_processed_total', result='ok')}, "
+                   f"сэкономлено {metrics.get('photo_bytes_saved_total') / 1024:.0f} КБ\n")
     bot.send_message(chat_id, admin_text)
 
-@bot.message_handler(func=lambda message: message.text == "📦 Новая заявка")
+ORDERS_HELP = """
+🔎 Поиск заявок:
+/orders — последние заявки
+/orders 89991234567 — по телефону
+/orders Москва — по городу
+/orders id 123456789 — по User ID
+/orders статус В работе — по статусу
+/orders дата 2024-05-01 — за день
+/status <ID заявки> <статус> — сменить статус
+"""
+
+def parse_orders_query(text):
+    """Условия поиска из аргументов команды /orders"""
+    query = text.strip()
+    if not query:
+        return {}
+    keyword, _, value = query.partition(' ')
+    keyword, value = keyword.lower(), value.strip()
+    if keyword == 'id' and value.isdigit():
+        return {'user_id': int(value)}
+    if keyword == 'статус' and value:
+        return {'status': value}
+    if keyword == 'дата' and value:
+        return {'since': value, 'until': value}
+    if sum(char.isdigit() for char in query) >= 10:
+        return {'phone': query}
+    return {'destination': query}
+
+def format_order_line(order):
+    return (f"{order.get('timestamp', '')} | {order['status']}\n"
+            f"   {order.get('name', '')}, {display(order, 'phone')}, {order.get('destination', '')}"
+            f" — ID {order.get('order_id', '')}")
+
+def orders_command(message):
+    """Поиск заявок в локальном индексе (только для менеджеров)"""
+    chat_id = message.chat.id
+    if chat_id not in MANAGER_CHAT_IDS:
+        return
+    args = telebot.util.extract_arguments(message.text) or ''
+    if args.lower() == 'help':
+        bot.send_message(chat_id, ORDERS_HELP)
+        return
+    orders = order_store.search(limit=10, **parse_orders_query(args))
+    if not orders:
+        bot.send_message(chat_id, "Заявки не найдены." + ORDERS_HELP)
+        return
+    lines = [f"📋 Найдено заявок: {len(orders)} (новые сверху)"]
+    lines.extend(format_order_line(order) for order in orders)
+    bot.send_message(chat_id, "\n\n".join(lines))
+
+def status_command(message):
+    """Смена статуса заявки менеджером: /status <ID заявки> <статус>"""
+    chat_id = message.chat.id
+    if chat_id not in MANAGER_CHAT_IDS:
+        return
+    order_id, _, status = (telebot.util.extract_arguments(message.text) or '').partition(' ')
+    status = status.strip()
+    order = order_store.get(order_id) if order_id else None
+    if order is None or not status:
+        bot.send_message(chat_id, "Использование: /status <ID заявки> <статус>\nID заявки есть в /orders и в столбце P таблицы.")
+        return
+    if order['status'] == status:
+        bot.send_message(chat_id, f"У заявки {order_id} уже статус «{status}».")
+        return
+    order_store.set_status(order_id, status)
+    notify_status_change(order, order['status'], status)
+    if sheet_sync:
+        sheet_sync.wake()
+    bot.send_message(chat_id, f"✅ Статус заявки {order_id}: «{order['status']}» → «{status}». Клиент уведомлён.")
+
 def new_request(message):
     chat_id = message.chat.id
-    user_data[chat_id] = {'step': 'name'}
-    
-    text = "Введите ваше имя:"
-    bot.send_message(chat_id, text, reply_markup=standard_keyboard())
+    user_data[chat_id] = {}
+    ask_step(chat_id, 'name')
 
-@bot.message_handler(func=lambda message: message.text == "👨‍💼 Связаться с менеджером")
 def contact_manager(message):
     chat_id = message.chat.id
     user_data[chat_id] = {'step': 'manager_contact'}
     
     text = "Опишите вашу проблему или вопрос. Менеджер свяжется с вами в ближайшее время:"
-    bot.send_message(chat_id, text, reply_markup=cancel_keyboard())
+    bot.send_message(chat_id, text, reply_markup=KEYBOARDS['cancel'])
 
-@bot.message_handler(func=lambda message: message.text == "❌ Отменить")
 def cancel_command(message):
     chat_id = message.chat.id
     if chat_id in user_data:
         del user_data[chat_id]
-    bot.send_message(chat_id, "Заявка отменена.", reply_markup=main_menu_keyboard())
+    bot.send_message(chat_id, "Заявка отменена.", reply_markup=KEYBOARDS['main_menu'])
 
-@bot.message_handler(func=lambda message: message.text == "⬅️ Назад")
 def back_command(message):
     chat_id = message.chat.id
     if chat_id not in user_data:
-        start_command(message)
+        reset_dialog(message)
         return
     
     current_step = user_data[chat_id].get('step', 'start')
     
     # Логика возврата на предыдущий шаг
-    steps_order = ['name', 'phone', 'destination', 'cargo', 'website', 'photo', 'weight', 'volume', 'delivery', 'budget', 'comment', 'confirm']
-    
-    if current_step in steps_order:
-        current_index = steps_order.index(current_step)
-        if current_index > 0:
-            prev_step = steps_order[current_index - 1]
-            user_data[chat_id]['step'] = prev_step
-            
-            # Возвращаем к соответствующему шагу
-            if prev_step == 'name':
-                bot.send_message(chat_id, "Введите ваше имя:", reply_markup=standard_keyboard())
-            elif prev_step == 'phone':
-                bot.send_message(chat_id, "📞 Ваш номер телефона:", reply_markup=phone_keyboard())
-            elif prev_step == 'destination':
-                bot.send_message(chat_id, "🏙️ Город назначения (Россия):", reply_markup=standard_keyboard())
-            elif prev_step == 'cargo':
-                bot.send_message(chat_id, "📦 Описание груза:", reply_markup=standard_keyboard())
-            elif prev_step == 'website':
-                bot.send_message(chat_id, "🔗 Ссылка на сайт (или 'Нет'):", reply_markup=standard_keyboard())
-            elif prev_step == 'photo':
-                bot.send_message(chat_id, "🖼️ Фото груза (или 'Пропустить фото'):", reply_markup=skip_photo_keyboard())
-            elif prev_step == 'weight':
-                bot.send_message(chat_id, "⚖️ Вес груза (кг):", reply_markup=standard_keyboard())
-            elif prev_step == 'volume':
-                bot.send_message(chat_id, "📏 Объем груза (м³):", reply_markup=standard_keyboard())
-            elif prev_step == 'delivery':
-                bot.send_message(chat_id, "🚚 Способ доставки:", reply_markup=delivery_keyboard())
-            elif prev_step == 'budget':
-                bot.send_message(chat_id, "💰 Бюджет:", reply_markup=standard_keyboard())
-            elif prev_step == 'comment':
-                bot.send_message(chat_id, "💬 Комментарии (или 'Нет'):", reply_markup=standard_keyboard())
-        else:
-            start_command(message)
+    prev_step = PREV_STEP.get(current_step)
+    if prev_step:
+        ask_step(chat_id, prev_step)
     else:
         start_command(message)
 
-@bot.message_handler(func=lambda message: message.text == "⬅️ Назад к подтверждению")
 def back_to_confirmation(message):
     chat_id = message.chat.id
     if chat_id not in user_data:
-        start_command(message)
+        reset_dialog(message)
         return
     
     user_data[chat_id]['step'] = 'confirm'
     show_preview(chat_id)
 
-@bot.message_handler(func=lambda message: message.text == "🏠 В начало")
 def main_menu_command(message):
     start_command(message)
 
-# ========== ЛОГИКА ДИАЛОГА ==========
+# ========== МАРШРУТИЗАЦИЯ СООБЩЕНИЙ ==========
+# Кнопки, которые работают на любом шаге диалога
+BUTTON_HANDLERS = {
+    "📦 Новая заявка": new_request,
+    "👨‍💼 Связаться с менеджером": contact_manager,
+    "❌ Отменить": cancel_command,
+    "⬅️ Назад": back_command,
+    "⬅️ Назад к подтверждению": back_to_confirmation,
+    "🏠 В начало": main_menu_command,
+}
+
+COMMAND_HANDLERS = {
+    'start': start_command,
+    'admin': admin_command,
+    'orders': orders_command,
+    'status': status_command,
+}
+
+# Один обработчик вместо цепочки фильтров: кнопки и команды находятся
+# поиском по словарю, остальное уходит в диалог
 @bot.message_handler(content_types=['text', 'contact'])
+@with_user_state
+def route_message(message):
+    text = message.text
+    handler = BUTTON_HANDLERS.get(text)
+    if handler is None and text and text.startswith('/'):
+        handler = COMMAND_HANDLERS.get(telebot.util.extract_command(text))
+    if handler is None:
+        handler = handle_all_messages
+    handler(message)
+
+# ========== ЛОГИКА ДИАЛОГА ==========
 def handle_all_messages(message):
     chat_id = message.chat.id
     
     if chat_id not in user_data:
-        start_command(message)
+        reset_dialog(message)
         return
     
     current_step = user_data[chat_id].get('step', 'start')
     
-    if current_step == 'start':
-        if message.text == "📦 Новая заявка":
-            new_request(message)
-        elif message.text == "👨‍💼 Связаться с менеджером":
-            contact_manager(message)
-        else:
-            start_command(message)
-    
-    elif current_step == 'manager_contact':
-        process_manager_contact(message)
-    
-    elif current_step == 'name':
-        process_name(message)
-    
-    elif current_step == 'phone':
-        process_phone(message)
-    
-    elif current_step == 'destination':
-        process_destination(message)
-    
-    elif current_step == 'cargo':
-        process_cargo(message)
-    
-    elif current_step == 'website':
-        process_website(message)
-    
-    elif current_step == 'photo':
-        process_photo(message)
-    
-    elif current_step == 'weight':
-        process_weight(message)
-    
-    elif current_step == 'volume':
-        process_volume(message)
-    
-    elif current_step == 'delivery':
-        process_delivery(message)
-    
-    elif current_step == 'budget':
-        process_budget(message)
-    
-    elif current_step == 'comment':
-        process_comment(message)
-    
-    elif current_step == 'confirm':
-        process_confirmation(message)
-    
-    elif current_step == 'correction':
-        process_correction(message)
+    handler = STEP_HANDLERS.get(current_step)
+    if handler:
+        started = time.perf_counter()
+        try:
+            handler(message)
+        except Exception:
+            STEP_ERRORS[current_step].inc()
+            raise
+        finally:
+            STEP_LATENCY[current_step].observe(time.perf_counter() - started)
 
 @bot.message_handler(content_types=['photo'])
+@with_user_state
 def handle_photos(message):
     chat_id = message.chat.id
     
     if chat_id not in user_data:
-        start_command(message)
+        reset_dialog(message)
         return
     
     current_step = user_data[chat_id].get('step', 'start')
@@ -370,318 +759,178 @@ def process_manager_contact(message):
 📞 Свяжитесь с пользователем как можно скорее!
 """
     
-    # Отправляем менеджерам
-    send_to_manager_chats(manager_request_text, None, "Запрос помощи")
+    request_key = f"help-{chat_id}-{message.message_id}"
+    row = [
+        "Запрос помощи",  # A: Статус
+        datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # B: Дата создания
+        str(chat_id),  # C: User ID
+        f"@{message.from_user.username}" if message.from_user.username else "Не указан",  # D: Username
+        f"{message.from_user.first_name} {message.from_user.last_name or ''}".strip(),  # E: Имя
+        "Не указан",  # F: Телефон
+        "Не указан",  # G: Город назначения
+        message.text,  # H: Описание груза
+        "Не указана",  # I: Ссылка на сайт
+        "Не загружено",  # J: Фото
+        "Не указан",  # K: Вес
+        "Не указан",  # L: Объем
+        "Не указан",  # M: Способ доставки
+        "Не указан",  # N: Бюджет
+        "Не указан",  # O: Комментарий
+        request_key   # P: ID заявки
+    ]
     
-    # Сохраняем в Google Sheets
-    if sheet:
-        try:
-            row = [
-                "Запрос помощи",  # A: Статус
-                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # B: Дата создания
-                str(chat_id),  # C: User ID
-                f"@{message.from_user.username}" if message.from_user.username else "Не указан",  # D: Username
-                f"{message.from_user.first_name} {message.from_user.last_name or ''}".strip(),  # E: Имя
-                "Не указан",  # F: Телефон
-                "Не указан",  # G: Город назначения
-                message.text,  # H: Описание груза
-                "Не указана",  # I: Ссылка на сайт
-                "Не загружено",  # J: Фото
-                "Не указан",  # K: Вес
-                "Не указан",  # L: Объем
-                "Не указан",  # M: Способ доставки
-                "Не указан",  # N: Бюджет
-                "Не указан"   # O: Комментарий
-            ]
-            sheet.append_row(row)
-        except Exception as e:
-            logger.error(f"❌ Ошибка сохранения запроса помощи: {e}")
+    # Фиксируем запрос в журнале, а отправку менеджерам и запись в таблицу
+    # выполняем в фоне
+    if MANAGER_CHAT_IDS:
+        outbox.record('notification', f"notify-{request_key}",
+                      notification_payload(manager_request_text, None, None, "Запрос помощи"))
+    if sheets_enabled():
+        outbox.record('sheet_row', request_key, row)
+    submit_job(chat_id, process_help_request, request_key, manager_request_text, row)
     
     bot.send_message(chat_id, "✅ Ваше сообщение отправлено менеджерам! Они свяжутся с вами в ближайшее время.", 
-                    reply_markup=main_menu_keyboard())
-
-def process_name(message):
-    chat_id = message.chat.id
-    if message.text == "❌ Отменить":
-        cancel_command(message)
-        return
-    
-    user_data[chat_id]['name'] = message.text
-    
-    # Если это режим исправления, возвращаем к подтверждению
-    if user_data[chat_id].get('correcting_mode'):
-        user_data[chat_id]['step'] = 'confirm'
+                    reply_markup=KEYBOARDS['main_menu'])
+
+def ask_step(chat_id, step_name, prefix=""):
+    """Переводит диалог на шаг анкеты и задаёт его вопрос"""
+    step = STEPS[step_name]
+    user_data[chat_id]['step'] = step_name
+    bot.send_message(chat_id, prefix + step['prompt'], reply_markup=KEYBOARDS[step['keyboard']])
+
+def complete_step(chat_id, prefix=""):
+    """Поле заполнено: в режиме исправления — к подтверждению, иначе — следующий шаг"""
+    state = user_data[chat_id]
+    next_step = NEXT_STEP[state['step']]
+    if state.get('correcting_mode') or next_step == CONFIRM_STEP:
+        state['step'] = CONFIRM_STEP
         show_preview(chat_id)
         return
-    
-    # Иначе продолжаем обычный поток
-    user_data[chat_id]['step'] = 'phone'
-    user_data[chat_id]['timestamp'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    user_data[chat_id]['user_id'] = chat_id
-    user_data[chat_id]['username'] = f"@{message.from_user.username}" if message.from_user.username else "Не указан"
-    
-    bot.send_message(chat_id, "📞 Ваш номер телефона:", reply_markup=phone_keyboard())
+    ask_step(chat_id, next_step, prefix)
 
-def process_phone(message):
+def process_form_step(message):
+    """Общий обработчик текстовых шагов анкеты"""
     chat_id = message.chat.id
+    state = user_data[chat_id]
+    step = STEPS[state['step']]
     
-    # Обработка контакта
+    # Телефон можно отправить кнопкой «Отправить номер»
     if message.contact:
-        phone = message.contact.phone_number
-        user_data[chat_id]['phone'] = phone
-        
-        # Если это режим исправления, возвращаем к подтверждению
-        if user_data[chat_id].get('correcting_mode'):
-            user_data[chat_id]['step'] = 'confirm'
-            show_preview(chat_id)
-            return
-        
-        # Иначе продолжаем обычный поток
-        user_data[chat_id]['step'] = 'destination'
-        bot.send_message(chat_id, "🏙️ Город назначения (Россия):", reply_markup=standard_keyboard())
+        value = message.contact.phone_number
+    else:
+        value = message.text
+    if value is None:
         return
-    
-    # Обработка текста (если пользователь ввел номер вручную)
-    if message.text and message.text not in ["⬅️ Назад", "👨‍💼 Связаться с менеджером", "🏠 В начало"]:
-        phone = message.text
-        user_data[chat_id]['phone'] = phone
-        
-        # Если это режим исправления, возвращаем к подтверждению
-        if user_data[chat_id].get('correcting_mode'):
-            user_data[chat_id]['step'] = 'confirm'
-            show_preview(chat_id)
+    # Телефон, вес, объём и бюджет разбираются сразу: при ошибке вопрос
+    # задаётся снова, а числа сохраняются рядом с исходным текстом
+    if step.get('validator'):
+        parsed = validate(step['validator'], value)
+        if parsed is None:
+            metrics.inc('validation_failed_total', field=step['field'])
+            bot.send_message(chat_id, step['invalid'], reply_markup=KEYBOARDS[step['keyboard']])
             return
-        
-        # Иначе продолжаем обычный поток
-        user_data[chat_id]['step'] = 'destination'
-        bot.send_message(chat_id, "🏙️ Город назначения (Россия):", reply_markup=standard_keyboard())
-        return
-    
-    # Если это команда навигации
-    if message.text == "⬅️ Назад":
-        back_command(message)
-    elif message.text == "👨‍💼 Связаться с менеджером":
-        contact_manager(message)
-    elif message.text == "🏠 В начало":
-        main_menu_command(message)
-
-def process_destination(message):
-    chat_id = message.chat.id
-    if message.text == "❌ Отменить":
-        cancel_command(message)
-        return
-
-    user_data[chat_id]['destination'] = message.text
-    
-    # Если это режим исправления, возвращаем к подтверждению
-    if user_data[chat_id].get('correcting_mode'):
-        user_data[chat_id]['step'] = 'confirm'
-        show_preview(chat_id)
-        return
-    
-    # Иначе продолжаем обычный поток
-    user_data[chat_id]['step'] = 'cargo'
-    bot.send_message(chat_id, "📦 Описание груза:", reply_markup=standard_keyboard())
-
-def process_cargo(message):
-    chat_id = message.chat.id
-    if message.text == "❌ Отменить":
-        cancel_command(message)
-        return
-
-    user_data[chat_id]['cargo'] = message.text
-    
-    # Если это режим исправления, возвращаем к подтверждению
-    if user_data[chat_id].get('correcting_mode'):
-        user_data[chat_id]['step'] = 'confirm'
-        show_preview(chat_id)
-        return
-    
-    # Иначе продолжаем обычный поток
-    user_data[chat_id]['step'] = 'website'
-    bot.send_message(chat_id, "🔗 Ссылка на сайт (или 'Нет'):", reply_markup=standard_keyboard())
-
-def process_website(message):
-    chat_id = message.chat.id
-    if message.text == "❌ Отменить":
-        cancel_command(message)
-        return
-
-    user_data[chat_id]['website'] = message.text
+        state.update(parsed)
+    state[step['field']] = value
     
-    # Если это режим исправления, возвращаем к подтверждению
-    if user_data[chat_id].get('correcting_mode'):
-        user_data[chat_id]['step'] = 'confirm'
-        show_preview(chat_id)
-        return
+    # Данные пользователя фиксируются при первом заполнении имени
+    if step['step'] == 'name' and not state.get('correcting_mode'):
+        state['timestamp'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        state['user_id'] = chat_id
+        state['username'] = f"@{message.from_user.username}" if message.from_user.username else "Не указан"
     
-    # Иначе продолжаем обычный поток
-    user_data[chat_id]['step'] = 'photo'
-    bot.send_message(chat_id, "🖼️ Фото груза (или 'Пропустить фото'):", 
-                    reply_markup=skip_photo_keyboard())
+    complete_step(chat_id)
 
+@metrics.histogram('process_photo_seconds').time
 def process_photo(message):
     chat_id = message.chat.id
+    state = user_data[chat_id]
     
     # Обработка текстовых команд
     if hasattr(message, 'text') and message.text:
-        if message.text == "❌ Отменить":
-            cancel_command(message)
-            return
-        elif message.text == "📷 Пропустить фото":
-            user_data[chat_id]['photo'] = "Не загружено"
-            
-            # Если это режим исправления, возвращаем к подтверждению
-            if user_data[chat_id].get('correcting_mode'):
-                user_data[chat_id]['step'] = 'confirm'
-                show_preview(chat_id)
-                return
-            
-            # Иначе продолжаем обычный поток
-            user_data[chat_id]['step'] = 'weight'
-            bot.send_message(chat_id, "⚖️ Вес груза (кг):", reply_markup=standard_keyboard())
-            return
-        elif message.text in ["⬅️ Назад", "👨‍💼 Связаться с менеджером", "🏠 В начало"]:
-            # Обработка навигационных команд
-            if message.text == "⬅️ Назад":
-                back_command(message)
-            elif message.text == "👨‍💼 Связаться с менеджером":
-                contact_manager(message)
-            elif message.text == "🏠 В начало":
-                main_menu_command(message)
+        if message.text == "📷 Пропустить фото":
+            for field in ('photos', 'photo_file_id', 'photo_unique_id', 'album_id'):
+                state.pop(field, None)
+            state['photo'] = "Не загружено"
+            complete_step(chat_id)
             return
     
     # Обработка фото
     if message.photo:
-        # Сохраняем информацию о фото
-        user_data[chat_id]['photo'] = "Фото загружено"
-        # Сохраняем file_id для возможного дальнейшего использования
-        user_data[chat_id]['photo_file_id'] = message.photo[-1].file_id
-        
-        # Получаем URL фото
-        file_info = bot.get_file(message.photo[-1].file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        
-        # Сохраняем фото локально (на Render.com файловая система временная)
-        photo_filename = f"photo_{chat_id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-        with open(photo_filename, 'wb') as new_file:
-            new_file.write(downloaded_file)
+        # Сохраняем информацию о фото. Сам файл не скачиваем: менеджерам
+        # фото пересылается по file_id, а в архив попадает только по запросу
+        album_id = message.media_group_id
+        if not album_id or state.get('album_id') != album_id:
+            # Новая загрузка заменяет фото, присланные ранее
+            state['photos'] = []
+        if len(state['photos']) < PHOTO_MAX_PER_ORDER:
+            state['photos'].append({
+                'file_id': message.photo[-1].file_id,
+                'unique_id': message.photo[-1].file_unique_id,
+            })
+        set_photo_summary(state)
         
-        user_data[chat_id]['photo_filename'] = photo_filename
-        
-        # Если это режим исправления, возвращаем к подтверждению
-        if user_data[chat_id].get('correcting_mode'):
-            user_data[chat_id]['step'] = 'confirm'
-            show_preview(chat_id)
+        if album_id:
+            # Фото альбома приходят отдельными сообщениями — ждём остальные
+            state['album_id'] = album_id
+            schedule_album_completion(chat_id, album_id)
             return
-        
-        # Иначе продолжаем обычный поток
-        user_data[chat_id]['step'] = 'weight'
-        bot.send_message(chat_id, "✅ Фото сохранено!\n\n⚖️ Вес груза (кг):", reply_markup=standard_keyboard())
+        complete_step(chat_id, "✅ Фото сохранено!\n\n")
+    elif state.get('photos'):
+        # Текст пришёл раньше, чем закрылось окно сбора альбома
+        finish_album(chat_id)
     else:
         user_data[chat_id]['photo'] = "Не загружено"
-        
-        # Если это режим исправления, возвращаем к подтверждению
-        if user_data[chat_id].get('correcting_mode'):
-            user_data[chat_id]['step'] = 'confirm'
-            show_preview(chat_id)
+        complete_step(chat_id)
+
+def set_photo_summary(state):
+    """Обновляет описание фото и ссылку на первое фото в состоянии"""
+    photos = state['photos']
+    state['photo'] = "Фото загружено" if len(photos) == 1 else f"Фото загружено ({len(photos)} шт.)"
+    state['photo_file_id'] = photos[0]['file_id']
+    state['photo_unique_id'] = photos[0]['unique_id']
+
+# Таймеры сбора альбомов: chat_id -> (media_group_id, Timer)
+album_timers = {}
+album_timers_lock = threading.Lock()
+
+def schedule_album_completion(chat_id, album_id):
+    """(Пере)запускает таймер завершения шага после последнего фото альбома"""
+    timer = threading.Timer(PHOTO_ALBUM_WINDOW, complete_album, args=(chat_id, album_id))
+    timer.daemon = True
+    with album_timers_lock:
+        previous = album_timers.get(chat_id)
+        if previous:
+            previous[1].cancel()
+        album_timers[chat_id] = (album_id, timer)
+    timer.start()
+
+def finish_album(chat_id):
+    """Завершает шаг фото собранным альбомом"""
+    state = user_data[chat_id]
+    state.pop('album_id', None)
+    with album_timers_lock:
+        pending = album_timers.pop(chat_id, None)
+    if pending:
+        pending[1].cancel()
+    complete_step(chat_id, f"✅ Сохранено фото: {len(state['photos'])}\n\n")
+
+def complete_album(chat_id, album_id):
+    """Окно сбора альбома закрылось: переходим к следующему шагу"""
+    with album_timers_lock:
+        pending = album_timers.get(chat_id)
+        # Таймер перезапущен более поздним фото — завершит уже новый
+        if not pending or pending[1] is not threading.current_thread():
             return
-        
-        # Иначе продолжаем обычный поток
-        user_data[chat_id]['step'] = 'weight'
-        bot.send_message(chat_id, "⚖️ Вес груза (кг):", reply_markup=standard_keyboard())
-
-def process_weight(message):
-    chat_id = message.chat.id
-    if message.text == "❌ Отменить":
-        cancel_command(message)
-        return
-
-    user_data[chat_id]['weight'] = message.text
-    
-    # Если это режим исправления, возвращаем к подтверждению
-    if user_data[chat_id].get('correcting_mode'):
-        user_data[chat_id]['step'] = 'confirm'
-        show_preview(chat_id)
-        return
-    
-    # Иначе продолжаем обычный поток
-    user_data[chat_id]['step'] = 'volume'
-    bot.send_message(chat_id, "📏 Объем груза (м³):", reply_markup=standard_keyboard())
-
-def process_volume(message):
-    chat_id = message.chat.id
-    if message.text == "❌ Отменить":
-        cancel_command(message)
-        return
-
-    user_data[chat_id]['volume'] = message.text
-    
-    # Если это режим исправления, возвращаем к подтверждению
-    if user_data[chat_id].get('correcting_mode'):
-        user_data[chat_id]['step'] = 'confirm'
-        show_preview(chat_id)
-        return
-    
-    # Иначе продолжаем обычный поток
-    user_data[chat_id]['step'] = 'delivery'
-    bot.send_message(chat_id, "🚚 Способ доставки:", reply_markup=delivery_keyboard())
-
-def process_delivery(message):
-    chat_id = message.chat.id
-    if message.text == "❌ Отменить":
-        cancel_command(message)
-        return
-
-    user_data[chat_id]['delivery'] = message.text
-    
-    # Если это режим исправления, возвращаем к подтверждению
-    if user_data[chat_id].get('correcting_mode'):
-        user_data[chat_id]['step'] = 'confirm'
-        show_preview(chat_id)
-        return
-    
-    # Иначе продолжаем обычный поток
-    user_data[chat_id]['step'] = 'budget'
-    bot.send_message(chat_id, "💰 Бюджет:", reply_markup=standard_keyboard())
-
-def process_budget(message):
-    chat_id = message.chat.id
-    if message.text == "❌ Отменить":
-        cancel_command(message)
-        return
-
-    user_data[chat_id]['budget'] = message.text
-    
-    # Если это режим исправления, возвращаем к подтверждению
-    if user_data[chat_id].get('correcting_mode'):
-        user_data[chat_id]['step'] = 'confirm'
-        show_preview(chat_id)
-        return
-    
-    # Иначе продолжаем обычный поток
-    user_data[chat_id]['step'] = 'comment'
-    bot.send_message(chat_id, "💬 Комментарии (или 'Нет'):", reply_markup=standard_keyboard())
-
-def process_comment(message):
-    chat_id = message.chat.id
-    if message.text == "❌ Отменить":
-        cancel_command(message)
-        return
-
-    user_data[chat_id]['comment'] = message.text
-    
-    # Если это режим исправления, возвращаем к подтверждению
-    if user_data[chat_id].get('correcting_mode'):
-        user_data[chat_id]['step'] = 'confirm'
-        show_preview(chat_id)
-        return
-    
-    # Иначе продолжаем обычный поток
-    user_data[chat_id]['step'] = 'confirm'
-    
-    # Показываем заявку для подтверждения
-    show_preview(chat_id)
+        del album_timers[chat_id]
+    try:
+        with user_data.session(chat_id):
+            state = user_data.get(chat_id)
+            # Пока ждали, диалог мог уйти с шага фото или начать новый альбом
+            if not state or state.get('step') != 'photo' or state.get('album_id') != album_id:
+                return
+            metrics.inc('photo_albums_total')
+            finish_album(chat_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка завершения альбома в чате {chat_id}: {e}")
 
 def show_preview(chat_id):
     """Показывает предварительный просмотр заявки"""
@@ -691,21 +940,21 @@ def show_preview(chat_id):
 ✅ Проверьте правильность данных:
 
 👤 Имя: {user_data[chat_id]['name']}
-📞 Телефон: {user_data[chat_id]['phone']}
+📞 Телефон: {display(user_data[chat_id], 'phone')}
 🏙️ Город назначения: {user_data[chat_id]['destination']}
 📦 Груз: {user_data[chat_id]['cargo']}
 🔗 Ссылка: {user_data[chat_id]['website']}
 🖼️ Фото: {user_data[chat_id]['photo']}
-⚖️ Вес: {user_data[chat_id]['weight']} кг
-📏 Объем: {user_data[chat_id]['volume']} м³
+⚖️ Вес: {display(user_data[chat_id], 'weight')}
+📏 Объем: {display(user_data[chat_id], 'volume')}
 🚚 Способ доставки: {user_data[chat_id]['delivery']}
-💰 Бюджет: {user_data[chat_id]['budget']}
+💰 Бюджет: {display(user_data[chat_id], 'budget')}
 💬 Комментарии: {user_data[chat_id]['comment']}
 
 Всё верно?
 """
     
-    bot.send_message(chat_id, preview_text, reply_markup=confirm_keyboard())
+    bot.send_message(chat_id, preview_text, reply_markup=KEYBOARDS['confirm'])
 
 def process_confirmation(message):
     chat_id = message.chat.id
@@ -714,11 +963,15 @@ def process_confirmation(message):
         return
     
     if message.text == "✅ Подтвердить":
-        # Сохраняем данные
-        save_data(user_data[chat_id])
+        # ID заявки привязан к сообщению подтверждения, поэтому повторная
+        # доставка того же сообщения не создаст вторую заявку
+        order = dict(user_data[chat_id])
+        order['order_id'] = f"{chat_id}-{message.message_id}"
         
-        # Отправляем менеджерам
-        send_to_managers(user_data[chat_id])
+        # Заявка фиксируется в журнале сразу, а сохранение в таблицу и
+        # рассылка менеджерам идут в фоне — пользователь не ждёт их
+        record_order(order)
+        submit_job(chat_id, process_order, order)
         
         # Финальное сообщение
         final_text = f"""
@@ -729,7 +982,7 @@ def process_confirmation(message):
 Спасибо, что выбрали наш сервис! 🚚
 """
         
-        bot.send_message(chat_id, final_text, reply_markup=main_menu_keyboard())
+        bot.send_message(chat_id, final_text, reply_markup=KEYBOARDS['main_menu'])
         
         # Очищаем данные
         if chat_id in user_data:
@@ -746,7 +999,7 @@ def show_correction_options(chat_id):
 
 Нажмите на поле, которое нужно изменить:
 """
-    bot.send_message(chat_id, correction_text, reply_markup=correction_keyboard())
+    bot.send_message(chat_id, correction_text, reply_markup=KEYBOARDS['correction'])
 
 def process_correction(message):
     chat_id = message.chat.id
@@ -760,53 +1013,97 @@ def process_correction(message):
     user_data[chat_id]['correcting_mode'] = True
     
     # Определяем какое поле нужно исправить
-    if message.text == "👤 Имя":
-        user_data[chat_id]['step'] = 'name'
-        bot.send_message(chat_id, "Введите ваше имя:", reply_markup=standard_keyboard())
-    
-    elif message.text == "📞 Телефон":
-        user_data[chat_id]['step'] = 'phone'
-        bot.send_message(chat_id, "📞 Ваш номер телефона:", reply_markup=phone_keyboard())
-    
-    elif message.text == "🏙️ Город":
-        user_data[chat_id]['step'] = 'destination'
-        bot.send_message(chat_id, "🏙️ Город назначения (Россия):", reply_markup=standard_keyboard())
-    
-    elif message.text == "📦 Груз":
-        user_data[chat_id]['step'] = 'cargo'
-        bot.send_message(chat_id, "📦 Описание груза:", reply_markup=standard_keyboard())
-    
-    elif message.text == "🔗 Ссылка":
-        user_data[chat_id]['step'] = 'website'
-        bot.send_message(chat_id, "🔗 Ссылка на сайт (или 'Нет'):", reply_markup=standard_keyboard())
-    
-    elif message.text == "🖼️ Фото":
-        user_data[chat_id]['step'] = 'photo'
-        bot.send_message(chat_id, "🖼️ Фото груза (или 'Пропустить фото'):", reply_markup=skip_photo_keyboard())
-    
-    elif message.text == "⚖️ Вес":
-        user_data[chat_id]['step'] = 'weight'
-        bot.send_message(chat_id, "⚖️ Вес груза (кг):", reply_markup=standard_keyboard())
-    
-    elif message.text == "📏 Объем":
-        user_data[chat_id]['step'] = 'volume'
-        bot.send_message(chat_id, "📏 Объем груза (м³):", reply_markup=standard_keyboard())
-    
-    elif message.text == "🚚 Доставка":
-        user_data[chat_id]['step'] = 'delivery'
-        bot.send_message(chat_id, "🚚 Способ доставки:", reply_markup=delivery_keyboard())
+    step_name = CORRECTION_STEPS.get(message.text)
+    if step_name:
+        ask_step(chat_id, step_name)
+
+def process_start(message):
+    if message.text == "📦 Новая заявка":
+        new_request(message)
+    elif message.text == "👨‍💼 Связаться с менеджером":
+        contact_manager(message)
+    else:
+        start_command(message)
+
+# Таблица обработчиков по текущему шагу диалога
+STEP_HANDLERS = {
+    'start': process_start,
+    'manager_contact': process_manager_contact,
+    CONFIRM_STEP: process_confirmation,
+    'correction': process_correction,
+}
+for step_name in STEPS:
+    STEP_HANDLERS[step_name] = process_form_step
+STEP_HANDLERS['photo'] = process_photo
+
+# Метрики шагов создаются заранее, чтобы на каждое сообщение не строить ключи
+STEP_LATENCY = {step: metrics.histogram('handler_seconds', step=step) for step in STEP_HANDLERS}
+STEP_ERRORS = {step: metrics.counter('handler_errors_total', step=step) for step in STEP_HANDLERS}
+TELEGRAM_SEND_LATENCY = metrics.histogram('telegram_send_seconds')
+
+def process_help_request(request_key, text, row):
+    """Фоновая обработка запроса помощи: менеджеры и таблица"""
+    send_to_manager_chats(text, "Запрос помощи", key=f"notify-{request_key}")
+    if sheets_enabled():
+        try:
+            queue_sheet_row(request_key, row)
+            return
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения запроса помощи: {e}")
+    journal.append('help', request_key, {'text': text}, row=row)
+
+def record_order(data):
+    """Записывает заявку в журнал до ответа пользователю"""
+    try:
+        # Ссылки на фото в таблице должны открываться, даже если фото ещё не скачано
+        for photo in order_photos(data):
+            photo_store.remember(photo['file_id'], photo['unique_id'])
+        order_store.save(data)
+        if sheets_enabled():
+            outbox.record('sheet_row', data['order_id'], build_order_row(data))
+        if MANAGER_CHAT_IDS:
+            outbox.record('notification', f"notify-{data['order_id']}", notification_payload(
+                build_manager_text(data), None, data.get('photo_file_id'), "Новая заявка", order_album(data)
+            ))
+    except Exception as e:
+        logger.error(f"❌ Ошибка записи заявки в журнал: {e}")
+
+def order_photos(data):
+    """Фото заявки: список {'file_id', 'unique_id'}"""
+    if data.get('photos'):
+        return data['photos']
+    if data.get('photo_file_id'):
+        return [{'file_id': data['photo_file_id'], 'unique_id': data.get('photo_unique_id')}]
+    return []
+
+def order_album(data):
+    """file_id фото для отправки альбомом (None, если фото одно или нет)"""
+    photos = order_photos(data)
+    return [photo['file_id'] for photo in photos] if len(photos) > 1 else None
+
+def archive_order_photo(data):
+    """Скачивает фото заявки в локальный архив"""
+    for photo in order_photos(data):
+        try:
+            path = photo_store.fetch(photo['file_id'], photo['unique_id'])
+            logger.info(f"🖼️ Фото заявки {data['order_id']} сохранено в архив: {path}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения фото заявки {data['order_id']}: {e}")
+
+def process_order(data):
+    """Фоновая обработка подтверждённой заявки"""
+    if PHOTO_ARCHIVE and data.get('photo_file_id'):
+        archive_order_photo(data)
     
-    elif message.text == "💰 Бюджет":
-        user_data[chat_id]['step'] = 'budget'
-        bot.send_message(chat_id, "💰 Бюджет:", reply_markup=standard_keyboard())
+    # Сохраняем данные
+    save_data(data)
     
-    elif message.text == "💬 Комментарий":
-        user_data[chat_id]['step'] = 'comment'
-        bot.send_message(chat_id, "💬 Комментарии (или 'Нет'):", reply_markup=standard_keyboard())
+    # Отправляем менеджерам
+    send_to_managers(data)
 
-def send_to_managers(data):
-    """Отправляем заявку менеджерам"""
-    manager_text = f"""
+def build_manager_text(data):
+    """Текст уведомления менеджерам о новой заявке"""
+    return f"""
 🆕 НОВАЯ ЗАЯВКА НА ДОСТАВКУ
 
 📅 Дата: {data['timestamp']}
@@ -815,153 +1112,366 @@ def send_to_managers(data):
 
 📋 ДАННЫЕ ЗАЯВКИ:
 ├ Имя: {data.get('name', '')}
-├ Телефон: {data.get('phone', '')}
+├ Телефон: {display(data, 'phone', with_raw=True)}
 ├ Город назначения: {data.get('destination', '')}
 ├ Груз: {data.get('cargo', '')}
 ├ Ссылка: {data.get('website', '')}
 ├ Фото: {data.get('photo', '')}
-├ Вес: {data.get('weight', '')} кг
-├ Объем: {data.get('volume', '')} м³
+├ Вес: {display(data, 'weight', with_raw=True)}
+├ Объем: {display(data, 'volume', with_raw=True)}
 ├ Способ доставки: {data.get('delivery', '')}
-├ Бюджет: {data.get('budget', '')}
+├ Бюджет: {display(data, 'budget', with_raw=True)}
 └ Комментарии: {data.get('comment', '')}
 
 ⚡ Срочно свяжитесь с клиентом!
 """
+
+def send_to_managers(data):
+    """Отправляем заявку менеджерам"""
+    manager_text = build_manager_text(data)
     
-    # Отправляем фото менеджерам, если оно есть
-    photo_path = data.get('photo_filename')
+    # Отправляем фото менеджерам, если оно есть. file_id из Telegram позволяет
+    # переслать фото без скачивания и повторной загрузки файла
+    photo_file_id = data.get('photo_file_id')
     
     # Отправляем в указанные чаты менеджеров
-    send_to_manager_chats(manager_text, photo_path, "Новая заявка")
-    
-    # Альтернативный способ - сохраняем в лог файл
-    save_manager_notification(manager_text, data.get('name', 'N/A'))
-
-def send_to_manager_chats(text, photo_path=None, notification_type="Уведомление"):
-    """Отправляет сообщения в чаты менеджеров"""
+    send_to_manager_chats(manager_text, "Новая заявка", key=f"notify-{data['order_id']}",
+                          photo_file_id=photo_file_id, album=order_album(data))
+    
+    # Альтернативный способ - сохраняем в журнал
+    save_manager_notification(manager_text, data.get('name', 'N/A'), key=data['order_id'])
+
+def notification_payload(text, photo_file_id, notification_type, album=None):
+    """Запись уведомления в журнале"""
+    return {
+        'text': text,
+        'photo_file_id': photo_file_id,
+        'album': album,
+        'type': notification_type,
+    }
+
+# Больше фото в одном send_media_group Telegram не принимает
+MEDIA_GROUP_LIMIT = 10
+CAPTION_LIMIT = 1024
+
+def send_album(manager_id, text, album):
+    """Отправляет фото альбомами по file_id — один запрос на 10 фото
+    
+    Текст идёт подписью к первому фото, а если не помещается в подпись —
+    отдельным сообщением перед альбомом.
+    """
+    caption = text if len(text) <= CAPTION_LIMIT else None
+    if caption is None:
+        bot.send_message(chat_id=manager_id, text=text)
+    for start in range(0, len(album), MEDIA_GROUP_LIMIT):
+        media = [types.InputMediaPhoto(file_id) for file_id in album[start:start + MEDIA_GROUP_LIMIT]]
+        if start == 0 and caption:
+            media[0].caption = caption
+        bot.send_media_group(chat_id=manager_id, media=media)
+
+def send_to_manager(manager_id, text, photo=None, notification_type="Уведомление", album=None):
+    """Отправляет уведомление одному менеджеру
+    
+    photo — file_id фото в Telegram, album — список file_id для отправки альбомом.
+    """
+    started = time.monotonic()
+    try:
+        # Уведомления менеджерам уступают очередь ответам пользователям
+        with send_scheduler.context(NOTIFY):
+            if album:
+                send_album(manager_id, text, album)
+            elif photo:
+                bot.send_photo(chat_id=manager_id, photo=photo, caption=text)
+            else:
+                bot.send_message(chat_id=manager_id, text=text)
+    except Exception:
+        metrics.inc('manager_send_total', manager=manager_id, result='error')
+        raise
+    finally:
+        latency = time.monotonic() - started
+        TELEGRAM_SEND_LATENCY.observe(latency)
+        metrics.histogram('manager_send_seconds', manager=manager_id).observe(latency)
+        metrics.set('manager_send_last_seconds', latency, manager=manager_id)
+    
+    metrics.inc('manager_send_total', manager=manager_id, result='ok')
+    logger.info(f"✅ {notification_type}{' с фото' if album or photo else ''} отправлена менеджеру {manager_id}")
+
+@metrics.histogram('notify_managers_seconds').time
+def send_to_manager_chats(text, notification_type="Уведомление", key=None, photo_file_id=None, album=None):
+    """Отправляет сообщения в чаты менеджеров
+    
+    Если передан key, уведомление записывается в журнал и каждому менеджеру
+    отправляется не больше одного раза, даже при повторной доставке.
+    Рассылка идёт параллельно; фото уходят по file_id, без повторной загрузки.
+    """
     if not MANAGER_CHAT_IDS:
         logger.warning(f"⚠️ Список ID менеджеров пуст. {notification_type} не отправлена.")
         # Сохраняем в лог файл как запасной вариант
         save_manager_notification(text, "Менеджер")
         return
     
+    delivered = set()
+    if key:
+        outbox.record('notification', key, notification_payload(text, photo_file_id, notification_type, album))
+        delivered = outbox.delivered_targets(key)
+    
     success_count = 0
+    pending = []
     for manager_id in MANAGER_CHAT_IDS:
+        if str(manager_id) in delivered:
+            success_count += 1
+        else:
+            pending.append(manager_id)
+    
+    def deliver(manager_id):
+        send_to_manager(manager_id, text, photo_file_id, notification_type, album)
+        if key:
+            outbox.mark_target_delivered(key, manager_id)
+    
+    futures = {manager_pool.submit(deliver, manager_id): manager_id for manager_id in pending}
+    for future, manager_id in futures.items():
         try:
-            if photo_path and os.path.exists(photo_path):
-                # Отправляем фото с текстом
-                with open(photo_path, 'rb') as photo:
-                    bot.send_photo(chat_id=manager_id, photo=photo, caption=text)
-                logger.info(f"✅ {notification_type} с фото отправлена менеджеру {manager_id}")
-            else:
-                # Отправляем только текст
-                bot.send_message(chat_id=manager_id, text=text)
-                logger.info(f"✅ {notification_type} отправлена менеджеру {manager_id}")
+            future.result()
             success_count += 1
         except Exception as e:
             logger.error(f"❌ Ошибка отправки менеджеру {manager_id}: {e}")
     
+    if key and success_count == len(MANAGER_CHAT_IDS):
+        outbox.mark_delivered([key])
+    
     if success_count == 0:
         logger.warning(f"⚠️ Ни одному менеджеру не удалось отправить {notification_type}")
         save_manager_notification(text, "Менеджер")
 
-def save_manager_notification(text, user_name):
-    """Сохраняет уведомление в файл (запасной вариант)"""
+def save_manager_notification(text, user_name, key=None):
+    """Сохраняет уведомление в запасной журнал"""
     try:
-        filename = f"manager_notifications.txt"
-        with open(filename, 'a', encoding='utf-8') as f:
-            f.write(f"\n{'='*60}\n")
-            f.write(f"Дата: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Пользователь: {user_name}\n")
-            f.write(f"Текст:\n{text}\n")
-            f.write(f"{'='*60}\n")
-        logger.info(f"📝 Уведомление сохранено в файл: {filename}")
+        journal.append('notification', key, {'text': text, 'user': user_name})
     except Exception as e:
-        logger.error(f"❌ Ошибка сохранения уведомления в файл: {e}")
+        logger.error(f"❌ Ошибка сохранения уведомления в журнал: {e}")
+
+def typed(data, field, raw_field):
+    """Число для ячейки таблицы; исходный текст, если ответ не разобран"""
+    value = data.get(field)
+    return value if value is not None else data.get(raw_field, '')
+
+def build_order_row(data):
+    """Строка заявки для Google Таблицы"""
+    # Формируем строку для таблицы в правильном порядке
+    photo_info = data.get('photo', 'Не загружено')
+    photos = order_photos(data)
+    if photos and PUBLIC_URL:
+        photo_info = "\n".join(photo_url(photo['unique_id']) for photo in photos)
+    elif photos:
+        photo_info = "Фото в Telegram: " + ", ".join(photo['unique_id'] for photo in photos)
+    
+    # ВАЖНО: Этот порядок должен соответствовать столбцам в вашей Google таблице
+    return [
+        "Новая заявка",  # A: Статус
+        data.get('timestamp', ''),  # B: Дата создания
+        str(data.get('user_id', '')),  # C: User ID
+        data.get('username', ''),  # D: Username
+        data.get('name', ''),  # E: Имя
+        data.get('phone_e164') or data.get('phone', ''),  # F: Телефон (E.164)
+        data.get('destination', ''),  # G: Город назначения
+        data.get('cargo', ''),  # H: Описание груза
+        data.get('website', ''),  # I: Ссылка на сайт
+        photo_info,  # J: Фото
+        typed(data, 'weight_kg', 'weight'),  # K: Вес, кг
+        typed(data, 'volume_m3', 'volume'),  # L: Объем, м³
+        data.get('delivery', ''),  # M: Способ доставки
+        budget_cell(data),  # N: Бюджет
+        data.get('comment', ''),  # O: Комментарий
+        data.get('order_id', '')  # P: ID заявки
+    ]
 
+@metrics.histogram('save_data_seconds').time
 def save_data(data):
     """Сохраняем данные в Google Sheets или файл"""
     # Пробуем сохранить в Google Sheets
-    if sheet:
+    if sheets_enabled():
         try:
-            # Формируем строку для таблицы в правильном порядке
-            photo_info = data.get('photo', 'Не загружено')
-            if data.get('photo_filename'):
-                photo_info = f"Фото сохранено: {data.get('photo_filename')}"
-            
-            # ВАЖНО: Этот порядок должен соответствовать столбцам в вашей Google таблице
-            row = [
-                "Новая заявка",  # A: Статус
-                data.get('timestamp', ''),  # B: Дата создания
-                str(data.get('user_id', '')),  # C: User ID
-                data.get('username', ''),  # D: Username
-                data.get('name', ''),  # E: Имя
-                data.get('phone', ''),  # F: Телефон
-                data.get('destination', ''),  # G: Город назначения
-                data.get('cargo', ''),  # H: Описание груза
-                data.get('website', ''),  # I: Ссылка на сайт
-                photo_info,  # J: Фото
-                data.get('weight', ''),  # K: Вес
-                data.get('volume', ''),  # L: Объем
-                data.get('delivery', ''),  # M: Способ доставки
-                data.get('budget', ''),  # N: Бюджет
-                data.get('comment', '')  # O: Комментарий
-            ]
-            sheet.append_row(row)
-            logger.info(f"✅ Данные сохранены в Google Таблицу (пользователь: {data.get('name', 'N/A')})")
+            queue_sheet_row(data['order_id'], build_order_row(data))
+            logger.info(f"✅ Заявка поставлена в очередь записи в Google Таблицу (пользователь: {data.get('name', 'N/A')})")
             return
         except Exception as e:
             logger.error(f"❌ Ошибка сохранения в Google Sheets: {e}")
     
-    # Если Google Sheets не доступен, сохраняем в файл
+    # Если Google Sheets не доступен, сохраняем в журнал: строка таблицы
+    # хранится вместе с заявкой для повторного импорта (python journal.py import)
     save_to_file(data)
 
 def save_to_file(data):
-    """Сохраняем данные в текстовый файл"""
+    """Сохраняем заявку в запасной журнал"""
     try:
-        filename = f"заявки_{datetime.datetime.now().strftime('%Y%m')}.txt"
-        with open(filename, 'a', encoding='utf-8') as f:
-            f.write("=" * 50 + "\n")
-            f.write(f"Дата: {data['timestamp']}\n")
-            f.write(f"ID: {data.get('user_id', '')}\n")
-            f.write(f"Username: {data.get('username', '')}\n")
-            f.write(f"Имя: {data.get('name', '')}\n")
-            f.write(f"Телефон: {data.get('phone', '')}\n")
-            f.write(f"Город назначения: {data.get('destination', '')}\n")
-            f.write(f"Груз: {data.get('cargo', '')}\n")
-            f.write(f"Ссылка: {data.get('website', '')}\n")
-            f.write(f"Фото: {data.get('photo', '')}\n")
-            if data.get('photo_filename'):
-                f.write(f"Файл фото: {data.get('photo_filename')}\n")
-            f.write(f"Вес: {data.get('weight', '')} кг\n")
-            f.write(f"Объем: {data.get('volume', '')} м³\n")
-            f.write(f"Способ доставки: {data.get('delivery', '')}\n")
-            f.write(f"Бюджет: {data.get('budget', '')}\n")
-            f.write(f"Комментарии: {data.get('comment', '')}\n")
-            f.write("=" * 50 + "\n\n")
-        
-        logger.info(f"✅ Данные сохранены в файл: {filename}")
+        journal.append('order', data.get('order_id'), data, row=build_order_row(data))
+        logger.info(f"✅ Заявка сохранена в журнал: {JOURNAL_DIR}")
     except Exception as e:
-        logger.error(f"❌ Ошибка сохранения в файл: {e}")
+        logger.error(f"❌ Ошибка сохранения в журнал: {e}")
+
+# ========== ПОВТОРНАЯ ДОСТАВКА ИЗ ЖУРНАЛА ==========
+def replay_sheet_rows(entries):
+    """Повторно ставит в очередь строки, которые не дошли до таблицы"""
+    if not sheet_writer or not sheet_writer.ready:
+        return []
+    entries = [(key, row) for key, row, _ in entries if not sheet_writer.is_pending(key)]
+    if not entries:
+        return []
+    # Строки могли быть записаны прямо перед сбоем. Столбец ID заявки (P)
+    # читается один раз за проход, а не поиском по листу для каждой строки
+    found = sheet.locate([key for key, _ in entries], column=16)
+    if found:
+        order_store.place([(key, title, row) for key, (title, row) in found.items()])
+        outbox.mark_delivered(list(found))
+    for key, row in entries:
+        if key not in found:
+            sheet_writer.append(row, key)
+    # Попытку засчитает sheet_writer (on_failure), если запись не удастся
+    return []
+
+def replay_notifications(entries):
+    """Досылает уведомления менеджерам, которые их ещё не получили"""
+    for key, payload, _ in entries:
+        try:
+            send_to_manager_chats(payload['text'], payload['type'], key=key,
+                                  photo_file_id=payload.get('photo_file_id'), album=payload.get('album'))
+        except Exception as e:
+            logger.error(f"❌ Ошибка повторной доставки {key}: {e}")
+    return [key for key, _, _ in entries]
+
+outbox_replayer = OutboxReplayer(outbox, {
+    'sheet_row': replay_sheet_rows,
+    'notification': replay_notifications,
+}).start()
+atexit.register(outbox_replayer.stop)
+
+# ========== СОСТОЯНИЕ И МЕТРИКИ ==========
+def readiness():
+    """Готов ли сервис принимать обновления. Возвращает (готов, подробности)"""
+    queue_depth = update_pool.queue_depth()
+    # Чаты привязаны к очередям по хешу: одна переполненная очередь уже
+    # отказывает своим чатам, даже если остальные свободны
+    max_depth = update_pool.max_queue_depth()
+    saturated = max_depth >= UPDATE_QUEUE_SIZE * 0.9
+    ready = startup.ready() and not saturated
+    return ready, {
+        'ready': ready,
+        'components': startup.status(),
+        'update_queue_depth': queue_depth,
+        'update_queue_max_depth': max_depth,
+    }
+
+def metrics_authorized(authorization):
+    return not METRICS_TOKEN or hmac.compare_digest(authorization or '', f"Bearer {METRICS_TOKEN}")
+
+def metrics_text():
+    """Метрики в формате Prometheus; глубины очередей снимаются в момент запроса"""
+    metrics.set('update_queue_depth', update_pool.queue_depth())
+    metrics.set('pipeline_queue_depth', order_pipeline.queue_depth())
+    metrics.set('send_queue_depth', send_scheduler.queue_depth())
+    for client, (_, _, reuse) in http_pool.stats().items():
+        metrics.set('http_connection_reuse_ratio', reuse, client=client)
+    for kind, pending in outbox.stats().items():
+        metrics.set('outbox_pending', pending, kind=kind)
+    for kind, dead in outbox.dead_stats().items():
+        metrics.set('outbox_dead', dead, kind=kind)
+    if sheet_writer:
+        metrics.set('sheets_queue_depth', sheet_writer.queue_depth())
+    metrics.set('ready', int(startup.ready()))
+    return metrics.render_prometheus()
+
+def orders_api_authorized(authorization):
+    return bool(ORDERS_API_TOKEN) and hmac.compare_digest(authorization or '', f"Bearer {ORDERS_API_TOKEN}")
+
+def query_orders(args):
+    """Поиск заявок для /api/orders. Возвращает (ответ, код)"""
+    filters = {name: args.get(name) for name in ORDER_FILTERS if args.get(name)}
+    before = args.get('before')
+    try:
+        if 'user_id' in filters:
+            filters['user_id'] = int(filters['user_id'])
+        limit = int(args.get('limit', 20))
+        if before:
+            # Курсор следующей страницы: "<дата создания>|<ID заявки>"
+            created_at, _, order_id = before.rpartition('|')
+            filters['before'] = (created_at, order_id)
+    except ValueError:
+        return {'error': 'invalid parameter'}, 400
+    orders = order_store.search(limit=limit, **filters)
+    result = {'orders': orders}
+    if len(orders) == max(1, min(limit, ORDER_SEARCH_MAX_LIMIT)):
+        last = orders[-1]
+        result['next'] = f"{last.get('timestamp', '')}|{last['order_id']}"
+    return result, 200
 
 # ========== WEBHOOK МАРШРУТЫ ДЛЯ RENDER ==========
 @app.route('/')
 def home():
     return "🚚 Telegram Bot для доставки из Китая в РФ активен!"
 
+@app.route('/healthz')
+def healthz():
+    # Процесс жив и отвечает; внешние зависимости проверяет /readyz
+    return {'status': 'ok'}
+
+@app.route('/readyz')
+def readyz():
+    ready, details = readiness()
+    return details, 200 if ready else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics_authorized(request.headers.get('Authorization')):
+        return 'Forbidden', 403
+    return metrics_text(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/photos/<unique_id>')
+def photo(unique_id):
+    # ?size=thumb — миниатюра, если включена обработка фото
+    path, status = resolve_photo(unique_id, request.args.get('sig'), request.args.get('size') == 'thumb')
+    if path is None:
+        return '', status
+    return send_file(path, mimetype='image/jpeg', max_age=7 * 24 * 3600)
+
+@app.route('/api/orders')
+def orders_api():
+    if not orders_api_authorized(request.headers.get('Authorization')):
+        return {'error': 'forbidden'}, 403
+    return query_orders(request.args)
+
+@app.route('/api/orders/<order_id>')
+def order_api(order_id):
+    if not orders_api_authorized(request.headers.get('Authorization')):
+        return {'error': 'forbidden'}, 403
+    order = order_store.get(order_id)
+    if order is None:
+        return {'error': 'not found'}, 404
+    return order
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return 'Forbidden', 403
     if request.headers.get('content-type') == 'application/json':
         json_string = request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        try:
+            update = telebot.types.Update.de_json(json_string)
+        except Exception as e:
+            logger.error(f"❌ Некорректное обновление от Telegram: {e}")
+            return 'Bad request', 400
+        # Отвечаем сразу: обработка идёт в пуле. Если очередь переполнена,
+        # Telegram повторит доставку позже
+        if not enqueue_update(update, timeout=0):
+            return 'Busy', 503, {'Retry-After': '5'}
         return ''
     else:
         return 'Invalid content type', 403
 
 # ========== ЗАПУСК ПРИЛОЖЕНИЯ ==========
 if __name__ == '__main__':
+    if BOT_ENGINE == 'async':
+        logger.warning("⚠️ BOT_ENGINE=async: асинхронный режим запускается через start_bot.py")
+    
     # На Render используем порт из переменной окружения
     port = int(os.environ.get('PORT', 5000))
     
@@ -969,7 +1479,7 @@ if __name__ == '__main__':
     webhook_url = os.environ.get('WEBHOOK_URL')
     if webhook_url:
         bot.remove_webhook()
-        bot.set_webhook(url=f"{webhook_url}/webhook")
+        bot.set_webhook(url=f"{webhook_url}/webhook", secret_token=WEBHOOK_SECRET)
         logger.info(f"✅ Webhook установлен: {webhook_url}/webhook")
     else:
         logger.info("🔧 Режим: Webhook не настроен, используется polling")
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+import app as bot_app
+
+logger = logging.getLogger(__name__)
+
+ASYNC_HANDLER_THREADS = int(os.environ.get('ASYNC_HANDLER_THREADS', 16))
+ASYNC_MAX_PENDING = int(os.environ.get('ASYNC_MAX_PENDING', 1000))
+
+
+class AsyncEngine:
+    """Асинхронный приём обновлений.
+
+    Это адаптер только для входящих обновлений: long polling AsyncTeleBot или
+    aiohttp-webhook принимают их в event loop, а обрабатывают те же
+    синхронные обработчики диалога из app.py (TeleBot.process_new_updates) в
+    пуле потоков. Ответы отправляются через синхронный send_scheduler, как и
+    в режиме sync, поэтому поток обработчика ждёт отправки. Порядок сообщений
+    одного чата сохраняется, разные чаты обрабатываются параллельно.
+    """
+
+    LOCK_STRIPES = 256
+
+    def __init__(self, threads=ASYNC_HANDLER_THREADS, max_pending=ASYNC_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="async-handler")
+        self.max_pending = max_pending
+        self._locks = None
+        self._pending = None
+        self._tasks = set()
+
+    def _ensure_loop_objects(self):
+        # asyncio-примитивы создаём уже внутри работающего event loop
+        if self._locks is None:
+            self._locks = [asyncio.Lock() for _ in range(self.LOCK_STRIPES)]
+            self._pending = asyncio.Semaphore(self.max_pending)
+
+    async def dispatch(self, update):
+        """Принимает обновление; ждёт только при переполнении (backpressure)"""
+        self._ensure_loop_objects()
+        if not bot_app.update_dedup.check(update.update_id):
+            logger.info(f"🔁 Повторное обновление {update.update_id} пропущено")
+            return
+        await self._pending.acquire()
+        chat_id = bot_app.update_chat_id(update)
+        if chat_id in bot_app.MANAGER_CHAT_IDS:
+            self._start(update)
+            return
+        # Ограничитель частоты может передать обновление позже из своего
+        # потока, поэтому запуск и освобождение места идут через event loop
+        loop = asyncio.get_running_loop()
+        action = bot_app.flood_guard.admit(
+            chat_id, update,
+            lambda update: loop.call_soon_threadsafe(self._start, update),
+            lambda update: loop.call_soon_threadsafe(self._pending.release),
+            group=bot_app.update_media_group(update),
+        )
+        bot_app.warn_flood(chat_id, action)
+
+    def _start(self, update):
+        # Задачи стартуют в порядке создания и в том же порядке встают в
+        # очередь замка — так сохраняется порядок сообщений одного чата
+        lock = self._locks[hash(bot_app.update_chat_id(update)) % self.LOCK_STRIPES]
+        task = asyncio.create_task(self._run(update, lock))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        bot_app.metrics.set('update_queue_depth', len(self._tasks))
+
+    async def _run(self, update, lock):
+        loop = asyncio.get_running_loop()
+        try:
+            async with lock:
+                await loop.run_in_executor(self.executor, bot_app.handle_update, update)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            self._pending.release()
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class BridgeBot(AsyncTeleBot):
+    """AsyncTeleBot, передающий обновления в AsyncEngine"""
+
+    def __init__(self, token, engine):
+        super().__init__(token)
+        self.engine = engine
+
+    async def process_new_updates(self, updates):
+        for update in updates:
+            await self.engine.dispatch(update)
+
+
+# Ключ движка в web.Application
+ENGINE = web.AppKey('engine', AsyncEngine)
+
+
+async def webhook_handler(request):
+    engine = request.app[ENGINE]
+    secret = bot_app.WEBHOOK_SECRET
+    if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+        return web.Response(status=403, text='Forbidden')
+    if request.content_type != 'application/json':
+        return web.Response(status=403, text='Invalid content type')
+    try:
+        update = types.Update.de_json(await request.text())
+    except Exception as e:
+        logger.error(f"❌ Некорректное обновление от Telegram: {e}")
+        return web.Response(status=400, text='Bad request')
+    await engine.dispatch(update)
+    return web.Response(text='')
+
+
+async def photo_handler(request):
+    # Поиск и скачивание фото — блокирующие операции, выполняем в пуле потоков
+    path, status = await asyncio.get_running_loop().run_in_executor(
+        request.app[ENGINE].executor, bot_app.resolve_photo,
+        request.match_info['unique_id'], request.query.get('sig'), request.query.get('size') == 'thumb',
+    )
+    if path is None:
+        return web.Response(status=status)
+    return web.FileResponse(path, headers={'Content-Type': 'image/jpeg', 'Cache-Control': 'max-age=604800'})
+
+
+async def home_handler(request):
+    return web.Response(text=bot_app.home())
+
+
+async def healthz_handler(request):
+    return web.json_response({'status': 'ok'})
+
+
+async def readyz_handler(request):
+    ready, details = bot_app.readiness()
+    return web.json_response(details, status=200 if ready else 503)
+
+
+async def metrics_handler(request):
+    if not bot_app.metrics_authorized(request.headers.get('Authorization')):
+        return web.Response(status=403, text='Forbidden')
+    return web.Response(text=bot_app.metrics_text(), content_type='text/plain')
+
+
+async def orders_handler(request):
+    if not bot_app.orders_api_authorized(request.headers.get('Authorization')):
+        return web.json_response({'error': 'forbidden'}, status=403)
+    result, status = await asyncio.get_running_loop().run_in_executor(
+        request.app[ENGINE].executor, bot_app.query_orders, request.query,
+    )
+    return web.json_response(result, status=status)
+
+
+async def order_handler(request):
+    if not bot_app.orders_api_authorized(request.headers.get('Authorization')):
+        return web.json_response({'error': 'forbidden'}, status=403)
+    order = await asyncio.get_running_loop().run_in_executor(
+        request.app[ENGINE].executor, bot_app.order_store.get, request.match_info['order_id'],
+    )
+    if order is None:
+        return web.json_response({'error': 'not found'}, status=404)
+    return web.json_response(order)
+
+
+def create_web_app(engine):
+    web_app = web.Application()
+    web_app[ENGINE] = engine
+    web_app.router.add_get('/', home_handler)
+    web_app.router.add_post('/webhook', webhook_handler)
+    web_app.router.add_get('/photos/{unique_id}', photo_handler)
+    web_app.router.add_get('/healthz', healthz_handler)
+    web_app.router.add_get('/readyz', readyz_handler)
+    web_app.router.add_get('/metrics', metrics_handler)
+    web_app.router.add_get('/api/orders', orders_handler)
+    web_app.router.add_get('/api/orders/{order_id}', order_handler)
+    return web_app
+
+
+async def run_webhook(async_bot, engine, webhook_url, port):
+    await async_bot.remove_webhook()
+    await async_bot.set_webhook(url=f"{webhook_url}/webhook", secret_token=bot_app.WEBHOOK_SECRET)
+    logger.info(f"✅ Webhook установлен: {webhook_url}/webhook")
+
+    runner = web.AppRunner(create_web_app(engine))
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    logger.info(f"🚀 Асинхронный сервер запущен на порту {port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_polling(async_bot):
+    await async_bot.remove_webhook()
+    logger.info("🔧 Бот запущен в асинхронном режиме polling...")
+    await async_bot.infinity_polling()
+
+
+async def main():
+    engine = AsyncEngine()
+    async_bot = BridgeBot(bot_app.BOT_TOKEN, engine)
+    webhook_url = os.environ.get('WEBHOOK_URL')
+    try:
+        if webhook_url:
+            await run_webhook(async_bot, engine, webhook_url, int(os.environ.get('PORT', 5000)))
+        else:
+            await run_polling(async_bot)
+    finally:
+        await engine.drain()
+        await async_bot.close_session()
+        bot_app.update_dedup.persist()
+
+
+def run():
+    asyncio.run(main())
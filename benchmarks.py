@@ -0,0 +1,547 @@
+"""Микробенчмарки компонентов бота.
+
+Запуск: python benchmarks.py <имя> [параметры]
+Бенчмарки не импортируют app.py и не ходят в Telegram/Google.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+
+def report(title, samples):
+    """Печатает p50/p99/среднее по замерам в микросекундах"""
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2] * 1e6
+    p99 = samples[int(len(samples) * 0.99)] * 1e6
+    mean = statistics.fmean(samples) * 1e6
+    print(f"{title:<40} p50={p50:8.2f} мкс  p99={p99:8.2f} мкс  среднее={mean:8.2f} мкс")
+
+
+def sample_state(chat_id):
+    return {
+        'step': 'weight',
+        'name': f"Пользователь {chat_id}",
+        'phone': '+79991234567',
+        'destination': 'Москва',
+        'cargo': 'Запчасти для станков',
+        'website': 'Нет',
+        'photo': 'Не загружено',
+        'timestamp': '2024-01-01 12:00:00',
+        'user_id': chat_id,
+        'username': '@user',
+    }
+
+
+def bench_state(args):
+    from state_store import MemoryStateStore, SQLiteStateStore, create_state_store
+
+    stores = [('memory', MemoryStateStore(max_entries=args.dialogs * 2))]
+    tmpdir = tempfile.mkdtemp()
+    stores.append(('sqlite', SQLiteStateStore(os.path.join(tmpdir, 'states.db'))))
+    if args.redis_url:
+        stores.append(('redis', create_state_store(args.redis_url)))
+
+    for name, store in stores:
+        started = time.perf_counter()
+        for chat_id in range(args.dialogs):
+            store.set(chat_id, sample_state(chat_id))
+        print(f"{name}: заполнение {args.dialogs} диалогов за {time.perf_counter() - started:.2f} с")
+
+        get_samples, set_samples = [], []
+        for _ in range(args.ops):
+            chat_id = random.randrange(args.dialogs)
+            t0 = time.perf_counter()
+            state = store.get(chat_id)
+            t1 = time.perf_counter()
+            state['step'] = 'volume'
+            with store.lock(chat_id):
+                store.set(chat_id, state)
+            t2 = time.perf_counter()
+            get_samples.append(t1 - t0)
+            set_samples.append(t2 - t1)
+        report(f"{name}: get", get_samples)
+        report(f"{name}: lock+set", set_samples)
+        store.close()
+
+
+def legacy_dispatch(current_step, handlers):
+    """Прежняя цепочка if/elif из handle_all_messages"""
+    if current_step == 'start':
+        handlers['start']()
+    elif current_step == 'manager_contact':
+        handlers['manager_contact']()
+    elif current_step == 'name':
+        handlers['name']()
+    elif current_step == 'phone':
+        handlers['phone']()
+    elif current_step == 'destination':
+        handlers['destination']()
+    elif current_step == 'cargo':
+        handlers['cargo']()
+    elif current_step == 'website':
+        handlers['website']()
+    elif current_step == 'photo':
+        handlers['photo']()
+    elif current_step == 'weight':
+        handlers['weight']()
+    elif current_step == 'volume':
+        handlers['volume']()
+    elif current_step == 'delivery':
+        handlers['delivery']()
+    elif current_step == 'budget':
+        handlers['budget']()
+    elif current_step == 'comment':
+        handlers['comment']()
+    elif current_step == 'confirm':
+        handlers['confirm']()
+    elif current_step == 'correction':
+        handlers['correction']()
+
+
+def legacy_prev_step(current_step):
+    """Прежний поиск предыдущего шага в back_command"""
+    steps_order = ['name', 'phone', 'destination', 'cargo', 'website', 'photo', 'weight',
+                   'volume', 'delivery', 'budget', 'comment', 'confirm']
+    if current_step in steps_order:
+        current_index = steps_order.index(current_step)
+        if current_index > 0:
+            return steps_order[current_index - 1]
+    return None
+
+
+def bench_dispatch(args):
+    from dialog_steps import PREV_STEP, STEP_ORDER
+
+    steps = ['start', 'manager_contact'] + STEP_ORDER + ['correction']
+    handlers = {step: (lambda: None) for step in steps}
+    messages = [random.choice(steps) for _ in range(args.ops)]
+
+    def run(title, func):
+        samples = []
+        for step in messages:
+            t0 = time.perf_counter()
+            func(step)
+            samples.append(time.perf_counter() - t0)
+        report(title, samples)
+
+    run("dispatch: if/elif", lambda step: legacy_dispatch(step, handlers))
+    run("dispatch: таблица", lambda step: handlers.get(step, lambda: None)())
+    run("назад: list.index", legacy_prev_step)
+    run("назад: PREV_STEP", PREV_STEP.get)
+
+
+def bench_routing(args):
+    """Маршрутизация кнопок: перебор фильтров-лямбд против словаря"""
+    for buttons in (6, 25, 100, 400):
+        texts = [f"Кнопка {index}" for index in range(buttons)]
+        # Так TeleBot проверяет func=lambda message: message.text == ... по очереди
+        predicates = [(lambda text, expected=expected: text == expected) for expected in texts]
+        index = {text: position for position, text in enumerate(texts)}
+        # Половина сообщений — обычный текст анкеты, который не совпадает ни с одной кнопкой
+        messages = [random.choice(texts) if random.random() < 0.5 else "Москва" for _ in range(args.ops)]
+
+        def linear(text):
+            for position, predicate in enumerate(predicates):
+                if predicate(text):
+                    return position
+            return None
+
+        for title, func in ((f"{buttons} кнопок: перебор фильтров", linear),
+                            (f"{buttons} кнопок: словарь", index.get)):
+            samples = []
+            for text in messages:
+                t0 = time.perf_counter()
+                func(text)
+                samples.append(time.perf_counter() - t0)
+            report(title, samples)
+
+
+def bench_images(args):
+    """Обработка фото: изображений в секунду на ядро"""
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    from image_processing import Image, process_image, run
+
+    if Image is None:
+        print("Pillow не установлен — бенчмарк обработки фото пропущен")
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    sources = []
+    for index in range(args.images):
+        # Шум сжимается плохо и близок к реальным фото по нагрузке на кодек
+        image = Image.frombytes('RGB', (1280, 960), os.urandom(1280 * 960 * 3))
+        path = os.path.join(tmpdir, f"source_{index}.jpg")
+        image.save(path, 'JPEG', quality=95)
+        sources.append(path)
+
+    def jobs():
+        for index, path in enumerate(sources):
+            yield path, os.path.join(tmpdir, f"thumb_{index}.jpg"), os.path.join(tmpdir, f"archive_{index}.jpg")
+
+    started = time.perf_counter()
+    for job in jobs():
+        process_image(*job)
+    elapsed = time.perf_counter() - started
+    print(f"1 процесс: {len(sources) / elapsed:.1f} изобр./с на ядро")
+
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        started = time.perf_counter()
+        list(pool.map(process_image, *zip(*jobs())))
+        elapsed = time.perf_counter() - started
+    rate = len(sources) / elapsed
+    print(f"{workers} процессов: {rate:.1f} изобр./с, {rate / workers:.1f} изобр./с на ядро")
+
+    # Как в боте: отдельный процесс на каждое фото, не больше workers одновременно
+    with ThreadPoolExecutor(workers) as pool:
+        started = time.perf_counter()
+        list(pool.map(run, *zip(*jobs())))
+        elapsed = time.perf_counter() - started
+    rate = len(sources) / elapsed
+    print(f"{workers} процессов на фото: {rate:.1f} изобр./с, {rate / workers:.1f} изобр./с на ядро")
+
+
+def bench_startup(args):
+    """Холодный старт: последовательные рукопожатия против фоновых параллельных"""
+    import subprocess
+    import sys
+
+    from startup import Startup
+
+    # Задержки имитируют сетевые вызовы при запуске: get_me, авторизация
+    # gspread, открытие таблицы, чтение метаданных листа
+    handshakes = {
+        'telegram': [args.latency],
+        'google_sheets': [args.latency] * 3,
+    }
+
+    def handshake(delays):
+        return lambda: [time.sleep(delay) for delay in delays]
+
+    started = time.perf_counter()
+    for delays in handshakes.values():
+        handshake(delays)()
+    serial = time.perf_counter() - started
+
+    started = time.perf_counter()
+    startup = Startup()
+    for name, delays in handshakes.items():
+        startup.add(name, handshake(delays))
+    first_update = time.perf_counter() - started
+    startup.wait()
+    ready = time.perf_counter() - started
+
+    print(f"последовательно: первое обновление через {serial * 1000:.0f} мс")
+    print(f"в фоне: первое обновление через {first_update * 1000:.1f} мс, "
+          f"все подключения готовы через {ready * 1000:.0f} мс")
+
+    if args.import_app:
+        # Реальный импорт app.py в отдельном процессе (нужны зависимости и переменные окружения)
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', 'import app'], capture_output=True)
+        elapsed = time.perf_counter() - started
+        status = "ok" if result.returncode == 0 else f"ошибка {result.returncode}"
+        print(f"импорт app.py: {elapsed * 1000:.0f} мс ({status})")
+
+
+class MockBotAPI:
+    """Локальный сервер, отвечающий как Bot API и применяющий лимиты Telegram"""
+
+    def __init__(self, latency):
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs, urlsplit
+
+        from ratelimit import RateLimiter
+
+        chats = RateLimiter(1.0, 3)
+        total = RateLimiter(30.0, 30, max_keys=1)
+        self.sent = 0
+        self.limited = 0
+        lock = threading.Lock()
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                # telebot передаёт параметры в строке запроса
+                params = parse_qs(urlsplit(self.path).query)
+                params.update(parse_qs(self.rfile.read(length).decode()))
+                chat_id = int(params['chat_id'][0])
+                time.sleep(latency)
+                if not chats.try_acquire(chat_id) or not total.try_acquire(None):
+                    with lock:
+                        mock.limited += 1
+                    self._reply(429, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 1},
+                                      'description': 'Too Many Requests: retry after 1'})
+                    return
+                with lock:
+                    mock.sent += 1
+                    message_id = mock.sent
+                self._reply(200, {'ok': True, 'result': {
+                    'message_id': message_id, 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', [''])[0],
+                }})
+
+            do_GET = do_POST
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/bot{{0}}/{{1}}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def bench_send(args):
+    """Рассылка при одновременном подтверждении заявок: напрямую и через планировщик"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    import telebot
+    from telebot import apihelper
+
+    from send_scheduler import NOTIFY, REPLY, SendScheduler
+
+    managers = [1000 + index for index in range(args.managers)]
+    # На каждую заявку: ответ пользователю и уведомление каждому менеджеру
+    messages = []
+    for order in range(args.orders):
+        messages.append((REPLY, order + 1))
+        messages.extend((NOTIFY, manager) for manager in managers)
+
+    for title, use_scheduler in (("напрямую", False), ("планировщик", True)):
+        mock = MockBotAPI(args.api_latency)
+        apihelper.API_URL = mock.url
+        bot = telebot.TeleBot('123:bench', threaded=False)
+        latencies = {REPLY: [], NOTIFY: []}
+        errors = 0
+
+        def send(priority, chat_id, started):
+            bot.send_message(chat_id, "Бенчмарк")
+            latencies[priority].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        if use_scheduler:
+            scheduler = SendScheduler(workers=8).start()
+            futures = [scheduler.submit(chat_id, send, priority, chat_id, started, priority=priority)
+                       for priority, chat_id in messages]
+        else:
+            pool = ThreadPoolExecutor(16)
+            futures = [pool.submit(send, priority, chat_id, started) for priority, chat_id in messages]
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                errors += 1
+        elapsed = time.perf_counter() - started
+        if use_scheduler:
+            scheduler.stop()
+        else:
+            pool.shutdown()
+        mock.close()
+
+        print(f"{title}: {len(messages)} сообщений за {elapsed:.2f} с, доставлено {mock.sent}, "
+              f"ответов 429: {mock.limited}, потеряно: {errors}")
+        for priority, name in ((REPLY, "ответы пользователям"), (NOTIFY, "уведомления менеджерам")):
+            if latencies[priority]:
+                report(f"  {name}", latencies[priority])
+
+
+def bench_orders(args):
+    """Поиск по локальному индексу заявок"""
+    from order_store import OrderStore
+
+    cities = ["Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", "Казань",
+              "Нижний Новгород", "Челябинск", "Самара", "Омск", "Ростов-на-Дону"]
+    statuses = ["Новая заявка", "В работе", "Выполнена", "Отменена"]
+    users = max(1, args.rows // 5)
+    store = OrderStore(os.path.join(tempfile.mkdtemp(), 'orders.db'))
+
+    started = time.perf_counter()
+    batch = []
+    for index in range(args.rows):
+        user_id = random.randrange(users)
+        order = sample_state(user_id)
+        order.update({
+            'order_id': f"{user_id}-{index}",
+            'phone': f"+7999{user_id:07d}",
+            'destination': random.choice(cities),
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1.6e9 + index * 30)),
+        })
+        batch.append(order)
+        if len(batch) == 10000:
+            store.save_many(batch, random.choice(statuses))
+            batch = []
+    if batch:
+        store.save_many(batch)
+    print(f"заполнение {args.rows} заявок за {time.perf_counter() - started:.1f} с")
+
+    queries = {
+        "по user_id": lambda: store.search(user_id=random.randrange(users)),
+        "по телефону": lambda: store.search(phone=f"8 999 {random.randrange(users):07d}"),
+        "по городу": lambda: store.search(destination=random.choice(cities).upper()),
+        "по статусу": lambda: store.search(status=random.choice(statuses)),
+        "по дате": lambda: store.search(since="2021-01-01", until="2021-01-31"),
+        "город + статус": lambda: store.search(destination=random.choice(cities), status="В работе"),
+    }
+    for title, query in queries.items():
+        samples = []
+        for _ in range(min(args.ops, 2000)):
+            t0 = time.perf_counter()
+            query()
+            samples.append(time.perf_counter() - t0)
+        report(f"заявки: {title}", samples)
+    store.close()
+
+
+def legacy_save_to_file(filename, data):
+    """Прежний формат заявок: текстовый блок, файл открывается на каждую запись"""
+    with open(filename, 'a', encoding='utf-8') as f:
+        f.write("=" * 50 + "\n")
+        f.write(f"Дата: {data['timestamp']}\n")
+        f.write(f"ID заявки: {data.get('order_id', '')}\n")
+        f.write(f"ID: {data.get('user_id', '')}\n")
+        f.write(f"Username: {data.get('username', '')}\n")
+        f.write(f"Имя: {data.get('name', '')}\n")
+        f.write(f"Телефон: {data.get('phone', '')}\n")
+        f.write(f"Город назначения: {data.get('destination', '')}\n")
+        f.write(f"Груз: {data.get('cargo', '')}\n")
+        f.write(f"Ссылка: {data.get('website', '')}\n")
+        f.write(f"Фото: {data.get('photo', '')}\n")
+        f.write(f"Вес: {data.get('weight', '')} кг\n")
+        f.write(f"Объем: {data.get('volume', '')} м³\n")
+        f.write(f"Способ доставки: {data.get('delivery', '')}\n")
+        f.write(f"Бюджет: {data.get('budget', '')}\n")
+        f.write(f"Комментарии: {data.get('comment', '')}\n")
+        f.write("=" * 50 + "\n\n")
+
+
+def bench_journal(args):
+    """Запись и чтение запасного журнала против прежнего текстового файла"""
+    from journal import JournalWriter, compress_segment, read_records, segments
+
+    orders = []
+    for index in range(args.records):
+        order = sample_state(index)
+        order.update({'order_id': f"{index}-{index}", 'weight': '120', 'volume': '0.8',
+                      'delivery': 'Авто', 'budget': '5000 $', 'comment': 'Нет'})
+        orders.append(order)
+    tmpdir = tempfile.mkdtemp()
+
+    legacy = os.path.join(tmpdir, 'заявки.txt')
+    samples = []
+    started = time.perf_counter()
+    for order in orders:
+        t0 = time.perf_counter()
+        legacy_save_to_file(legacy, order)
+        samples.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    report("журнал: текстовый файл, запись", samples)
+    print(f"   {args.records / elapsed:,.0f} записей/с, {os.path.getsize(legacy) / 1e6:.1f} МБ")
+
+    directory = os.path.join(tmpdir, 'journal')
+    writer = JournalWriter(directory, max_bytes=16 * 1024 * 1024, compress=False)
+    samples = []
+    started = time.perf_counter()
+    for order in orders:
+        t0 = time.perf_counter()
+        writer.append('order', order['order_id'], order, row=list(order.values()))
+        samples.append(time.perf_counter() - t0)
+    writer.close()
+    elapsed = time.perf_counter() - started
+    size = sum(os.path.getsize(path) for path in segments(directory))
+    report("журнал: JSONL, запись", samples)
+    print(f"   {args.records / elapsed:,.0f} записей/с, {size / 1e6:.1f} МБ в {len(segments(directory))} сегментах")
+
+    for title, kind in (("все записи", None), ("фильтр по виду", 'help')):
+        started = time.perf_counter()
+        count = sum(1 for _ in read_records(directory, kind=kind))
+        elapsed = time.perf_counter() - started
+        print(f"журнал: чтение JSONL, {title}: {count} записей, {args.records / elapsed:,.0f} записей/с")
+
+    started = time.perf_counter()
+    for path in segments(directory):
+        compress_segment(path)
+    compressed = sum(os.path.getsize(path) for path in segments(directory))
+    print(f"журнал: сжатие gzip за {time.perf_counter() - started:.2f} с, {size / 1e6:.1f} -> {compressed / 1e6:.1f} МБ")
+    started = time.perf_counter()
+    count = sum(1 for _ in read_records(directory))
+    print(f"журнал: чтение .jsonl.gz: {count} записей, {count / (time.perf_counter() - started):,.0f} записей/с")
+
+
+def bench_validation(args):
+    """Разбор ответов анкеты: телефон, вес, объём, бюджет"""
+    from validation import validate
+
+    corpus = {
+        'phone': ['+7 999 123-45-67', '8 (999) 123 45 67', '89991234567', '9991234567',
+                  '+86 138 0013 8000', '13800138000', '0086 138 0013 8000', 'позвоните мне'],
+        'weight': ['120', '120 кг', '1,5 т', 'около 5 тонн', '500 г', '5-7 т', 'не знаю', 'тяжёлый'],
+        'volume': ['0.8', '0,8 м³', '2 куба', '500 л', '120х80х100 см', '1.2 x 0.8 x 1 м',
+                   'примерно 3 м3', '10 куб. м', 'не знаю'],
+        'budget': ['50000', '50 000 ₽', '50 тыс. руб', '3000 $', '$3000', '20 000 юаней',
+                   '1,5 млн', '5 т.р.', '5 m', 'сколько скажете'],
+    }
+    rejected = 0
+    for name, texts in corpus.items():
+        samples = []
+        for index in range(args.ops):
+            text = texts[index % len(texts)]
+            t0 = time.perf_counter()
+            result = validate(name, text)
+            samples.append(time.perf_counter() - t0)
+            rejected += result is None
+        report(f"разбор: {name}", samples)
+    print(f"   не распознано: {rejected / (args.ops * len(corpus)):.0%} ответов")
+
+
+BENCHMARKS = {
+    'state': bench_state,
+    'dispatch': bench_dispatch,
+    'routing': bench_routing,
+    'images': bench_images,
+    'startup': bench_startup,
+    'send': bench_send,
+    'orders': bench_orders,
+    'journal': bench_journal,
+    'validation': bench_validation,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('--dialogs', type=int, default=100000, help="число активных диалогов")
+    parser.add_argument('--ops', type=int, default=20000, help="число замеров")
+    parser.add_argument('--images', type=int, default=200, help="число фото для обработки")
+    parser.add_argument('--latency', type=float, default=0.3, help="задержка одного сетевого вызова, с")
+    parser.add_argument('--import-app', action='store_true', help="замерить реальный импорт app.py")
+    parser.add_argument('--orders', type=int, default=50, help="одновременно подтверждённых заявок")
+    parser.add_argument('--managers', type=int, default=2, help="число менеджеров")
+    parser.add_argument('--api-latency', type=float, default=0.05, help="задержка ответа Bot API, с")
+    parser.add_argument('--rows', type=int, default=1000000, help="число заявок в индексе")
+    parser.add_argument('--records', type=int, default=100000, help="число записей журнала")
+    parser.add_argument('--redis-url', default=os.environ.get('BENCH_REDIS_URL'),
+                        help="redis://host:port/db для проверки Redis-хранилища")
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator:
+    """Отсеивает повторные доставки обновлений Telegram по update_id.
+
+    Последние capacity идентификаторов хранятся в кольцевом буфере.
+    Максимальный обработанный update_id (high-water mark) периодически
+    сохраняется на диск, чтобы после перезапуска не обработать заново то,
+    что Telegram доставит повторно. Обновления, которые не удалось принять
+    (forget), отметку на диске не пропускает: сохраняется значение ниже
+    самого старого из них, и после перезапуска они обрабатываются.
+    """
+
+    # Если обновлений не было неделю, Telegram выбирает следующий update_id
+    # случайно — старая отметка тогда бесполезна и даже вредна
+    HWM_MAX_AGE = 6 * 24 * 3600
+
+    def __init__(self, capacity=10000, state_path='update_hwm.json', persist_interval=5.0):
+        self.capacity = capacity
+        self.state_path = state_path
+        self.persist_interval = persist_interval
+        self._recent = deque()
+        self._recent_set = set()
+        # Снятые отметки: Telegram доставит эти обновления снова
+        self._forgotten = set()
+        self._lock = threading.Lock()
+        self._last_persist = 0.0
+        # Всё, что не выше отметки с прошлого запуска, уже было обработано
+        self._startup_hwm = self._load()
+        self._persisted_hwm = self._startup_hwm
+        self.high_water_mark = self._startup_hwm
+
+    def _load(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+            if time.time() - state.get('saved_at', 0) > self.HWM_MAX_AGE:
+                return 0
+            return int(state['high_water_mark'])
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прочитать {self.state_path}: {e}")
+            return 0
+
+    def _persistable_hwm(self):
+        floor = self.high_water_mark - self.capacity
+        pending = [update_id for update_id in self._forgotten if update_id > floor]
+        if pending:
+            return min(self.high_water_mark, min(pending) - 1)
+        return self.high_water_mark
+
+    def persist(self):
+        with self._lock:
+            hwm = self._persistable_hwm()
+            if hwm == self._persisted_hwm:
+                return
+            self._persisted_hwm = hwm
+            self._last_persist = time.monotonic()
+        tmp_path = f"{self.state_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'high_water_mark': hwm, 'saved_at': time.time()}, f)
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить {self.state_path}: {e}")
+
+    def _is_duplicate(self, update_id):
+        if update_id in self._recent_set:
+            return True
+        if update_id in self._forgotten:
+            return False
+        # До перезапуска уже обработали, либо слишком старое, чтобы помнить
+        if update_id <= self._startup_hwm:
+            return True
+        return update_id <= self.high_water_mark - self.capacity
+
+    def seen(self, update_id):
+        """Проверка без отметки"""
+        with self._lock:
+            return self._is_duplicate(update_id)
+
+    def check(self, update_id):
+        """Отмечает update_id. Возвращает False для повторной доставки"""
+        with self._lock:
+            if self._is_duplicate(update_id):
+                duplicate = True
+            else:
+                duplicate = False
+                self._recent.append(update_id)
+                self._recent_set.add(update_id)
+                self._forgotten.discard(update_id)
+                if len(self._recent) > self.capacity:
+                    self._recent_set.discard(self._recent.popleft())
+                if update_id > self.high_water_mark:
+                    self.high_water_mark = update_id
+            persist_due = time.monotonic() - self._last_persist > self.persist_interval
+
+        if duplicate:
+            metrics.inc('updates_duplicate_total')
+            return False
+        metrics.inc('updates_received_total')
+        if persist_due:
+            self.persist()
+        return True
+
+    def forget(self, update_id):
+        """Снимает отметку, если обновление не удалось принять в обработку"""
+        with self._lock:
+            if update_id in self._recent_set:
+                self._recent_set.discard(update_id)
+                self._recent.remove(update_id)
+            self._forgotten.add(update_id)
+            if len(self._forgotten) > self.capacity:
+                # Слишком старые снятые отметки больше не держат отметку на диске
+                floor = self.high_water_mark - self.capacity
+                self._forgotten = {x for x in self._forgotten if x > floor}
+
+    def filter(self, updates):
+        return [update for update in updates if self.check(update.update_id)]
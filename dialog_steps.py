@@ -0,0 +1,48 @@
+"""Таблица шагов анкеты заявки.
+
+Каждый шаг описывает поле состояния, вопрос пользователю, клавиатуру и
+кнопку в меню исправления. Переходы вперёд/назад и выбор поля для
+исправления собираются из таблицы один раз при импорте в словари,
+поэтому обработка сообщения не зависит от числа шагов.
+
+Ответ на шаг с validator разбирается функцией из validation.py; если
+разобрать не удалось, пользователь получает подсказку invalid.
+"""
+
+FORM_STEPS = [
+    {'step': 'name', 'field': 'name', 'prompt': "Введите ваше имя:",
+     'keyboard': 'standard', 'button': "👤 Имя"},
+    {'step': 'phone', 'field': 'phone', 'prompt': "📞 Ваш номер телефона:",
+     'keyboard': 'phone', 'button': "📞 Телефон", 'validator': 'phone',
+     'invalid': "⚠️ Не удалось распознать номер. Введите его цифрами, например: +7 999 123-45-67"},
+    {'step': 'destination', 'field': 'destination', 'prompt': "🏙️ Город назначения (Россия):",
+     'keyboard': 'standard', 'button': "🏙️ Город"},
+    {'step': 'cargo', 'field': 'cargo', 'prompt': "📦 Описание груза:",
+     'keyboard': 'standard', 'button': "📦 Груз"},
+    {'step': 'website', 'field': 'website', 'prompt': "🔗 Ссылка на сайт (или 'Нет'):",
+     'keyboard': 'standard', 'button': "🔗 Ссылка"},
+    {'step': 'photo', 'field': 'photo', 'prompt': "🖼️ Фото груза (или 'Пропустить фото'):",
+     'keyboard': 'skip_photo', 'button': "🖼️ Фото"},
+    {'step': 'weight', 'field': 'weight', 'prompt': "⚖️ Вес груза (кг):",
+     'keyboard': 'standard', 'button': "⚖️ Вес", 'validator': 'weight',
+     'invalid': "⚠️ Укажите вес числом, например: 120, 1,5 т или 500 г (или «Не знаю»)"},
+    {'step': 'volume', 'field': 'volume', 'prompt': "📏 Объем груза (м³):",
+     'keyboard': 'standard', 'button': "📏 Объем", 'validator': 'volume',
+     'invalid': "⚠️ Укажите объём числом или габаритами, например: 0,8 м³, 500 л или 120х80х100 см (или «Не знаю»)"},
+    {'step': 'delivery', 'field': 'delivery', 'prompt': "🚚 Способ доставки:",
+     'keyboard': 'delivery', 'button': "🚚 Доставка"},
+    {'step': 'budget', 'field': 'budget', 'prompt': "💰 Бюджет:",
+     'keyboard': 'standard', 'button': "💰 Бюджет", 'validator': 'budget',
+     'invalid': "⚠️ Укажите бюджет числом и валютой, например: 50 000 ₽, 50 тыс. руб., 3000 $ или 20 000 ¥ (или «Не знаю»)"},
+    {'step': 'comment', 'field': 'comment', 'prompt': "💬 Комментарии (или 'Нет'):",
+     'keyboard': 'standard', 'button': "💬 Комментарий"},
+]
+
+# Шаг подтверждения идёт сразу после последнего поля анкеты
+CONFIRM_STEP = 'confirm'
+
+STEPS = {step['step']: step for step in FORM_STEPS}
+STEP_ORDER = [step['step'] for step in FORM_STEPS] + [CONFIRM_STEP]
+NEXT_STEP = dict(zip(STEP_ORDER, STEP_ORDER[1:]))
+PREV_STEP = {next_step: step for step, next_step in NEXT_STEP.items()}
+CORRECTION_STEPS = {step['button']: step['step'] for step in FORM_STEPS}
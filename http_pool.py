@@ -0,0 +1,97 @@
+"""Общие HTTP-сессии для клиентов Telegram и Google Sheets.
+
+Каждому клиенту — одна requests.Session на все потоки с пулом соединений,
+размер которого соответствует числу рабочих потоков. Соединения
+переиспользуются (keep-alive), поэтому TLS-рукопожатие выполняется один
+раз на соединение, а не на запрос. Для каждого клиента считаются запросы и
+новые соединения — из них получается доля переиспользования.
+"""
+import socket
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from metrics import metrics
+
+# TCP keep-alive не даёт NAT и балансировщикам молча закрыть простаивающее соединение
+SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, 'TCP_KEEPIDLE'):
+    SOCKET_OPTIONS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 20),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3),
+    ]
+
+_clients = set()
+
+
+def _counting_pools(name):
+    """Классы пулов urllib3, которые считают запросы и новые соединения"""
+    opened = metrics.counter('http_connections_opened_total', client=name)
+    sent = metrics.counter('http_requests_total', client=name)
+
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        def _new_conn(self):
+            opened.inc()
+            return super()._new_conn()
+
+        def urlopen(self, *args, **kwargs):
+            sent.inc()
+            return super().urlopen(*args, **kwargs)
+
+    class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+        def _new_conn(self):
+            opened.inc()
+            return super()._new_conn()
+
+        def urlopen(self, *args, **kwargs):
+            sent.inc()
+            return super().urlopen(*args, **kwargs)
+
+    return {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter с подсчётом соединений и TCP keep-alive"""
+
+    def __init__(self, name, pool_size, retries):
+        self.name = name
+        self._pool_classes = _counting_pools(name)
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, max_retries=retries)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault('socket_options', SOCKET_OPTIONS)
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = self._pool_classes
+
+
+def connect_retries():
+    """Повтор только ошибок соединения: запрос ещё не ушёл, повтор безопасен"""
+    return Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.3,
+                 allowed_methods=None, raise_on_status=False)
+
+
+def mount(session, name, pool_size):
+    """Подключает к сессии пул соединений клиента name"""
+    adapter = PooledAdapter(name, pool_size, connect_retries())
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    _clients.add(name)
+    return session
+
+
+def create_session(name, pool_size):
+    return mount(requests.Session(), name, pool_size)
+
+
+def stats():
+    """{клиент: (запросов, новых соединений, доля переиспользования)}"""
+    result = {}
+    for name in sorted(_clients):
+        sent = metrics.get('http_requests_total', client=name)
+        opened = metrics.get('http_connections_opened_total', client=name)
+        result[name] = (sent, opened, 1 - opened / sent if sent else 0.0)
+    return result
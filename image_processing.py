@@ -0,0 +1,60 @@
+"""Обработка фото заявок: миниатюра и пережатая архивная копия.
+
+Бот запускает обработку каждого фото отдельным процессом:
+    python image_processing.py <исходный файл> <миниатюра> <архивная копия>
+Это чистый интерпретатор: он не наследует потоки и замки бота (как при
+fork) и не выполняет заново главный скрипт бота (как multiprocessing в
+режиме spawn — app.py и start_bot.py запускают фоновые службы при
+импорте). Модуль не импортирует ничего, кроме Pillow.
+"""
+import os
+import subprocess
+import sys
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не обязателен: без него фото хранятся как есть
+    Image = None
+
+THUMB_SIZE = 320
+ARCHIVE_MAX_SIDE = 2048
+ARCHIVE_QUALITY = 80
+PROCESS_TIMEOUT = 60
+
+
+def process_image(source, thumb_path, archive_path, thumb_size=THUMB_SIZE, max_side=ARCHIVE_MAX_SIDE,
+                  quality=ARCHIVE_QUALITY):
+    """Создаёт миниатюру и пережатую архивную копию фото.
+
+    Возвращает размеры исходного файла, архивной копии и миниатюры в байтах.
+    """
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        archive = image.copy()
+        archive.thumbnail((max_side, max_side))
+        archive.save(archive_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+        image.thumbnail((thumb_size, thumb_size))
+        image.save(thumb_path, 'JPEG', quality=70, optimize=True)
+    return os.path.getsize(source), os.path.getsize(archive_path), os.path.getsize(thumb_path)
+
+
+def run(source, thumb_path, archive_path, timeout=PROCESS_TIMEOUT):
+    """Выполняет process_image в отдельном процессе. Возвращает те же размеры"""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), source, thumb_path, archive_path],
+        capture_output=True, text=True, timeout=timeout,
+    )
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()
+        raise RuntimeError(error[-1] if error else f"код завершения {result.returncode}")
+    original, archived, thumb = (int(value) for value in result.stdout.split())
+    return original, archived, thumb
+
+
+def main(argv=None):
+    source, thumb_path, archive_path = sys.argv[1:] if argv is None else argv
+    print(*process_image(source, thumb_path, archive_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""Запасной журнал заявок и уведомлений в формате JSON Lines.
+
+Записи, которые не удалось отправить в таблицу или менеджерам, пишутся
+одной строкой JSON на запись:
+    {"ts": "2024-05-01 12:00:00", "kind": "order", "key": "...", "data": {...}, "row": [...]}
+Журнал разбит на сегменты journal-<время создания>.jsonl. Сегмент
+закрывается, когда превышает max_bytes или живёт дольше max_age, после
+чего сжимается gzip в фоне. Запись буферизуется и сбрасывается на диск
+не реже раза в flush_interval секунд.
+
+Открытый сегмент заблокирован (flock) процессом, который в него пишет:
+сжимаются только сегменты, которые никто не держит.
+
+Чтение и повторный импорт в таблицу:
+    python journal.py cat --kind order --since 2024-05-01
+    python journal.py stats
+    python journal.py import --kind order
+Импорт открывает таблицу сам (GOOGLE_CREDENTIALS_JSON или --credentials,
+SPREADSHEET_ID или --spreadsheet) и не импортирует app.py, поэтому его
+можно запускать рядом с работающим ботом.
+"""
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+from metrics import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: блокировок нет, сегменты после перезапуска не сжимаются
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = '.jsonl'
+GZIP_SUFFIX = '.jsonl.gz'
+
+
+def now_text():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class JournalWriter:
+    """Буферизованная запись журнала с ротацией сегментов"""
+
+    def __init__(self, directory='journal', prefix='journal', max_bytes=64 * 1024 * 1024, max_age=24 * 3600,
+                 flush_interval=1.0, compress=True, buffer_size=1024 * 1024):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.buffer_size = buffer_size
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._opened_at = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self.records = 0
+        self._written = metrics.counter('journal_records_total')
+
+        # Сегменты, не сжатые до перезапуска, сжимаем сразу. Сегмент, который
+        # держит другой процесс, compress_segment пропустит
+        if compress and fcntl is not None:
+            for path in segments(directory, prefix):
+                if path.endswith(SUFFIX):
+                    self._compress_later(path)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="journal-flush", daemon=True)
+            self._thread.start()
+        return self
+
+    def append(self, kind, key, data, **extra):
+        """Добавляет запись. Поля extra попадают в запись как есть"""
+        record = {'ts': now_text(), 'kind': kind, 'key': key, 'data': data}
+        record.update(extra)
+        line = (json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None or self._should_rotate(len(line)):
+                self._rotate()
+            self._file.write(line)
+            self._size += len(line)
+            self.records += 1
+        self._written.inc()
+
+    def _should_rotate(self, incoming):
+        # Пустой сегмент не закрываем: он ничем не отличается от нового
+        return self._size and (self._size + incoming > self.max_bytes
+                               or time.monotonic() - self._opened_at >= self.max_age)
+
+    def _rotate(self):
+        """Закрывает текущий сегмент и открывает новый (под self._lock)"""
+        closed = self._close_segment()
+        while True:
+            name = f"{self.prefix}-{datetime.datetime.now():%Y%m%d-%H%M%S%f}{SUFFIX}"
+            self._path = os.path.join(self.directory, name)
+            self._file = open(self._path, 'ab', buffering=self.buffer_size)
+            if lock_file(self._file):
+                break
+            # Новый файл успел захватить сжатие из другого процесса: берём другое имя
+            self._file.close()
+        self._size = 0
+        self._opened_at = time.monotonic()
+        if closed and self.compress:
+            self._compress_later(closed)
+
+    def _close_segment(self):
+        if self._file is None:
+            return None
+        self._file.close()
+        self._file = None
+        return self._path
+
+    def _compress_later(self, path):
+        threading.Thread(target=compress_segment, args=(path,), name="journal-gzip", daemon=True).start()
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                if self._size and time.monotonic() - self._opened_at >= self.max_age:
+                    self._rotate()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка сброса журнала на диск: {e}")
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            self._close_segment()
+
+
+def lock_file(f):
+    """Неблокирующая эксклюзивная блокировка файла; снимается при закрытии"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def compress_segment(path):
+    """Сжимает закрытый сегмент: .jsonl -> .jsonl.gz
+
+    Сегмент, открытый на запись (заблокированный), не трогается.
+    """
+    target = path[:-len(SUFFIX)] + GZIP_SUFFIX
+    try:
+        with open(path, 'rb') as source:
+            if not lock_file(source):
+                return
+            with gzip.open(target + '.tmp', 'wb', compresslevel=6) as destination:
+                shutil.copyfileobj(source, destination, 1024 * 1024)
+            os.replace(target + '.tmp', target)
+            os.remove(path)
+    except Exception as e:
+        logger.error(f"❌ Ошибка сжатия сегмента журнала {path}: {e}")
+
+
+def segments(directory, prefix='journal'):
+    """Сегменты журнала по порядку записи; при наличии сжатой копии берётся она"""
+    if not os.path.isdir(directory):
+        return []
+    found = {}
+    for name in os.listdir(directory):
+        if not name.startswith(prefix + '-'):
+            continue
+        if name.endswith(GZIP_SUFFIX):
+            found[name[:-len(GZIP_SUFFIX)]] = name
+        elif name.endswith(SUFFIX):
+            found.setdefault(name[:-len(SUFFIX)], name)
+    return [os.path.join(directory, found[base]) for base in sorted(found)]
+
+
+def read_records(directory='journal', kind=None, key=None, since=None, until=None, prefix='journal'):
+    """Потоково читает записи журнала с фильтрами
+
+    since/until — границы времени записи ('YYYY-MM-DD[ HH:MM:SS]').
+    Строка, оборванная сбоем посреди записи, пропускается.
+    """
+    if until and len(until) <= 10:
+        until += " 23:59:59"
+    # Записи пишутся без пробелов, поэтому по виду можно отсеять строку до разбора JSON
+    marker = f'"kind":{json.dumps(kind, ensure_ascii=False)}' if kind else None
+    for path in segments(directory, prefix):
+        opener = gzip.open if path.endswith(GZIP_SUFFIX) else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if marker and marker not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if kind and record.get('kind') != kind:
+                    continue
+                if key and record.get('key') != key:
+                    continue
+                if since and record.get('ts', '') < since:
+                    continue
+                if until and record.get('ts', '') > until:
+                    continue
+                yield record
+
+
+def reimport(records, sheets, batch_size=500, dry_run=False):
+    """Дописывает в таблицу строки заявок из журнала, которых там ещё нет
+
+    sheets — WorksheetRegistry. ID уже записанных заявок берутся из столбца P
+    всех листов таблицы. Возвращает (прочитано, дописано).
+    """
+    existing = set()
+    for worksheet in sheets.spreadsheet.worksheets():
+        existing.update(worksheet.col_values(16))
+    seen, batch = 0, []
+    imported = 0
+    for record in records:
+        seen += 1
+        row = record.get('row')
+        if not row or record.get('key') in existing:
+            continue
+        existing.add(record.get('key'))
+        batch.append(row)
+        if len(batch) >= batch_size:
+            imported += len(batch)
+            if not dry_run:
+                sheets.append_rows(batch, value_input_option='RAW')
+            batch = []
+    if batch:
+        imported += len(batch)
+        if not dry_run:
+            sheets.append_rows(batch, value_input_option='RAW')
+    return seen, imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Чтение и повторный импорт запасного журнала")
+    parser.add_argument('command', choices=['cat', 'stats', 'import'])
+    parser.add_argument('--dir', default=os.environ.get('JOURNAL_DIR', 'journal'))
+    parser.add_argument('--kind', help="order, help или notification")
+    parser.add_argument('--key', help="ID заявки")
+    parser.add_argument('--since')
+    parser.add_argument('--until')
+    parser.add_argument('--dry-run', action='store_true', help="import: только посчитать строки")
+    parser.add_argument('--credentials', help="import: файл JSON-ключа сервисного аккаунта")
+    parser.add_argument('--spreadsheet', default=os.environ.get('SPREADSHEET_ID'), help="import: ID таблицы")
+    parser.add_argument('--rollover', default=os.environ.get('SHEET_ROLLOVER', 'off'))
+    parser.add_argument('--prefix', default=os.environ.get('SHEET_PREFIX', 'Заявки'))
+    parser.add_argument('--max-rows', type=int, default=int(os.environ.get('SHEET_MAX_ROWS', 50000)))
+    args = parser.parse_args(argv)
+
+    records = read_records(args.dir, kind=args.kind, key=args.key, since=args.since, until=args.until)
+    if args.command == 'cat':
+        for record in records:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
+    elif args.command == 'stats':
+        counts = {}
+        for record in records:
+            counts[record.get('kind')] = counts.get(record.get('kind'), 0) + 1
+        for kind, count in sorted(counts.items(), key=lambda item: str(item[0])):
+            print(f"{kind}: {count}")
+    else:
+        # Таблица открывается напрямую: импорт app.py запустил бы фоновые службы бота
+        from sheet_registry import ORDER_HEADERS, WorksheetRegistry, authorize
+        if args.credentials:
+            with open(args.credentials, encoding='utf-8') as f:
+                credentials_json = f.read()
+        else:
+            credentials_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
+        if not credentials_json or not args.spreadsheet:
+            parser.error("import: нужны GOOGLE_CREDENTIALS_JSON (или --credentials) и SPREADSHEET_ID (или --spreadsheet)")
+        sheets = WorksheetRegistry(authorize(credentials_json).open_by_key(args.spreadsheet), ORDER_HEADERS,
+                                   mode=args.rollover, prefix=args.prefix, max_rows=args.max_rows)
+        seen, imported = reimport(records, sheets, dry_run=args.dry_run)
+        print(f"Прочитано записей: {seen}, {'к импорту' if args.dry_run else 'дописано в таблицу'}: {imported}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Реестр клавиатур бота.
+
+Клавиатуры описаны данными и собираются один раз: в reply_markup уходит уже
+готовая JSON-строка, поэтому на каждое сообщение не создаются объекты
+KeyboardButton и не выполняется сериализация. Варианты клавиатур с
+параметрами (например, локализованные подписи) кэшируются в ограниченном LRU.
+"""
+from functools import lru_cache
+
+from telebot import types
+
+BACK = "⬅️ Назад"
+MANAGER = "👨‍💼 Связаться с менеджером"
+MAIN = "🏠 В начало"
+NAVIGATION = (BACK, MANAGER, MAIN)
+
+# Описание: (row_width, группы кнопок). Каждая группа добавляется одним
+# вызовом keyboard.add(...), как в исходных функциях клавиатур.
+# Кнопка — строка или словарь параметров KeyboardButton.
+LAYOUTS = {
+    'phone': (1, [
+        [{'text': "📞 Отправить номер", 'request_contact': True}],
+        NAVIGATION,
+    ]),
+    'delivery': (2, [
+        ["✈️ Авиа", "🚢 Море", "🚛 Авто", "🔀 Комбинированное", "❓ Не знаю"],
+        NAVIGATION,
+    ]),
+    'skip_photo': (1, [
+        ["📷 Пропустить фото"],
+        NAVIGATION,
+    ]),
+    'cancel': (1, [
+        ["❌ Отменить", MANAGER, MAIN],
+    ]),
+    'main_menu': (1, [
+        ["📦 Новая заявка", MANAGER],
+    ]),
+    'confirm': (2, [
+        ["✅ Подтвердить", "✏️ Исправить", MANAGER, MAIN],
+    ]),
+    'correction': (2, [
+        ["👤 Имя", "📞 Телефон", "🏙️ Город", "📦 Груз",
+         "🔗 Ссылка", "🖼️ Фото", "⚖️ Вес", "📏 Объем",
+         "🚚 Доставка", "💰 Бюджет", "💬 Комментарий"],
+        ["⬅️ Назад к подтверждению"],
+    ]),
+    'standard': (1, [
+        NAVIGATION,
+    ]),
+}
+
+
+def _button(spec, labels):
+    if isinstance(spec, dict):
+        spec = dict(spec, text=labels.get(spec['text'], spec['text']))
+        return types.KeyboardButton(**spec)
+    return types.KeyboardButton(text=labels.get(spec, spec))
+
+
+def build_keyboard(name, labels=None):
+    """Собирает клавиатуру и возвращает сериализованный reply_markup"""
+    row_width, groups = LAYOUTS[name]
+    labels = labels or {}
+    keyboard = types.ReplyKeyboardMarkup(row_width=row_width, resize_keyboard=True)
+    for group in groups:
+        keyboard.add(*[_button(spec, labels) for spec in group])
+    return keyboard.to_json()
+
+
+@lru_cache(maxsize=512)
+def _cached_variant(name, labels):
+    return build_keyboard(name, dict(labels))
+
+
+def keyboard_variant(name, labels=None):
+    """Вариант клавиатуры с заменой подписей (например, перевод)
+
+    labels — словарь {исходная подпись: новая подпись}. Результат кэшируется.
+    """
+    if not labels:
+        return KEYBOARDS[name]
+    return _cached_variant(name, tuple(sorted(labels.items())))
+
+
+# Все базовые клавиатуры собираются один раз при импорте
+KEYBOARDS = {name: build_keyboard(name) for name in LAYOUTS}
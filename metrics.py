@@ -0,0 +1,168 @@
+import bisect
+import functools
+import threading
+import time
+
+# Границы корзин гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами.
+
+    Массив счётчиков выделяется один раз при создании, observe() только
+    находит корзину двоичным поиском и увеличивает счётчики.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self, func):
+        """Декоратор: замеряет время выполнения функции"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(time.perf_counter() - started)
+        return wrapper
+
+    def snapshot(self):
+        """(корзины, накопленные счётчики, сумма, количество)"""
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []
+        running = 0
+        for value in counts:
+            running += value
+            cumulative.append(running)
+        return self.buckets, cumulative, total, count
+
+
+class Counter:
+    """Счётчик с заранее заданными метками: на горячем пути ключ не строится заново"""
+
+    def __init__(self, registry, key):
+        self._registry = registry
+        self._key = key
+
+    def inc(self, value=1):
+        registry = self._registry
+        with registry._lock:
+            registry._counters[self._key] = registry._counters.get(self._key, 0) + value
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=None):
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in items) + '}'
+
+
+class Metrics:
+    """Простой потокобезопасный реестр счётчиков, датчиков и гистограмм.
+
+    Метрики адресуются именем и набором меток:
+        metrics.inc('state_evictions_total', reason='ttl')
+
+    Для горячего пути метрику можно получить заранее и дальше работать
+    с объектом напрямую:
+        latency = metrics.histogram('handler_seconds', step='name')
+        latency.observe(0.012)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def get(self, name, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def total(self, name):
+        """Сумма счётчика по всем меткам"""
+        with self._lock:
+            return sum(value for (metric, _), value in self._counters.items() if metric == name)
+
+    def counter(self, name, **labels):
+        """Счётчик с фиксированными метками"""
+        return Counter(self, self._key(name, labels))
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS, **labels):
+        """Гистограмма с фиксированными метками (создаётся при первом запросе)"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            return histogram
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters), dict(self._gauges)
+
+    def render_prometheus(self):
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+
+        lines = []
+        for kind, series in (('counter', counters), ('gauge', gauges)):
+            current = None
+            for (name, labels), value in series:
+                if name != current:
+                    lines.append(f"# TYPE {name} {kind}")
+                    current = name
+                lines.append(f"{name}{_labels(labels)} {value}")
+
+        current = None
+        for (name, labels), histogram in histograms:
+            if name != current:
+                lines.append(f"# TYPE {name} histogram")
+                current = name
+            buckets, cumulative, total, count = histogram.snapshot()
+            for bound, value in zip(buckets, cumulative):
+                lines.append(f"{name}_bucket{_labels(labels, ('le', bound))} {value}")
+            lines.append(f"{name}_bucket{_labels(labels, ('le', '+Inf'))} {cumulative[-1]}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,234 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Поля заявки, по которым есть индексы и фильтры поиска
+FILTERS = ('user_id', 'phone', 'destination', 'status', 'since', 'until')
+MAX_LIMIT = 200
+
+
+def phone_key(phone):
+    """Ключ поиска по телефону: последние 10 цифр (+7 999… и 8 999… совпадают)"""
+    digits = re.sub(r'\D', '', str(phone or ''))
+    return digits[-10:] or None
+
+
+def text_key(value):
+    # SQLite lower() не понимает кириллицу, поэтому ключ нормализуется здесь
+    return ' '.join(str(value or '').split()).casefold() or None
+
+
+class OrderStore:
+    """Локальный индекс заявок в SQLite.
+
+    Пишется вместе с таблицей и позволяет искать заявки по пользователю,
+    телефону, городу, статусу и дате без чтения Google Sheets. Каждый
+    индекс составной с датой создания, поэтому выборка «последние N заявок
+    по условию» читает только N строк индекса. Полная заявка хранится в
+    поле data как JSON.
+
+    Для синхронизации с таблицей хранится место строки заявки (лист и номер
+    строки) и synced_status — статус, который сейчас записан в таблице.
+    Если status отличается от synced_status, локальное изменение ещё не
+    отправлено в таблицу.
+    """
+
+    def __init__(self, path='orders.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS orders (
+                order_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                user_id INTEGER,
+                phone_key TEXT,
+                destination_key TEXT,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                sheet_title TEXT,
+                sheet_row INTEGER,
+                synced_status TEXT
+            );
+            CREATE INDEX IF NOT EXISTS orders_user ON orders (user_id, created_at);
+            CREATE INDEX IF NOT EXISTS orders_phone ON orders (phone_key, created_at);
+            CREATE INDEX IF NOT EXISTS orders_destination ON orders (destination_key, created_at);
+            CREATE INDEX IF NOT EXISTS orders_status ON orders (status, created_at);
+            CREATE INDEX IF NOT EXISTS orders_created ON orders (created_at);
+        """)
+        self._migrate()
+
+    def _migrate(self):
+        # Базы, созданные до синхронизации с таблицей, получают новые столбцы
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(orders)")}
+        for column, kind in (('sheet_title', 'TEXT'), ('sheet_row', 'INTEGER'), ('synced_status', 'TEXT')):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE orders ADD COLUMN {column} {kind}")
+        if 'synced_status' not in columns:
+            self._conn.execute("UPDATE orders SET synced_status = status")
+
+    @staticmethod
+    def _row(data, status):
+        return (
+            data['order_id'],
+            status,
+            data.get('timestamp', ''),
+            data.get('user_id'),
+            phone_key(data.get('phone_e164') or data.get('phone')),
+            text_key(data.get('destination')),
+            json.dumps(data, ensure_ascii=False),
+            time.time(),
+            status,
+        )
+
+    def save(self, data, status="Новая заявка"):
+        """Сохраняет заявку. Повторное сохранение того же order_id игнорируется"""
+        return self.save_many([data], status) == 1
+
+    def save_many(self, orders, status="Новая заявка"):
+        """Сохраняет пакет заявок одной транзакцией. Возвращает число новых"""
+        return self._transaction(
+            "INSERT OR IGNORE INTO orders (order_id, status, created_at, user_id, phone_key, "
+            "destination_key, data, updated_at, synced_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [self._row(data, status) for data in orders],
+        )
+
+    def set_status(self, order_id, status):
+        """Меняет статус заявки (в таблицу он уйдёт при синхронизации).
+
+        Возвращает False, если заявки нет.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE orders SET status = ?, updated_at = ? WHERE order_id = ?",
+                (status, time.time(), order_id),
+            )
+        return cursor.rowcount == 1
+
+    def _transaction(self, query, rows):
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(query, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return self._conn.total_changes - before
+
+    def place(self, placements):
+        """Запоминает строки таблицы: [(order_id, лист, номер строки)]"""
+        return self._transaction(
+            "UPDATE orders SET sheet_title = ?, sheet_row = ? WHERE order_id = ?",
+            [(title, row, order_id) for order_id, title, row in placements],
+        )
+
+    def tracked(self, since, skip_statuses=()):
+        """Заявки с известной строкой в таблице, созданные не раньше since.
+
+        Заявки со статусом из skip_statuses (закрытые) пропускаются, если
+        у них нет неотправленного локального изменения. Возвращает список
+        (order_id, лист, строка, status, synced_status).
+        """
+        skip = list(skip_statuses)
+        placeholders = ', '.join('?' * len(skip))
+        closed = f"synced_status IN ({placeholders}) AND status = synced_status" if skip else "0"
+        with self._lock:
+            return [tuple(row) for row in self._conn.execute(
+                "SELECT order_id, sheet_title, sheet_row, status, synced_status FROM orders "
+                f"WHERE created_at >= ? AND sheet_row IS NOT NULL AND NOT ({closed}) "
+                "ORDER BY sheet_title, sheet_row",
+                [since] + skip,
+            )]
+
+    def apply_sync(self, changes):
+        """Применяет результат синхронизации: [(order_id, status, synced_status, ожидаемый status)]
+
+        Заявка, статус которой успели изменить локально, не трогается.
+        Возвращает множество order_id, к которым изменения применены.
+        """
+        applied = set()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                now = time.time()
+                for order_id, status, synced_status, expected in changes:
+                    cursor = self._conn.execute(
+                        "UPDATE orders SET status = ?, synced_status = ?, updated_at = ? "
+                        "WHERE order_id = ? AND status = ?",
+                        (status, synced_status, now, order_id, expected),
+                    )
+                    if cursor.rowcount:
+                        applied.add(order_id)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return applied
+
+    def get(self, order_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        return self._order(row) if row else None
+
+    def search(self, user_id=None, phone=None, destination=None, status=None, since=None, until=None,
+               limit=20, before=None):
+        """Последние заявки по условиям, от новых к старым
+
+        since/until — границы даты создания в формате 'YYYY-MM-DD[ HH:MM:SS]'.
+        before — (created_at, order_id) последней заявки предыдущей страницы.
+        """
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(int(user_id))
+        if phone:
+            conditions.append("phone_key = ?")
+            params.append(phone_key(phone))
+        if destination:
+            conditions.append("destination_key = ?")
+            params.append(text_key(destination))
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if since:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        if until:
+            # Дата без времени включает весь день
+            conditions.append("created_at <= ?")
+            params.append(until if len(until) > 10 else until + " 23:59:59")
+        if before:
+            conditions.append("(created_at, order_id) < (?, ?)")
+            params.extend(before)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        query = f"SELECT * FROM orders {where} ORDER BY created_at DESC, order_id DESC LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(query, params + [limit]).fetchall()
+        return [self._order(row) for row in rows]
+
+    @staticmethod
+    def _order(row):
+        order = json.loads(row['data'])
+        order['status'] = row['status']
+        return order
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,233 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """Журнал исходящих записей (заявки для таблицы, уведомления менеджерам).
+
+    Каждая запись сохраняется один раз под идемпотентным ключом и остаётся
+    в журнале, пока не будет доставлена. База работает в режиме WAL с
+    synchronous=NORMAL: запись на горячем пути не ждёт fsync, сброс на диск
+    происходит пакетно при контрольных точках.
+
+    Неудачные попытки доставки откладывают следующую с экспоненциальной
+    паузой (backoff, 2·backoff, … не больше max_backoff). После max_attempts
+    попыток запись переводится в карантин (dead_at) и больше не повторяется,
+    чтобы не загораживать остальные; она остаётся в базе для разбора.
+    """
+
+    def __init__(self, path='outbox.db', max_attempts=10, backoff=60, max_backoff=6 * 3600):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                delivered_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS entries_pending
+                ON entries (kind, created_at) WHERE delivered_at IS NULL;
+            CREATE TABLE IF NOT EXISTS deliveries (
+                key TEXT NOT NULL,
+                target TEXT NOT NULL,
+                delivered_at REAL NOT NULL,
+                PRIMARY KEY (key, target)
+            );
+        """)
+        self._migrate()
+
+    def _migrate(self):
+        # Базы, созданные до появления паузы между попытками и карантина
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(entries)")}
+        for column in ('next_attempt_at', 'dead_at'):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE entries ADD COLUMN {column} REAL")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_replay ON entries (kind, created_at) "
+            "WHERE delivered_at IS NULL AND dead_at IS NULL"
+        )
+
+    def record(self, kind, key, payload):
+        """Сохраняет запись. Возвращает False, если ключ уже был записан"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO entries (key, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+                (key, kind, json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+        return cursor.rowcount == 1
+
+    def mark_delivered(self, keys):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE entries SET delivered_at = ? WHERE key = ? AND delivered_at IS NULL",
+                [(now, key) for key in keys],
+            )
+
+    def note_attempt(self, keys, kind=None):
+        """Учитывает попытку доставки: откладывает следующую или переводит в карантин.
+
+        Возвращает число записей, попавших в карантин.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE entries SET attempts = attempts + 1, "
+                "next_attempt_at = ? + min(?, ? * (1 << min(attempts, 30))) "
+                "WHERE key = ? AND delivered_at IS NULL AND dead_at IS NULL",
+                [(now, self.max_backoff, self.backoff, key) for key in keys],
+            )
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "UPDATE entries SET dead_at = ? WHERE key = ? AND delivered_at IS NULL "
+                "AND dead_at IS NULL AND attempts >= ?",
+                [(now, key, self.max_attempts) for key in keys],
+            )
+            dead = self._conn.total_changes - before
+        if dead:
+            metrics.inc('outbox_dead_total', dead, kind=kind)
+            logger.warning(f"⚠️ Записей в карантине после {self.max_attempts} попыток ({kind}): {dead}")
+        return dead
+
+    def mark_target_delivered(self, key, target):
+        """Отмечает доставку записи конкретному получателю (например, менеджеру)"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO deliveries (key, target, delivered_at) VALUES (?, ?, ?)",
+                (key, str(target), time.time()),
+            )
+
+    def delivered_targets(self, key):
+        with self._lock:
+            rows = self._conn.execute("SELECT target FROM deliveries WHERE key = ?", (key,)).fetchall()
+        return {row[0] for row in rows}
+
+    def pending(self, kind, created_before, limit=100):
+        """Возвращает недоставленные записи, созданные до created_before
+
+        Записи в карантине и те, чья пауза после неудачной попытки ещё не
+        истекла, пропускаются.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, payload, attempts FROM entries "
+                "WHERE kind = ? AND delivered_at IS NULL AND dead_at IS NULL AND created_at <= ? "
+                "AND (next_attempt_at IS NULL OR next_attempt_at <= ?) "
+                "ORDER BY created_at LIMIT ?",
+                (kind, created_before, time.time(), limit),
+            ).fetchall()
+        return [(key, json.loads(payload), attempts) for key, payload, attempts in rows]
+
+    def stats(self):
+        """Недоставленные записи по видам (без карантина)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT kind, COUNT(*) FROM entries WHERE delivered_at IS NULL AND dead_at IS NULL GROUP BY kind"
+            ).fetchall()
+        return dict(rows)
+
+    def dead_stats(self):
+        """Записи в карантине по видам"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT kind, COUNT(*) FROM entries WHERE dead_at IS NOT NULL AND delivered_at IS NULL GROUP BY kind"
+            ).fetchall()
+        return dict(rows)
+
+    def maintenance(self, keep_delivered=7 * 24 * 3600):
+        """Удаляет старые доставленные записи и сбрасывает WAL на диск"""
+        cutoff = time.time() - keep_delivered
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM deliveries WHERE key IN "
+                "(SELECT key FROM entries WHERE delivered_at IS NOT NULL AND delivered_at < ?)",
+                (cutoff,),
+            )
+            self._conn.execute("DELETE FROM entries WHERE delivered_at IS NOT NULL AND delivered_at < ?", (cutoff,))
+            self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.close()
+
+
+class OutboxReplayer:
+    """Фоновый поток, который повторно доставляет записи из журнала.
+
+    handlers — словарь {kind: функция(entries)}, где entries — список
+    (key, payload, attempts) одного прохода. Функция должна сама отметить
+    записи доставленными (сразу или асинхронно) и вернуть ключи, доставку
+    которых она выполнила сама: для них засчитывается попытка. Записи,
+    переданные дальше в асинхронную доставку, не возвращаются — попытку
+    засчитывает тот, кто узнаёт её результат (Outbox.note_attempt). Записи,
+    которые функция пропустила (например, таблица ещё не подключена),
+    попыткой не считаются.
+    """
+
+    def __init__(self, outbox, handlers, interval=60, grace=300):
+        self.outbox = outbox
+        self.handlers = handlers
+        self.interval = interval
+        self.grace = grace
+        self.started_at = time.time()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name="outbox-replayer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def replay_once(self, created_before=None):
+        if created_before is None:
+            created_before = time.time() - self.grace
+        replayed = 0
+        for kind, handler in self.handlers.items():
+            entries = self.outbox.pending(kind, created_before)
+            if not entries:
+                continue
+            try:
+                attempted = list(handler(entries) or ())
+            except Exception as e:
+                logger.error(f"❌ Ошибка повторной доставки ({kind}): {e}")
+                attempted = [key for key, _, _ in entries]
+            replayed += len(attempted)
+            self.outbox.note_attempt(attempted, kind)
+        if replayed:
+            logger.info(f"🔁 Повторно отправлено записей из журнала: {replayed}")
+        return replayed
+
+    def _run(self):
+        # После перезапуска сразу дожимаем всё, что не успели доставить до него
+        created_before = self.started_at
+        while True:
+            try:
+                self.replay_once(created_before=created_before)
+                self.outbox.maintenance()
+            except Exception as e:
+                logger.error(f"❌ Ошибка обслуживания журнала: {e}")
+            created_before = None
+            if self._stop.wait(self.interval):
+                return
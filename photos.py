@@ -0,0 +1,264 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from telebot import apihelper
+
+import image_processing
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class PhotoStore:
+    """Хранилище фото заявок на диске с адресацией по содержимому.
+
+    Основная ссылка на фото — file_id/file_unique_id из Telegram; файл
+    скачивается только когда он действительно нужен (fetch). Скачивание
+    идёт потоком, файл называется по sha256 содержимого, поэтому одинаковые
+    фото хранятся один раз. Общий объём ограничен max_bytes: при
+    превышении удаляются давно не использованные файлы (LRU по mtime).
+
+    При processing=True и установленном Pillow каждое сохранённое фото
+    заменяется пережатой копией и получает миниатюру. Обработка идёт в
+    фоне, отдельным процессом на фото (image_processing.py), не больше
+    workers одновременно; пока она не закончилась, отдаётся исходный файл.
+    """
+
+    def __init__(self, bot, directory='photos', max_bytes=512 * 1024 * 1024, processing=False, workers=None,
+                 session=None):
+        self.bot = bot
+        self.session = session or requests
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.processor = None
+        if processing and image_processing.Image is None:
+            logger.warning("⚠️ Pillow не установлен: обработка фото отключена")
+        elif processing:
+            # Потоки только ждут процессы обработки, поэтому GIL не занимают
+            self.processor = ThreadPoolExecutor(workers, thread_name_prefix="photo-process")
+        self._processing = set()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS photos (
+                unique_id TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL
+            )
+        """)
+        # file_id нужен, чтобы скачать фото по запросу, даже если его ещё нет на диске
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                unique_id TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL
+            )
+        """)
+        # Байты по часам: {'2024-01-01 12:00': [скачано, сохранено]}
+        self.hourly = OrderedDict()
+
+    def path(self, sha256):
+        return os.path.join(self.directory, f"{sha256}.jpg")
+
+    def thumb_path(self, sha256):
+        return os.path.join(self.directory, f"{sha256}_thumb.jpg")
+
+    def remember(self, file_id, unique_id):
+        """Запоминает file_id фото, чтобы его можно было скачать позже"""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO files (unique_id, file_id) VALUES (?, ?)",
+                               (unique_id, file_id))
+
+    def lookup(self, unique_id):
+        """Путь к уже сохранённому фото или None"""
+        with self._lock:
+            row = self._conn.execute("SELECT sha256 FROM photos WHERE unique_id = ?", (unique_id,)).fetchone()
+        if row is None:
+            return None
+        path = self.path(row[0])
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def fetch(self, file_id, unique_id):
+        """Возвращает путь к фото, при необходимости скачивая его из Telegram"""
+        path = self.lookup(unique_id)
+        if path:
+            return path
+        file_info = self.bot.get_file(file_id)
+        sha256, size = self.store_stream(self._download(file_info.file_path))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO photos (unique_id, sha256, size, stored_at) VALUES (?, ?, ?, ?)",
+                (unique_id, sha256, size, time.time()),
+            )
+        self.process_later(sha256)
+        self.enforce_limit()
+        return self.path(sha256)
+
+    def get(self, unique_id, thumb=False):
+        """Путь к фото (или миниатюре) для выдачи по ссылке; None, если фото неизвестно"""
+        path = self.lookup(unique_id)
+        if path is None:
+            with self._lock:
+                row = self._conn.execute("SELECT file_id FROM files WHERE unique_id = ?", (unique_id,)).fetchone()
+            if row is None:
+                return None
+            path = self.fetch(row[0], unique_id)
+        if thumb:
+            # Пока миниатюры нет, отдаём исходное фото, а миниатюра строится в фоне
+            sha256 = os.path.basename(path)[:-len('.jpg')]
+            if os.path.exists(self.thumb_path(sha256)):
+                return self.thumb_path(sha256)
+            self.process_later(sha256)
+        return path
+
+    def process_later(self, sha256):
+        """Ставит обработку фото в фон. False — обработка выключена или уже идёт"""
+        if self.processor is None or os.path.exists(self.thumb_path(sha256)):
+            return False
+        with self._lock:
+            if sha256 in self._processing:
+                return False
+            self._processing.add(sha256)
+        try:
+            self.processor.submit(self._process_in_background, sha256)
+        except RuntimeError:
+            # Пул уже остановлен (завершение работы)
+            with self._lock:
+                self._processing.discard(sha256)
+            return False
+        return True
+
+    def _process_in_background(self, sha256):
+        try:
+            self.process(sha256)
+        finally:
+            with self._lock:
+                self._processing.discard(sha256)
+
+    def process(self, sha256):
+        """Пережимает фото и строит миниатюру отдельным процессом (ждёт результата)"""
+        if self.processor is None or os.path.exists(self.thumb_path(sha256)):
+            return False
+        source = self.path(sha256)
+        archive_tmp = source + '.archive.part'
+        thumb_tmp = self.thumb_path(sha256) + '.part'
+        started = time.monotonic()
+        try:
+            original, archived, _ = image_processing.run(source, thumb_tmp, archive_tmp)
+            # Архивная копия заменяет оригинал, только если она действительно меньше
+            if archived < original:
+                os.replace(archive_tmp, source)
+                metrics.inc('photo_bytes_saved_total', original - archived)
+            os.replace(thumb_tmp, self.thumb_path(sha256))
+            metrics.inc('photos_processed_total', result='ok')
+            metrics.inc('photo_process_seconds_sum', time.monotonic() - started)
+            return True
+        except Exception as e:
+            metrics.inc('photos_processed_total', result='error')
+            logger.error(f"❌ Ошибка обработки фото {sha256}: {e}")
+            return False
+        finally:
+            for tmp in (archive_tmp, thumb_tmp):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def _download(self, file_path):
+        if apihelper.FILE_URL is None:
+            url = f"https://api.telegram.org/file/bot{self.bot.token}/{file_path}"
+        else:
+            url = apihelper.FILE_URL.format(self.bot.token, file_path)
+        with self.session.get(url, stream=True, timeout=(apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT)) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                self._account(downloaded=len(chunk))
+                yield chunk
+
+    def store_stream(self, chunks):
+        """Сохраняет поток байтов. Возвращает (sha256, размер)"""
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            path = self.path(sha256)
+            if os.path.exists(path):
+                # Такое фото уже есть — второй копии не храним
+                os.remove(tmp_path)
+                os.utime(path)
+                metrics.inc('photo_dedup_total')
+            else:
+                os.replace(tmp_path, path)
+                self._account(stored=size)
+            return sha256, size
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def enforce_limit(self):
+        """Удаляет давно не использованные фото сверх max_bytes"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.jpg'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return 0
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+            except OSError as e:
+                logger.warning(f"⚠️ Не удалось удалить фото {path}: {e}")
+        metrics.inc('photos_removed_total', removed, reason='lru')
+        return removed
+
+    def _account(self, downloaded=0, stored=0):
+        if downloaded:
+            metrics.inc('photo_bytes_downloaded_total', downloaded)
+        if stored:
+            metrics.inc('photo_bytes_stored_total', stored)
+        hour = time.strftime('%Y-%m-%d %H:00')
+        with self._lock:
+            bucket = self.hourly.get(hour)
+            if bucket is None:
+                bucket = self.hourly[hour] = [0, 0]
+                while len(self.hourly) > 48:
+                    self.hourly.popitem(last=False)
+            bucket[0] += downloaded
+            bucket[1] += stored
+
+    def hourly_stats(self, hours=3):
+        with self._lock:
+            return list(self.hourly.items())[-hours:]
+
+    def close(self):
+        if self.processor:
+            self.processor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,251 @@
+"""Ограничение частоты сообщений.
+
+RateLimiter — набор token bucket по ключу (чату). Корзины хранятся в
+OrderedDict в порядке последнего обращения: полностью восполненная корзина
+ничем не отличается от новой, поэтому такие корзины удаляются с начала
+словаря при каждом создании новой, а общее число ограничено max_keys.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('drop', 'coalesce', 'delay')
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    """Token bucket на каждый ключ: rate токенов в секунду, не больше burst"""
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._cleanup(now)
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+            return bucket
+        self._buckets.move_to_end(key)
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        return bucket
+
+    def _cleanup(self, now):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            refilled = bucket.tokens + (now - bucket.updated) * self.rate >= self.burst
+            if not refilled and len(self._buckets) < self.max_keys:
+                break
+            del self._buckets[key]
+
+    def try_acquire(self, key, cost=1, now=None):
+        """Забирает cost токенов, если они есть"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._bucket(key, now)
+            if bucket.tokens < cost:
+                return False
+            bucket.tokens -= cost
+            return True
+
+    def refund(self, key, cost=1):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.tokens = min(self.burst, bucket.tokens + cost)
+
+    def reserve(self, key, cost=1, now=None):
+        """Резервирует cost токенов, даже в долг. Возвращает, сколько секунд подождать"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._bucket(key, now)
+            bucket.tokens -= cost
+            return max(0.0, -bucket.tokens / self.rate)
+
+    def wait_time(self, key, cost=1, now=None):
+        """Через сколько секунд будет доступно cost токенов"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._bucket(key, now)
+            return max(0.0, (cost - bucket.tokens) / self.rate)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class FloodGuard:
+    """Защита обработчиков от потока сообщений одного чата.
+
+    Сообщение проходит сразу, если есть токены и в корзине чата, и в общей.
+    Иначе действует политика:
+        drop     — сообщение отбрасывается;
+        coalesce — ждёт только последнее сообщение, предыдущее заменяется;
+        delay    — сообщения ждут очереди (не больше max_deferred на чат).
+    Отложенные сообщения одного чата передаются по порядку, и пока они
+    есть, новые сообщения этого чата встают за ними.
+
+    Части одного альбома (group — media_group_id) считаются одним
+    сообщением: решение по первой части действует для остальных.
+
+    Сроки всех отложенных чатов хранит одна куча, её разбирает один поток.
+    """
+
+    def __init__(self, chat_limiter, global_limiter, policy='delay', max_deferred=10, max_deferred_chats=10000,
+                 max_groups=10000):
+        if policy not in POLICIES:
+            raise ValueError(f"Неизвестная политика ограничения: {policy}")
+        self.chat_limiter = chat_limiter
+        self.global_limiter = global_limiter
+        self.policy = policy
+        self.max_deferred = max_deferred
+        self.max_deferred_chats = max_deferred_chats
+        self.max_groups = max_groups
+        # chat -> deque((item, deliver, discard, cost)). Пустая очередь — отложенные
+        # сообщения чата сейчас передаются, новые должны встать за ними
+        self._deferred = {}
+        # media_group_id -> пропущен ли альбом (последние max_groups альбомов)
+        self._groups = OrderedDict()
+        self._lock = threading.Lock()
+        # (когда, seq, chat) — по одной записи на отложенный чат
+        self._timers = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _take(self, key, cost=1):
+        if not cost:
+            return True
+        if not self.chat_limiter.try_acquire(key):
+            return False
+        if not self.global_limiter.try_acquire(None):
+            self.chat_limiter.refund(key)
+            return False
+        return True
+
+    def _wait_time(self, key):
+        return max(self.chat_limiter.wait_time(key), self.global_limiter.wait_time(None), 0.01)
+
+    def admit(self, key, item, deliver, discard=None, group=None):
+        """Пропускает item в deliver сейчас или позже. Возвращает действие
+
+        deliver и discard (для отброшенных и заменённых сообщений) вызываются
+        вне замка, поэтому медленная передача не задерживает другие чаты.
+        """
+        dropped = []
+        with self._lock:
+            action, cost = self._decide(key, group)
+            pending = self._deferred.get(key)
+            if action == 'passed':
+                pass
+            elif action == 'drop':
+                dropped.append((item, discard))
+            else:
+                if action == 'coalesce' and pending:
+                    replaced, _, replaced_discard, _ = pending.pop()
+                    dropped.append((replaced, replaced_discard))
+                elif action == 'coalesce':
+                    # Заменять нечего: сообщение просто ждёт своей очереди
+                    action = 'delay'
+                if pending is None:
+                    pending = self._deferred[key] = deque()
+                    self._schedule(key, self._wait_time(key))
+                pending.append((item, deliver, discard, cost))
+            if group is not None and group not in self._groups:
+                self._groups[group] = action != 'drop'
+                while len(self._groups) > self.max_groups:
+                    self._groups.popitem(last=False)
+
+        if action != 'passed':
+            metrics.inc('flood_limited_total', action=action)
+        for dropped_item, dropped_discard in dropped:
+            if dropped_discard:
+                dropped_discard(dropped_item)
+        if action == 'passed':
+            deliver(item)
+        return action
+
+    def _decide(self, key, group):
+        """Действие для нового сообщения и его стоимость в токенах (под замком)"""
+        cost = 1
+        if group is not None and group in self._groups:
+            if not self._groups[group]:
+                return 'drop', 0
+            cost = 0
+        pending = self._deferred.get(key)
+        if pending is None and self._take(key, cost):
+            return 'passed', cost
+        if pending is not None and (not pending or not cost):
+            # Отложенные сообщения чата передаются прямо сейчас, или это
+            # часть альбома, начало которого уже ждёт в очереди
+            return 'delay', cost
+        action = self.policy
+        if action == 'drop' or (pending is None and len(self._deferred) >= self.max_deferred_chats):
+            return 'drop', cost
+        if action == 'coalesce' and pending:
+            return action, cost
+        if len(pending or ()) >= self.max_deferred:
+            return 'drop', cost
+        return action, cost
+
+    def _schedule(self, key, delay):
+        with self._cond:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._seq), key))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='flood-guard', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while not self._timers or self._timers[0][0] > now:
+                    self._cond.wait(self._timers[0][0] - now if self._timers else None)
+                    now = time.monotonic()
+                _, _, key = heapq.heappop(self._timers)
+            self._release(key)
+
+    def _release(self, key):
+        # Готовые сообщения забираются под замком, а передаются без него.
+        # Пока они передаются, чат остаётся в _deferred с пустой очередью
+        while True:
+            with self._lock:
+                pending = self._deferred.get(key)
+                ready = []
+                while pending and self._take(key, pending[0][3]):
+                    ready.append(pending.popleft())
+                if not ready:
+                    if pending:
+                        self._schedule(key, self._wait_time(key))
+                    else:
+                        self._deferred.pop(key, None)
+                    return
+            for item, deliver, _, _ in ready:
+                try:
+                    deliver(item)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка передачи отложенного сообщения чата {key}: {e}")
+
+    def deferred(self):
+        """Число отложенных сообщений"""
+        with self._lock:
+            return sum(len(pending) for pending in self._deferred.values())
+
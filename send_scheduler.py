@@ -0,0 +1,251 @@
+"""Планировщик исходящих запросов к Telegram Bot API.
+
+Все отправки проходят через одну очередь с учётом лимитов Telegram:
+около 30 сообщений в секунду всего, около 1 в секунду в личный чат и до
+20 в минуту в группу. У каждого получателя своя очередь (порядок сообщений
+в чате сохраняется), а между получателями выбирается запрос с более высоким
+приоритетом: ответы пользователю идут раньше уведомлений менеджерам.
+Ответ 429 откладывает получателя на retry_after и повторяет запрос.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from telebot.apihelper import ApiTelegramException
+
+from metrics import metrics
+from ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета: меньше — важнее
+REPLY = 0
+NOTIFY = 1
+BULK = 2
+PRIORITY_NAMES = {REPLY: 'reply', NOTIFY: 'notify', BULK: 'bulk'}
+
+
+class SendJob:
+    __slots__ = ('func', 'args', 'kwargs', 'priority', 'coalesce_key', 'futures', 'attempts', 'queued_at')
+
+    def __init__(self, func, args, kwargs, priority, coalesce_key):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.futures = [Future()]
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+
+
+class SendScheduler:
+    """Очереди отправки по получателям с общим и персональными лимитами"""
+
+    def __init__(self, workers=8, global_rate=30.0, global_burst=30, chat_rate=1.0, chat_burst=3,
+                 group_rate=17 / 60, group_burst=3, max_retries=5, max_keys=100000):
+        self.workers = workers
+        self.max_retries = max_retries
+        self._global = RateLimiter(global_rate, global_burst, max_keys=1)
+        self._chats = RateLimiter(chat_rate, chat_burst, max_keys)
+        self._groups = RateLimiter(group_rate, group_burst, max_keys)
+
+        self._cond = threading.Condition()
+        self._queues = {}          # chat_id -> deque(SendJob)
+        self._ready = []           # (priority, seq, chat_id) — можно отправлять сейчас
+        self._delayed = []         # (ready_at, seq, chat_id) — ждут лимита или retry_after
+        self._scheduled = set()    # получатели в _ready или _delayed
+        self._in_flight = set()    # получатели, запрос к которым выполняется
+        self._seq = itertools.count()
+        self._local = threading.local()
+        self._threads = []
+        self._stopping = False
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self._wait_latency = {priority: metrics.histogram('send_queue_seconds', priority=name)
+                              for priority, name in PRIORITY_NAMES.items()}
+        self._api_latency = metrics.histogram('telegram_api_seconds')
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"send-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    @contextmanager
+    def context(self, priority, coalesce_key=None):
+        """Приоритет (и ключ объединения) для отправок из текущего потока"""
+        previous = getattr(self._local, 'options', None)
+        self._local.options = (priority, coalesce_key)
+        try:
+            yield
+        finally:
+            self._local.options = previous
+
+    def submit(self, chat_id, func, *args, priority=None, coalesce_key=None, **kwargs):
+        """Ставит вызов func(*args, **kwargs) в очередь получателя chat_id. Возвращает Future
+
+        Если в очереди получателя уже ждёт запрос с тем же coalesce_key,
+        он заменяется новым, а его Future получит результат нового.
+        """
+        if priority is None:
+            priority, coalesce_key = getattr(self._local, 'options', None) or (REPLY, coalesce_key)
+        job = SendJob(func, args, kwargs, priority, coalesce_key)
+        with self._cond:
+            queue = self._queues.get(chat_id)
+            if queue is None:
+                queue = self._queues[chat_id] = deque()
+            if coalesce_key is not None:
+                for index, queued in enumerate(queue):
+                    if queued.coalesce_key == coalesce_key:
+                        job.futures.extend(queued.futures)
+                        queue[index] = job
+                        self.coalesced += 1
+                        metrics.inc('send_coalesced_total')
+                        return job.futures[0]
+            queue.append(job)
+            if chat_id not in self._scheduled and chat_id not in self._in_flight:
+                self._push_ready(chat_id)
+            self._cond.notify()
+        return job.futures[0]
+
+    def call(self, chat_id, func, *args, timeout=300, **kwargs):
+        """Отправляет через очередь и ждёт результат"""
+        return self.submit(chat_id, func, *args, **kwargs).result(timeout)
+
+    def _push_ready(self, chat_id):
+        heapq.heappush(self._ready, (self._queues[chat_id][0].priority, next(self._seq), chat_id))
+        self._scheduled.add(chat_id)
+
+    def _push_delayed(self, chat_id, ready_at):
+        heapq.heappush(self._delayed, (ready_at, next(self._seq), chat_id))
+        self._scheduled.add(chat_id)
+
+    def _chat_wait(self, chat_id, now):
+        limiter = self._groups if isinstance(chat_id, int) and chat_id < 0 else self._chats
+        if limiter.try_acquire(chat_id, now=now):
+            return 0.0
+        return limiter.wait_time(chat_id, now=now)
+
+    def _next_job(self):
+        """Следующий запрос для отправки (вызывается под self._cond)"""
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._delayed)
+                self._scheduled.discard(chat_id)
+                self._push_ready(chat_id)
+            while self._ready:
+                _, _, chat_id = heapq.heappop(self._ready)
+                wait = self._chat_wait(chat_id, now)
+                if wait > 0:
+                    heapq.heappush(self._delayed, (now + wait, next(self._seq), chat_id))
+                    continue
+                self._scheduled.discard(chat_id)
+                self._in_flight.add(chat_id)
+                return chat_id, self._queues[chat_id].popleft()
+            if self._stopping and not self._scheduled and not self._in_flight:
+                return None, None
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            self._cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                chat_id, job = self._next_job()
+            if job is None:
+                with self._cond:
+                    self._cond.notify_all()
+                return
+            self._execute(chat_id, job)
+
+    def _execute(self, chat_id, job):
+        delay = self._global.reserve(None)
+        if delay > 0:
+            time.sleep(delay)
+        started = time.monotonic()
+        if job.attempts == 0:
+            self._wait_latency[job.priority].observe(started - job.queued_at)
+        job.attempts += 1
+        retry_at = None
+        # Счётчики меняются под self._cond: отправляют несколько потоков
+        outcome = 'failed'
+        try:
+            result = job.func(*job.args, **job.kwargs)
+            outcome = 'sent'
+            for future in job.futures:
+                future.set_result(result)
+        except ApiTelegramException as e:
+            if e.error_code == 429 and job.attempts <= self.max_retries:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                retry_at = time.monotonic() + retry_after
+                outcome = 'retried'
+                metrics.inc('telegram_retry_after_total')
+                logger.warning(f"⚠️ Telegram ограничил отправку в чат {chat_id}, повтор через {retry_after} с")
+            else:
+                self._fail(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        finally:
+            self._api_latency.observe(time.monotonic() - started)
+
+        with self._cond:
+            if outcome == 'sent':
+                self.sent += 1
+            elif outcome == 'retried':
+                self.retried += 1
+            else:
+                self.failed += 1
+            self._in_flight.discard(chat_id)
+            queue = self._queues[chat_id]
+            if retry_at is not None:
+                # Загружаемый файл уже прочитан первой попыткой
+                for value in list(job.args) + list(job.kwargs.values()):
+                    if hasattr(value, 'seek'):
+                        value.seek(0)
+                queue.appendleft(job)
+                self._push_delayed(chat_id, retry_at)
+            elif queue:
+                self._push_ready(chat_id)
+            else:
+                del self._queues[chat_id]
+            self._cond.notify()
+
+    def _fail(self, job, error):
+        metrics.inc('send_failed_total')
+        for future in job.futures:
+            future.set_exception(error)
+
+    def queue_depth(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self):
+        queue_depth = self.queue_depth()
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'queue_depth': queue_depth,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'coalesced': self.coalesced,
+            }
+
+    def stop(self, timeout=10):
+        """Дожидается отправки очереди и останавливает потоки"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
@@ -0,0 +1,262 @@
+"""Листы Google Таблицы для записи заявок.
+
+Чтобы один лист не разрастался, записи уходят в текущий лист-шард:
+    month — по листу на месяц («Заявки 2024-05»);
+    size  — новый лист, когда в текущем набралось max_rows строк
+            («Заявки 001», «Заявки 002», …);
+    off   — всё в первый лист, как раньше.
+Новый шард создаётся с заголовком из шаблона. Объекты листов кэшируются,
+поэтому запись не открывает лист заново. WorksheetRegistry повторяет
+методы листа, которыми пользуется писатель (append_rows, find, title), и
+подставляется вместо листа прозрачно для вызывающего кода.
+
+Модуль не имеет побочных эффектов при импорте, поэтому таблицу можно
+открыть из утилит (python journal.py import), не запуская бота.
+"""
+import datetime
+import json
+import logging
+import re
+import threading
+import time
+
+import gspread
+from google.oauth2.service_account import Credentials
+from gspread.exceptions import APIError, WorksheetNotFound
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MODES = ('off', 'month', 'size')
+# Суффикс названия шарда в каждом режиме
+SHARD_SUFFIXES = {'off': r'(?!)', 'month': r'\d{4}-\d{2}', 'size': r'\d+'}
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+# Шаблон заголовка листа
+ORDER_HEADERS = [
+    "Статус",                    # A
+    "Дата создания",             # B
+    "User ID",                   # C
+    "Username",                  # D
+    "Имя",                       # E
+    "Телефон",                   # F
+    "Город назначения",          # G
+    "Описание груза",            # H
+    "Ссылка на сайт",            # I
+    "Фото",                      # J
+    "Вес (кг)",                  # K
+    "Объем (м³)",                # L
+    "Способ доставки",           # M
+    "Бюджет",                    # N
+    "Комментарий",               # O
+    "ID заявки"                  # P
+]
+
+
+def authorize(credentials_json):
+    """gspread-клиент сервисного аккаунта по JSON-ключу (строкой)"""
+    credentials = Credentials.from_service_account_info(json.loads(credentials_json), scopes=SCOPES)
+    return gspread.authorize(credentials)
+
+
+class WorksheetRegistry:
+    """Кэш листов таблицы и выбор текущего листа для записи"""
+
+    # Сколько помнить, что листа нет (его может создать другой процесс)
+    MISSING_TTL = 600
+
+    def __init__(self, spreadsheet, headers, mode='off', prefix='Заявки', max_rows=50000):
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим листов: {mode}")
+        self.spreadsheet = spreadsheet
+        self.headers = list(headers)
+        self.mode = mode
+        self.prefix = prefix
+        self.max_rows = max_rows
+        self._shard = re.compile(re.escape(prefix) + ' ' + SHARD_SUFFIXES[mode] + '$')
+        self._lock = threading.Lock()
+        # Все листы таблицы одним запросом метаданных
+        self._worksheets = {worksheet.title: worksheet for worksheet in spreadsheet.worksheets()}
+        # Названия листов, которых нет: title -> до какого момента не спрашивать
+        self._missing = {}
+        self._first = spreadsheet.sheet1 if mode == 'off' else None
+        self._current = None
+
+    @property
+    def title(self):
+        return self.current().title
+
+    def shards(self):
+        """Названия листов-шардов от старых к новым"""
+        with self._lock:
+            return self._shards()
+
+    def _shards(self):
+        return sorted(title for title in self._worksheets if self._shard.match(title))
+
+    def current(self):
+        """Лист, в который сейчас идёт запись (при необходимости создаётся)"""
+        with self._lock:
+            if self.mode == 'off':
+                return self._first
+            if self.mode == 'month':
+                title = f"{self.prefix} {datetime.datetime.now():%Y-%m}"
+                if self._current is None or self._current.title != title:
+                    self._current = self._worksheets.get(title) or self._create(title)
+                return self._current
+            if self._current is None:
+                titles = self._shards()
+                self._current = self._worksheets[titles[-1]] if titles else self._create(f"{self.prefix} 001")
+            # row_count листа, созданного здесь, растёт вместе с append_rows
+            if self._current.row_count >= self.max_rows:
+                number = int(self._current.title.rsplit(' ', 1)[-1]) + 1
+                self._current = self._create(f"{self.prefix} {number:03d}")
+            return self._current
+
+    def _create(self, title):
+        # Лист из одной строки заголовка: сетка растёт ровно на добавленные строки
+        try:
+            worksheet = self.spreadsheet.add_worksheet(title, rows=1, cols=len(self.headers))
+        except APIError:
+            # Лист мог создать другой процесс
+            worksheet = self.spreadsheet.worksheet(title)
+        else:
+            worksheet.update([self.headers], 'A1')
+            worksheet.freeze(rows=1)
+            metrics.inc('sheet_rollover_total')
+            logger.info(f"📄 Создан новый лист таблицы: {title}")
+        self._worksheets[title] = worksheet
+        self._missing.pop(title, None)
+        return worksheet
+
+    def worksheet(self, title=None):
+        """Лист по названию (None — текущий) или None, если такого листа нет"""
+        if title is None:
+            return self.current()
+        with self._lock:
+            worksheet = self._worksheets.get(title)
+            if worksheet is None:
+                if self._missing.get(title, 0) > time.monotonic():
+                    return None
+                try:
+                    worksheet = self._worksheets[title] = self.spreadsheet.worksheet(title)
+                except WorksheetNotFound:
+                    self._missing[title] = time.monotonic() + self.MISSING_TTL
+                    return None
+                self._missing.pop(title, None)
+            return worksheet
+
+    def append_rows(self, rows, **kwargs):
+        return self.current().append_rows(rows, **kwargs)
+
+    def _recent(self, recent):
+        """Текущий лист и последние recent шардов, без повторов"""
+        candidates = [self.current()]
+        if self.mode != 'off':
+            candidates += [self.worksheet(title) for title in reversed(self.shards()[-recent:])]
+        seen = set()
+        for worksheet in candidates:
+            if worksheet is not None and worksheet.title not in seen:
+                seen.add(worksheet.title)
+                yield worksheet
+
+    def find(self, query, in_column=None, recent=2):
+        """Ищет значение в последних recent листах. Возвращает (лист, ячейка) или (None, None)"""
+        for worksheet in self._recent(recent):
+            found = worksheet.find(query, in_column=in_column)
+            if found:
+                return worksheet, found
+        return None, None
+
+    def locate(self, values, column, recent=2):
+        """Строки значений в столбце column последних recent листов: {значение: (лист, строка)}
+
+        Столбец каждого листа читается одним запросом; листы дальше не
+        читаются, когда найдены все значения.
+        """
+        remaining = set(values)
+        found = {}
+        for worksheet in self._recent(recent):
+            if not remaining:
+                break
+            for row, value in enumerate(worksheet.col_values(column), start=1):
+                if value in remaining:
+                    remaining.discard(value)
+                    found[value] = (worksheet.title, row)
+        return found
+
+    def forget(self, title):
+        """Лист удалён из таблицы (например, перенесён в архив)"""
+        with self._lock:
+            self._worksheets.pop(title, None)
+            self._missing[title] = time.monotonic() + self.MISSING_TTL
+
+
+class SheetArchiver:
+    """Фоновое обслуживание старых листов-шардов.
+
+    Все шарды, кроме keep последних, сжимаются: у листа удаляются пустые
+    строки и столбцы сетки (они тоже входят в лимит ячеек таблицы). Если
+    задана архивная таблица, шард копируется в неё и удаляется из рабочей.
+    """
+
+    def __init__(self, registry, keep=3, archive_spreadsheet_id=None, interval=24 * 3600):
+        self.registry = registry
+        self.keep = keep
+        self.archive_spreadsheet_id = archive_spreadsheet_id
+        self.interval = interval
+        self._compacted = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.registry.mode != 'off':
+            self._thread = threading.Thread(target=self._run, name="sheet-archiver", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.archive_once()
+            except Exception as e:
+                logger.error(f"❌ Ошибка обслуживания листов таблицы: {e}")
+
+    def archive_once(self):
+        """Сжимает или переносит старые шарды. Возвращает число обработанных"""
+        current = self.registry.current().title
+        old = [title for title in self.registry.shards()[:-self.keep or None] if title != current]
+        done = 0
+        for title in old:
+            if title in self._compacted and not self.archive_spreadsheet_id:
+                continue
+            worksheet = self.registry.worksheet(title)
+            if worksheet is None:
+                continue
+            self.compact(worksheet)
+            if self.archive_spreadsheet_id:
+                self.move(worksheet)
+            done += 1
+        return done
+
+    def compact(self, worksheet):
+        used_rows = max(1, len(worksheet.col_values(1)))
+        columns = len(self.registry.headers)
+        if worksheet.row_count > used_rows or worksheet.col_count > columns:
+            worksheet.resize(rows=used_rows, cols=columns)
+            logger.info(f"🗜️ Лист {worksheet.title} сжат до {used_rows} строк")
+        self._compacted.add(worksheet.title)
+
+    def move(self, worksheet):
+        copy = worksheet.copy_to(self.archive_spreadsheet_id)
+        archive = self.registry.spreadsheet.client.open_by_key(self.archive_spreadsheet_id)
+        archive.get_worksheet_by_id(copy['sheetId']).update_title(worksheet.title)
+        self.registry.spreadsheet.del_worksheet(worksheet)
+        self.registry.forget(worksheet.title)
+        self._compacted.discard(worksheet.title)
+        metrics.inc('sheet_archived_total')
+        logger.info(f"📦 Лист {worksheet.title} перенесён в архивную таблицу")
@@ -0,0 +1,231 @@
+"""Двусторонняя синхронизация статусов заявок с Google Таблицей.
+
+Менеджеры меняют статус (столбец A) прямо в таблице, бот — командой
+/status. Синхронизация не читает таблицу целиком: для каждой открытой
+заявки известна её строка (из ответа append), и за один запрос batch_get
+читаются только столбцы статуса и ID заявки этих строк, сгруппированные в
+непрерывные диапазоны. Локальные изменения отправляются одним batch_update.
+
+Изменение, сделанное с обеих сторон с прошлой синхронизации, — конфликт:
+побеждает таблица, потому что там работают менеджеры. Если ID заявки в
+строке не совпал (строки отсортировали или удалили), строки заявок
+находятся заново по столбцу ID — это единственное чтение, стоимость
+которого зависит от размера листа.
+"""
+import datetime
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SYNC_LATENCY = metrics.histogram('sheet_sync_seconds')
+CELLS_READ = metrics.counter('sheet_sync_cells_read_total')
+
+
+def row_blocks(rows, max_gap=1):
+    """Сортированные номера строк -> непрерывные диапазоны (первая, последняя)"""
+    blocks = []
+    for row in rows:
+        if blocks and row - blocks[-1][1] <= max_gap:
+            blocks[-1][1] = row
+        else:
+            blocks.append([row, row])
+    return [tuple(block) for block in blocks]
+
+
+def cell(values, index):
+    """Значение из ответа batch_get: пустые хвостовые ячейки Google не возвращает"""
+    if index < len(values) and values[index]:
+        return str(values[index][0]).strip()
+    return ''
+
+
+class SheetSync:
+    """Фоновая синхронизация статусов между OrderStore и таблицей.
+
+    worksheet(title) возвращает лист по названию (title=None — текущий лист)
+    или None, пока таблица не подключена. on_change(order, old, new)
+    вызывается для каждого статуса, изменённого в таблице.
+    """
+
+    def __init__(self, store, worksheet, interval=60, window_days=30, closed_statuses=(),
+                 status_column='A', id_column='P', max_ranges=200, on_change=None):
+        self.store = store
+        self.worksheet = worksheet
+        self.interval = interval
+        self.window_days = window_days
+        self.closed_statuses = tuple(closed_statuses)
+        self.status_column = status_column
+        self.id_column = id_column
+        self.max_ranges = max_ranges
+        self.on_change = on_change
+
+        # Листы, строки заявок на которых нужно найти заново (None — основной)
+        self._locate_titles = {None}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.pulled = 0
+        self.pushed = 0
+        self.conflicts = 0
+        self.last_sync = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sheet-sync", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Запускает синхронизацию, не дожидаясь интервала (после /status)"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sync_once()
+            except Exception as e:
+                logger.error(f"❌ Ошибка синхронизации с Google Таблицей: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _since(self):
+        since = datetime.datetime.now() - datetime.timedelta(days=self.window_days)
+        return since.strftime("%Y-%m-%d %H:%M:%S")
+
+    def sync_once(self):
+        """Один проход синхронизации. Возвращает (получено, отправлено, конфликтов)"""
+        if self.worksheet(None) is None:
+            return 0, 0, 0
+        started = time.monotonic()
+        since = self._since()
+        while self._locate_titles:
+            self.locate(self._locate_titles.pop(), since)
+
+        by_title = defaultdict(list)
+        for order_id, title, row, status, synced in self.store.tracked(since, self.closed_statuses):
+            by_title[title].append((row, order_id, status, synced))
+
+        pulled = pushed = conflicts = 0
+        for title, orders in by_title.items():
+            worksheet = self.worksheet(title)
+            if worksheet is None:
+                continue
+            result = self._sync_worksheet(worksheet, title, orders)
+            pulled += result[0]
+            pushed += result[1]
+            conflicts += result[2]
+
+        self.pulled += pulled
+        self.pushed += pushed
+        self.conflicts += conflicts
+        self.last_sync = time.time()
+        SYNC_LATENCY.observe(time.monotonic() - started)
+        if pulled or pushed or conflicts:
+            logger.info(f"🔄 Синхронизация с таблицей: получено {pulled}, отправлено {pushed}, "
+                        f"конфликтов {conflicts}")
+        return pulled, pushed, conflicts
+
+    def _read(self, worksheet, rows):
+        """{строка: (статус, ID заявки)} для указанных строк"""
+        blocks = row_blocks(rows)
+        # Два диапазона на блок (статус и ID), поэтому блоки делятся поровну
+        per_request = max(1, self.max_ranges // 2)
+        cells = {}
+        for start in range(0, len(blocks), per_request):
+            chunk = blocks[start:start + per_request]
+            ranges = []
+            for first, last in chunk:
+                ranges.append(f"{self.status_column}{first}:{self.status_column}{last}")
+                ranges.append(f"{self.id_column}{first}:{self.id_column}{last}")
+            values = worksheet.batch_get(ranges)
+            for (first, _), statuses, ids in zip(chunk, values[::2], values[1::2]):
+                for index in range(max(len(statuses), len(ids))):
+                    cells[first + index] = (cell(statuses, index), cell(ids, index))
+            CELLS_READ.inc(sum(len(block) for block in values))
+        return cells
+
+    def _sync_worksheet(self, worksheet, title, orders):
+        cells = self._read(worksheet, [row for row, _, _, _ in orders])
+        changes, pushes, notices = [], [], []
+        conflicts = 0
+        for row, order_id, status, synced in orders:
+            sheet_status, sheet_order_id = cells.get(row, ('', ''))
+            if sheet_order_id != order_id:
+                # Строку сдвинули или удалили: найдём её заново в следующий проход
+                self._locate_titles.add(title)
+                continue
+            if not sheet_status or sheet_status == synced:
+                if status != synced:
+                    pushes.append((row, order_id, status))
+                continue
+            if status == sheet_status:
+                changes.append((order_id, status, status, status))
+                continue
+            if status != synced:
+                conflicts += 1
+                metrics.inc('sheet_sync_changes_total', direction='conflict')
+                logger.warning(f"⚠️ Статус заявки {order_id} изменён и в боте («{status}»), "
+                               f"и в таблице («{sheet_status}»): оставлен статус из таблицы")
+            changes.append((order_id, sheet_status, sheet_status, status))
+            notices.append((order_id, status, sheet_status))
+
+        if pushes:
+            worksheet.batch_update(
+                [{'range': f"{self.status_column}{row}", 'values': [[status]]} for row, _, status in pushes],
+                value_input_option='USER_ENTERED',
+            )
+            changes.extend((order_id, status, status, status) for _, order_id, status in pushes)
+            metrics.inc('sheet_sync_changes_total', len(pushes), direction='push')
+
+        applied = self.store.apply_sync(changes) if changes else set()
+        pulled = 0
+        for order_id, old_status, new_status in notices:
+            if order_id not in applied:
+                continue
+            pulled += 1
+            metrics.inc('sheet_sync_changes_total', direction='pull')
+            if self.on_change:
+                try:
+                    self.on_change(self.store.get(order_id), old_status, new_status)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка уведомления об изменении статуса {order_id}: {e}")
+        return pulled, len(pushes), conflicts
+
+    def locate(self, title=None, since=None):
+        """Находит строки заявок листа (None — текущий) по столбцу ID заявки
+
+        Отслеживаемые заявки, которых на листе больше нет, перестают
+        синхронизироваться.
+        """
+        worksheet = self.worksheet(title)
+        if worksheet is None:
+            return 0
+        column = ord(self.id_column) - ord('A') + 1
+        ids = worksheet.col_values(column)
+        CELLS_READ.inc(len(ids))
+        found = {order_id: row for row, order_id in enumerate(ids, start=1) if order_id}
+        placements = [(order_id, worksheet.title, row) for order_id, row in found.items()]
+        missing = [(order_id, None, None)
+                   for order_id, sheet_title, _, _, _ in self.store.tracked(since or self._since())
+                   if sheet_title == worksheet.title and order_id not in found]
+        placed = self.store.place(placements + missing)
+        logger.info(f"🔎 Строки заявок на листе «{worksheet.title}» найдены заново: {placed}")
+        return placed
+
+    def stats(self):
+        return {
+            'pulled': self.pulled,
+            'pushed': self.pushed,
+            'conflicts': self.conflicts,
+            'last_sync': self.last_sync,
+        }
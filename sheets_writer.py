@@ -0,0 +1,257 @@
+import logging
+import queue
+import random
+import re
+import threading
+import time
+
+from gspread.exceptions import APIError
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Коды ответа Google API, при которых имеет смысл повторить запрос
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+APPEND_LATENCY = metrics.histogram('sheets_append_seconds')
+ROWS_WRITTEN = metrics.counter('sheets_rows_total', result='ok')
+ROWS_FAILED = metrics.counter('sheets_rows_total', result='error')
+
+# updatedRange из ответа append: 'Лист 1'!A10:P12
+UPDATED_RANGE = re.compile(r"^(?:'((?:[^']|'')*)'|([^!]*))![A-Z]+(\d+)")
+
+
+def parse_updated_range(updated_range):
+    """(название листа, номер первой строки) из updatedRange"""
+    match = UPDATED_RANGE.match(updated_range or '')
+    if not match:
+        return None, None
+    quoted, plain, row = match.groups()
+    title = quoted.replace("''", "'") if quoted is not None else plain
+    return title, int(row)
+
+
+class SheetsWriter:
+    """Фоновая пакетная запись строк в Google Sheets.
+
+    Строки складываются в очередь и отправляются одним вызовом append_rows,
+    когда набирается batch_size строк или проходит flush_interval секунд.
+    После записи пакета вызывается on_success(keys), после окончательной
+    ошибки — on_failure(keys, rows). on_placed([(key, лист, строка)])
+    сообщает, в какие строки таблицы попали записанные строки.
+
+    Писатель можно создать без таблицы (sheet=None): строки копятся в очереди
+    и начинают записываться после attach(sheet). Если подключиться к таблице
+    не удалось, abandon() отдаёт накопленное в on_failure, а append()
+    начинает отказывать.
+    """
+
+    def __init__(self, sheet, batch_size=20, flush_interval=2.0, max_retries=5,
+                 on_success=None, on_failure=None, on_placed=None):
+        self.sheet = sheet
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.on_placed = on_placed
+
+        self._queue = queue.Queue()
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._attached = threading.Event()
+        if sheet is not None:
+            self._attached.set()
+        self.unavailable = False
+        self._thread = None
+
+        self.rows_written = 0
+        self.flush_count = 0
+        self.failed_rows = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sheets-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    @property
+    def ready(self):
+        """Таблица подключена и строки записываются"""
+        return self._attached.is_set()
+
+    def attach(self, sheet):
+        """Подключает таблицу: накопленные строки начинают записываться"""
+        self.sheet = sheet
+        self.unavailable = False
+        self._attached.set()
+
+    def abandon(self):
+        """Таблица недоступна: накопленные строки отдаются в on_failure"""
+        self.unavailable = True
+        items = self._drain(self.queue_depth() + self.batch_size)
+        keys = [key for key, _ in items if key is not None]
+        with self._in_flight_lock:
+            self._in_flight.difference_update(keys)
+        if items and self.on_failure:
+            try:
+                self.on_failure(keys, [row for _, row in items])
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки несохранённых строк: {e}")
+
+    def append(self, row, key=None):
+        """Ставит строку в очередь на запись (не блокирует обработчик)"""
+        if self.unavailable:
+            raise RuntimeError("Google Sheets недоступен")
+        if key is not None:
+            with self._in_flight_lock:
+                if key in self._in_flight:
+                    return
+                self._in_flight.add(key)
+        self._queue.put((key, row))
+
+    def is_pending(self, key):
+        """Находится ли строка с этим ключом в очереди или в процессе записи"""
+        with self._in_flight_lock:
+            return key in self._in_flight
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'rows_written': self.rows_written,
+            'flush_count': self.flush_count,
+            'failed_rows': self.failed_rows,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
+
+    def stop(self, timeout=30):
+        """Останавливает поток; перед выходом он дописывает очередь
+
+        Пишет в таблицу только поток писателя: если он не закончил за
+        timeout секунд (например, ждёт повтора после ошибки), оставшиеся
+        строки дошлёт журнал (outbox) после перезапуска.
+        """
+        self._stop.set()
+        if self._thread is None:
+            return
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"⚠️ Запись в Google Sheets не завершилась за {timeout} с, "
+                           f"строк в очереди: {self.queue_depth()}")
+            return
+        self._thread = None
+
+    def _drain(self, limit):
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        # Пока таблица не подключена, строки только копятся в очереди
+        while not self._attached.wait(self.flush_interval):
+            if self._stop.is_set():
+                return
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            # Добираем пакет до batch_size, но ждём не дольше flush_interval
+            items = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(items) < self.batch_size and not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._flush(items)
+
+        # Остановка: дописываем то, что осталось в очереди
+        items = self._drain(self.batch_size)
+        while items:
+            self._flush(items)
+            items = self._drain(self.batch_size)
+
+    def _flush(self, items):
+        keys = [key for key, _ in items if key is not None]
+        try:
+            return self._write(items)
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.difference_update(keys)
+
+    def _place(self, items, response):
+        updates = (response or {}).get('updates') or {}
+        title, first_row = parse_updated_range(updates.get('updatedRange'))
+        if first_row is None:
+            return
+        placements = [(key, title, first_row + index)
+                      for index, (key, _) in enumerate(items) if key is not None]
+        if placements:
+            try:
+                self.on_placed(placements)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки номеров строк: {e}")
+
+    def _write(self, items):
+        keys = [key for key, _ in items if key is not None]
+        rows = [row for _, row in items]
+        started = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            try:
+                call_started = time.monotonic()
+                # RAW: текст клиента не разбирается как формула («=…», «+7…»)
+                response = self.sheet.append_rows(rows, value_input_option='RAW')
+                APPEND_LATENCY.observe(time.monotonic() - call_started)
+                ROWS_WRITTEN.inc(len(rows))
+                latency = time.monotonic() - started
+                self.rows_written += len(rows)
+                self.flush_count += 1
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+                logger.info(f"✅ В Google Таблицу записано строк: {len(rows)} за {latency:.2f} с")
+                if self.on_placed:
+                    self._place(items, response)
+                if self.on_success and keys:
+                    try:
+                        self.on_success(keys)
+                    except Exception as e:
+                        logger.error(f"❌ Ошибка обработки записанных строк: {e}")
+                return True
+            except APIError as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                if status not in RETRYABLE_STATUSES or attempt == self.max_retries:
+                    logger.error(f"❌ Ошибка пакетной записи в Google Sheets: {e}")
+                    break
+                delay = min(60, 2 ** attempt) + random.uniform(0, 1)
+                logger.warning(f"⚠️ Google Sheets ответил {status}, повтор через {delay:.1f} с")
+                time.sleep(delay)
+            except Exception as e:
+                logger.error(f"❌ Ошибка пакетной записи в Google Sheets: {e}")
+                break
+
+        self.failed_rows += len(rows)
+        ROWS_FAILED.inc(len(rows))
+        if self.on_failure:
+            try:
+                self.on_failure(keys, rows)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки несохранённых строк: {e}")
+        return False
@@ -1,6 +1,7 @@
 import os
 import logging
-from app import bot, sheet, MANAGER_CHAT_IDS
+from app import bot, SHEETS_CONFIGURED, MANAGER_CHAT_IDS, BOT_ENGINE, update_dedup
+from metrics import metrics
 
 # Настройка логирования
 logging.basicConfig(
@@ -12,18 +13,33 @@ logger = logging.getLogger(__name__)
 def main():
     logger.info("🚀 Запуск Telegram бота для доставки...")
     logger.info(f"📊 Статус системы:")
-    logger.info(f"   🤖 Бот: ✅ активен")
-    logger.info(f"   📊 Google Таблица: {'✅ Подключена' if sheet else '❌ Файл'}")
+    # Подключение к Telegram и таблице идёт в фоне, обновления принимаются сразу
+    logger.info(f"   🤖 Бот: ⏳ проверка токена в фоне")
+    logger.info(f"   📊 Google Таблица: {'⏳ Подключается в фоне' if SHEETS_CONFIGURED else '❌ Запасной журнал'}")
     logger.info(f"   👥 Менеджеры: {MANAGER_CHAT_IDS}")
+    logger.info(f"   ⚙️ Режим: {BOT_ENGINE}")
+    
+    if BOT_ENGINE == 'async':
+        # Асинхронный режим: AsyncTeleBot + aiohttp, те же обработчики из app.py
+        import async_engine
+        try:
+            async_engine.run()
+        except KeyboardInterrupt:
+            logger.info("🛑 Бот остановлен пользователем")
+        return
     
     try:
-        # Запускаем бота в режиме polling
+        # Запускаем бота в режиме polling. Обновления проходят через
+        # bot.process_new_updates, где повторы по update_id отсеиваются
         logger.info("🔧 Бот запущен в режиме polling...")
         bot.infinity_polling()
     except KeyboardInterrupt:
         logger.info("🛑 Бот остановлен пользователем")
     except Exception as e:
         logger.error(f"💥 Критическая ошибка: {e}")
+    finally:
+        update_dedup.persist()
+        logger.info(f"🔁 Отсеяно повторных обновлений: {metrics.get('updates_duplicate_total')}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
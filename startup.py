@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    """Фоновая инициализация внешних зависимостей.
+
+    Каждый компонент (подключение к Telegram, Google Sheets и т.д.)
+    инициализируется в своём потоке, поэтому сетевые рукопожатия идут
+    параллельно и не задерживают импорт приложения. Неудачная попытка
+    повторяется с растущей паузой. Состояние компонентов доступно через
+    status(), а ready() показывает, готовы ли все обязательные из них.
+    """
+
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self._components = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, func, required=True, attempts=1, backoff=2.0, on_failure=None):
+        """Запускает инициализацию компонента в фоне
+
+        on_failure(error) вызывается, если все попытки завершились ошибкой.
+        """
+        component = {
+            'state': self.PENDING,
+            'required': required,
+            'seconds': None,
+            'error': None,
+            'done': threading.Event(),
+        }
+        with self._lock:
+            self._components[name] = component
+        thread = threading.Thread(
+            target=self._run, args=(name, component, func, attempts, backoff, on_failure),
+            name=f"startup-{name}", daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def _run(self, name, component, func, attempts, backoff, on_failure):
+        started = time.monotonic()
+        for attempt in range(attempts):
+            try:
+                func()
+                component['state'] = self.READY
+                component['error'] = None
+                break
+            except Exception as e:
+                component['error'] = str(e)
+                if attempt + 1 < attempts:
+                    delay = min(60, backoff * 2 ** attempt)
+                    logger.warning(f"⚠️ {name}: ошибка инициализации ({e}), повтор через {delay:.0f} с")
+                    time.sleep(delay)
+        else:
+            component['state'] = self.FAILED
+            logger.error(f"❌ {name}: не удалось инициализировать: {component['error']}")
+            if on_failure:
+                try:
+                    on_failure(component['error'])
+                except Exception as e:
+                    logger.error(f"❌ {name}: ошибка обработки сбоя инициализации: {e}")
+
+        component['seconds'] = time.monotonic() - started
+        metrics.set('startup_seconds', component['seconds'], component=name)
+        if component['state'] == self.READY:
+            logger.info(f"✅ {name}: готово за {component['seconds']:.2f} с")
+        component['done'].set()
+
+    def wait(self, timeout=None):
+        """Ждёт завершения инициализации всех компонентов. True — все завершились"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            components = list(self._components.values())
+        for component in components:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not component['done'].wait(remaining):
+                return False
+        return True
+
+    def ready(self):
+        with self._lock:
+            return all(component['state'] == self.READY
+                       for component in self._components.values() if component['required'])
+
+    def status(self):
+        with self._lock:
+            return {
+                name: {
+                    'state': component['state'],
+                    'required': component['required'],
+                    'seconds': component['seconds'],
+                    'error': component['error'],
+                }
+                for name, component in self._components.items()
+            }
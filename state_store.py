@@ -0,0 +1,596 @@
+import copy
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Время жизни незавершённого диалога по умолчанию (сутки)
+DEFAULT_TTL = 24 * 3600
+# Сколько помнить о вытесненных диалогах, чтобы ответить «сессия истекла»
+EXPIRED_MEMORY = 10000
+
+
+class StateStore:
+    """Базовый интерфейс хранилища состояний диалогов.
+
+    Состояние — обычный словарь (step, correcting_mode, поля заявки),
+    который должен сериализоваться в JSON. У каждой записи свой TTL;
+    о вытесненных диалогах с введёнными данными хранилище помнит
+    (pop_expired), чтобы сообщить пользователю, что сессия истекла. Диалог,
+    в котором есть только шаг (например, после /start), не отмечается, а
+    новое сохранение состояния чата снимает отметку.
+    """
+
+    LOCK_STRIPES = 256
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        # Полосатые блокировки: память не растёт с числом чатов
+        self._chat_locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._expired = OrderedDict()
+        self._expired_lock = threading.Lock()
+
+    def get(self, chat_id):
+        raise NotImplementedError
+
+    def set(self, chat_id, state, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, chat_id):
+        raise NotImplementedError
+
+    def touch(self, chat_id, ttl=None):
+        """Продлевает время жизни состояния без перезаписи"""
+        state = self.get(chat_id)
+        if state is not None:
+            self.set(chat_id, state, ttl)
+
+    def sweep(self):
+        """Удаляет просроченные записи. Возвращает число удалённых"""
+        return 0
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def _evicted(self, chat_id, state, reason):
+        """Запоминает вытесненный диалог, если пользователь что-то ввёл"""
+        metrics.inc('state_evictions_total', reason=reason)
+        if not any(key != 'step' for key in state):
+            return
+        with self._expired_lock:
+            self._expired[chat_id] = reason
+            self._expired.move_to_end(chat_id)
+            while len(self._expired) > EXPIRED_MEMORY:
+                self._expired.popitem(last=False)
+
+    def _saved(self, chat_id):
+        # Диалог начат заново: старая отметка больше не актуальна
+        if self._expired:
+            with self._expired_lock:
+                self._expired.pop(chat_id, None)
+
+    def pop_expired(self, chat_id):
+        """Был ли диалог чата недавно вытеснен (сбрасывает отметку)"""
+        with self._expired_lock:
+            return self._expired.pop(chat_id, None) is not None
+
+    @contextmanager
+    def lock(self, chat_id):
+        """Блокировка на время обработки одного сообщения чата"""
+        with self._chat_locks[hash(chat_id) % self.LOCK_STRIPES]:
+            yield
+
+    def close(self):
+        pass
+
+
+class MemoryStateStore(StateStore):
+    """Хранилище в памяти процесса с TTL и вытеснением по LRU.
+
+    Ограничено и числом записей (max_entries), и примерным объёмом
+    (max_bytes, по размеру JSON-представления состояния).
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=100000, max_bytes=64 * 1024 * 1024):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # chat_id -> (expires_at, size, state)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id):
+        with self._lock:
+            item = self._data.get(chat_id)
+            if item is None:
+                return None
+            expires_at, size, state = item
+            if expires_at >= time.monotonic():
+                self._data.move_to_end(chat_id)
+                return state
+            del self._data[chat_id]
+            self.total_bytes -= size
+        self._evicted(chat_id, state, 'ttl')
+        return None
+
+    def set(self, chat_id, state, ttl=None):
+        size = len(json.dumps(state, ensure_ascii=False).encode('utf-8'))
+        evicted = []
+        with self._lock:
+            old = self._data.pop(chat_id, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._data[chat_id] = (time.monotonic() + (ttl or self.ttl), size, state)
+            self.total_bytes += size
+            while len(self._data) > self.max_entries:
+                evicted.append(self._pop_oldest('lru'))
+            while self.total_bytes > self.max_bytes and len(self._data) > 1:
+                evicted.append(self._pop_oldest('bytes'))
+        self._saved(chat_id)
+        for evicted_id, evicted_state, reason in evicted:
+            self._evicted(evicted_id, evicted_state, reason)
+
+    def _pop_oldest(self, reason):
+        chat_id, (_, size, state) = self._data.popitem(last=False)
+        self.total_bytes -= size
+        return chat_id, state, reason
+
+    def touch(self, chat_id, ttl=None):
+        with self._lock:
+            item = self._data.get(chat_id)
+            if item is not None:
+                self._data[chat_id] = (time.monotonic() + (ttl or self.ttl), item[1], item[2])
+                self._data.move_to_end(chat_id)
+
+    def delete(self, chat_id):
+        with self._lock:
+            item = self._data.pop(chat_id, None)
+            if item is not None:
+                self.total_bytes -= item[1]
+
+    def sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [chat_id for chat_id, item in self._data.items() if item[0] < now]
+            removed = []
+            for chat_id in expired:
+                _, size, state = self._data.pop(chat_id)
+                self.total_bytes -= size
+                removed.append((chat_id, state))
+        for chat_id, state in removed:
+            self._evicted(chat_id, state, 'ttl')
+        return len(removed)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStateStore(StateStore):
+    """Хранилище на диске (SQLite), переживает перезапуск процесса.
+
+    Число записей ограничено max_entries, но не на каждой записи, а при
+    очистке (sweep): сверх лимита удаляются записи, которые истекают
+    раньше остальных. Объём записей не ограничивается.
+    """
+
+    def __init__(self, path='states.db', ttl=DEFAULT_TTL, max_entries=100000):
+        super().__init__(ttl)
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS states (
+                chat_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS states_expires ON states (expires_at)")
+
+    def get(self, chat_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, expires_at FROM states WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] >= time.time():
+                return json.loads(row[0])
+            self._conn.execute("DELETE FROM states WHERE chat_id = ?", (chat_id,))
+        self._evicted(chat_id, json.loads(row[0]), 'ttl')
+        return None
+
+    def set(self, chat_id, state, ttl=None):
+        data = json.dumps(state, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO states (chat_id, data, expires_at) VALUES (?, ?, ?)",
+                (chat_id, data, time.time() + (ttl or self.ttl)),
+            )
+        self._saved(chat_id)
+
+    def touch(self, chat_id, ttl=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE states SET expires_at = ? WHERE chat_id = ?", (time.time() + (ttl or self.ttl), chat_id)
+            )
+
+    def sweep(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chat_id, data FROM states WHERE expires_at < ?", (time.time(),)
+            ).fetchall()
+            self._conn.executemany("DELETE FROM states WHERE chat_id = ?", [(row[0],) for row in rows])
+            excess = self._conn.execute("SELECT COUNT(*) FROM states").fetchone()[0] - self.max_entries
+            evicted = []
+            if excess > 0:
+                evicted = self._conn.execute(
+                    "SELECT chat_id, data FROM states ORDER BY expires_at LIMIT ?", (excess,)
+                ).fetchall()
+                self._conn.executemany("DELETE FROM states WHERE chat_id = ?", [(row[0],) for row in evicted])
+        for chat_id, data in rows:
+            self._evicted(chat_id, json.loads(data), 'ttl')
+        for chat_id, data in evicted:
+            self._evicted(chat_id, json.loads(data), 'lru')
+        return len(rows) + len(evicted)
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM states WHERE chat_id = ?", (chat_id,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM states").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisConnection:
+    """Минимальный клиент протокола Redis (RESP) без внешних зависимостей"""
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, timeout=5):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        self._file = self._sock.makefile('rb')
+        if self.password:
+            self._call('AUTH', self.password)
+        if self.db:
+            self._call('SELECT', self.db)
+
+    def _close(self):
+        try:
+            if self._sock is not None:
+                self._sock.close()
+        finally:
+            self._sock = None
+            self._file = None
+
+    def _encode(self, args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Redis закрыл соединение")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b'+':
+            return rest.decode('utf-8')
+        if prefix == b'-':
+            raise RuntimeError(f"Ошибка Redis: {rest.decode('utf-8')}")
+        if prefix == b':':
+            return int(rest)
+        if prefix == b'$':
+            length = int(rest)
+            if length == -1:
+                return None
+            data = self._file.read(length + 2)
+            return data[:-2]
+        if prefix == b'*':
+            length = int(rest)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"Неизвестный ответ Redis: {line!r}")
+
+    def _call(self, *args):
+        self._sock.sendall(self._encode(args))
+        return self._read_reply()
+
+    def execute(self, *args):
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._call(*args)
+                except (ConnectionError, OSError):
+                    self._close()
+                    if attempt:
+                        raise
+
+
+# Снять или продлить блокировку может только её владелец (по токену)
+UNLOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+RENEW_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+)
+
+
+class RedisStateStore(StateStore):
+    """Хранилище в Redis: общее для нескольких процессов бота.
+
+    Ключ живёт в Redis чуть дольше TTL диалога (expired_grace), а срок
+    годности хранится в самом значении: так бот замечает истёкший диалог
+    и может сообщить пользователю, что сессия закончилась.
+
+    Блокировка чата ставится на lock_lease секунд и, пока обработчик её
+    держит, продлевается фоновым потоком, так что долгий обработчик (например,
+    ждущий отправки) не теряет её.
+    """
+
+    def __init__(self, connection, ttl=DEFAULT_TTL, prefix='dialog:', lock_timeout=30,
+                 expired_grace=7 * 24 * 3600, lock_lease=60):
+        super().__init__(ttl)
+        self.redis = connection
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.expired_grace = expired_grace
+        self.lock_lease = lock_lease
+        # lock_key -> токен блокировок, которые держит этот процесс
+        self._held = {}
+        self._held_lock = threading.Lock()
+        self._renewer = None
+        self._stop = threading.Event()
+
+    def _key(self, chat_id):
+        return f"{self.prefix}{chat_id}"
+
+    def get(self, chat_id):
+        data = self.redis.execute('GET', self._key(chat_id))
+        if data is None:
+            return None
+        item = json.loads(data)
+        if item['expires_at'] >= time.time():
+            return item['state']
+        self.redis.execute('DEL', self._key(chat_id))
+        self._evicted(chat_id, item['state'], 'ttl')
+        return None
+
+    def set(self, chat_id, state, ttl=None):
+        ttl = ttl or self.ttl
+        data = json.dumps({'expires_at': time.time() + ttl, 'state': state}, ensure_ascii=False)
+        self.redis.execute('SET', self._key(chat_id), data, 'PX', int((ttl + self.expired_grace) * 1000))
+        self._saved(chat_id)
+
+    def delete(self, chat_id):
+        self.redis.execute('DEL', self._key(chat_id))
+
+    def __len__(self):
+        count = 0
+        cursor = b'0'
+        while True:
+            cursor, keys = self.redis.execute('SCAN', cursor, 'MATCH', f"{self.prefix}*", 'COUNT', 1000)
+            count += len(keys)
+            if cursor in (b'0', 0, '0'):
+                return count
+
+    @contextmanager
+    def lock(self, chat_id):
+        """Распределённая блокировка: работает между процессами бота
+
+        Если блокировку не удалось получить за lock_timeout секунд, бросает
+        TimeoutError: обработка сообщения без неё нарушила бы порядок
+        обработки сообщений чата.
+        """
+        with super().lock(chat_id):
+            lock_key = f"lock:{self._key(chat_id)}"
+            token = uuid.uuid4().hex
+            deadline = time.monotonic() + self.lock_timeout
+            delay = 0.01
+            while self.redis.execute('SET', lock_key, token, 'NX', 'PX', int(self.lock_lease * 1000)) is None:
+                if time.monotonic() > deadline:
+                    metrics.inc('state_lock_timeouts_total')
+                    raise TimeoutError(f"Не удалось получить блокировку чата {chat_id} за {self.lock_timeout} с")
+                time.sleep(delay)
+                delay = min(delay * 2, 0.2)
+            with self._held_lock:
+                self._held[lock_key] = token
+                if self._renewer is None:
+                    self._renewer = threading.Thread(target=self._renew_locks, name='redis-lock-renew', daemon=True)
+                    self._renewer.start()
+            try:
+                yield
+            finally:
+                with self._held_lock:
+                    del self._held[lock_key]
+                self.redis.execute('EVAL', UNLOCK_SCRIPT, 1, lock_key, token)
+
+    def _renew_locks(self):
+        """Продлевает удерживаемые блокировки каждую треть lock_lease"""
+        while not self._stop.wait(self.lock_lease / 3):
+            with self._held_lock:
+                held = list(self._held.items())
+            for lock_key, token in held:
+                try:
+                    renewed = self.redis.execute('EVAL', RENEW_SCRIPT, 1, lock_key, token, int(self.lock_lease * 1000))
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось продлить блокировку {lock_key}: {e}")
+                    continue
+                with self._held_lock:
+                    lost = not renewed and self._held.get(lock_key) == token
+                if lost:
+                    metrics.inc('state_lock_lost_total')
+                    logger.warning(f"⚠️ Блокировка {lock_key} истекла до окончания обработки")
+
+    def close(self):
+        self._stop.set()
+
+
+def create_state_store(url, ttl=DEFAULT_TTL, max_entries=100000, max_bytes=64 * 1024 * 1024):
+    """Создаёт хранилище по URL: memory://, sqlite:///states.db, redis://host:6379/0"""
+    parsed = urlparse(url)
+    if parsed.scheme == 'memory':
+        return MemoryStateStore(ttl=ttl, max_entries=max_entries, max_bytes=max_bytes)
+    if parsed.scheme == 'sqlite':
+        return SQLiteStateStore(parsed.path.lstrip('/') or 'states.db', ttl=ttl, max_entries=max_entries)
+    if parsed.scheme == 'redis':
+        connection = RedisConnection(
+            host=parsed.hostname or 'localhost',
+            port=parsed.port or 6379,
+            db=int(parsed.path.lstrip('/') or 0),
+            password=parsed.password,
+        )
+        return RedisStateStore(connection, ttl=ttl)
+    raise ValueError(f"Неизвестное хранилище состояний: {url}")
+
+
+class UserData:
+    """Словарь состояний диалогов поверх StateStore.
+
+    Внутри session(chat_id) состояние чата загружается один раз,
+    обработчики работают с ним как с обычным словарем, а при выходе
+    изменения сохраняются в хранилище. ttl_policy(state) задаёт TTL
+    записи в зависимости от её содержимого (None — TTL хранилища).
+    """
+
+    def __init__(self, store, ttl_policy=None):
+        self.store = store
+        self.ttl_policy = ttl_policy
+        self._local = threading.local()
+
+    def _ttl(self, state):
+        return self.ttl_policy(state) if self.ttl_policy else None
+
+    def _cache(self):
+        cache = getattr(self._local, 'cache', None)
+        if cache is None:
+            cache = self._local.cache = {}
+        return cache
+
+    @contextmanager
+    def session(self, chat_id):
+        cache = self._cache()
+        if chat_id in cache:
+            # Вложенный вызов обработчика в рамках того же сообщения
+            yield
+            return
+
+        with self.store.lock(chat_id):
+            state = self.store.get(chat_id)
+            snapshot = copy.deepcopy(state)
+            cache[chat_id] = state
+            try:
+                yield
+            finally:
+                state = cache.pop(chat_id)
+                if state is None:
+                    if snapshot is not None:
+                        self.store.delete(chat_id)
+                elif state != snapshot:
+                    self.store.set(chat_id, state, self._ttl(state))
+                else:
+                    self.store.touch(chat_id, self._ttl(state))
+
+    def __contains__(self, chat_id):
+        cache = self._cache()
+        if chat_id in cache:
+            return cache[chat_id] is not None
+        return self.store.get(chat_id) is not None
+
+    def __getitem__(self, chat_id):
+        cache = self._cache()
+        state = cache[chat_id] if chat_id in cache else self.store.get(chat_id)
+        if state is None:
+            raise KeyError(chat_id)
+        return state
+
+    def get(self, chat_id, default=None):
+        try:
+            return self[chat_id]
+        except KeyError:
+            return default
+
+    def __setitem__(self, chat_id, state):
+        cache = self._cache()
+        if chat_id in cache:
+            cache[chat_id] = state
+        else:
+            self.store.set(chat_id, state, self._ttl(state))
+
+    def __delitem__(self, chat_id):
+        cache = self._cache()
+        if chat_id in cache:
+            if cache[chat_id] is None:
+                raise KeyError(chat_id)
+            cache[chat_id] = None
+        else:
+            self.store.delete(chat_id)
+
+    def __len__(self):
+        return len(self.store)
+
+
+class StateSweeper:
+    """Периодическая очистка просроченных диалогов.
+
+    Фото диалогов на диске не хранятся (в состоянии только file_id), а
+    объём хранилища фото ограничивает сам PhotoStore.
+    """
+
+    def __init__(self, store, interval=300):
+        self.store = store
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="state-sweeper", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def sweep_once(self):
+        expired = self.store.sweep()
+        metrics.set('dialogs_active', len(self.store))
+        if expired:
+            logger.info(f"🧹 Очистка: истёкших диалогов {expired}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep_once()
+            except Exception as e:
+                logger.error(f"❌ Ошибка очистки состояний: {e}")
@@ -0,0 +1,82 @@
+"""Общие фикстуры тестов.
+
+app.py импортируется один раз с временными путями данных и поддельным
+Bot API: запросы к Telegram не уходят в сеть, а записываются в список.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DATA_DIR = tempfile.mkdtemp(prefix='bot-tests-')
+MANAGER_CHAT_ID = 1
+
+
+class FakeBotAPI:
+    """Подмена telebot.apihelper._make_request: отвечает как Bot API и запоминает вызовы"""
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+    def __call__(self, token, method_name, method='get', params=None, files=None):
+        params = dict(params or {})
+        with self._lock:
+            self.calls.append((method_name, params))
+            self._message_id += 1
+            message_id = self._message_id
+        if method_name == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Test', 'username': 'test_bot'}
+        if method_name.startswith('send'):
+            return {'message_id': message_id, 'date': int(time.time()),
+                    'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                    'text': params.get('text', '')}
+        return True
+
+    def texts(self, chat_id):
+        with self._lock:
+            return [params.get('text', '') for method, params in self.calls
+                    if method == 'sendMessage' and str(params.get('chat_id')) == str(chat_id)]
+
+    def wait_for(self, chat_id, count, timeout=10):
+        """Ждёт, пока чату уйдёт count сообщений, и возвращает их тексты"""
+        deadline = time.monotonic() + timeout
+        while len(self.texts(chat_id)) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.texts(chat_id)
+
+
+@pytest.fixture(scope='session')
+def bot_api():
+    telebot = pytest.importorskip('telebot')
+    api = FakeBotAPI()
+    telebot.apihelper._make_request = api
+    return api
+
+
+@pytest.fixture(scope='session')
+def bot_app(bot_api):
+    """app.py с отключённой таблицей и данными во временном каталоге"""
+    pytest.importorskip('flask')
+    pytest.importorskip('gspread')
+    os.environ.update({
+        'BOT_TOKEN': '123456:TEST',
+        'MANAGER_CHAT_IDS': str(MANAGER_CHAT_ID),
+        'OUTBOX_PATH': os.path.join(DATA_DIR, 'outbox.db'),
+        'ORDERS_DB_PATH': os.path.join(DATA_DIR, 'orders.db'),
+        'JOURNAL_DIR': os.path.join(DATA_DIR, 'journal'),
+        'PHOTO_DIR': os.path.join(DATA_DIR, 'photos'),
+        'UPDATE_HWM_PATH': os.path.join(DATA_DIR, 'update_hwm.json'),
+        'PHOTO_URL_SECRET': 'test-secret',
+    })
+    for name in ('GOOGLE_CREDENTIALS_JSON', 'WEBHOOK_SECRET', 'WEBHOOK_URL', 'STATE_STORE_URL'):
+        os.environ.pop(name, None)
+    import app
+    return app
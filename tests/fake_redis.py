@@ -0,0 +1,150 @@
+"""Локальная замена Redis для тестов: TCP-сервер протокола RESP.
+
+Поддерживает команды, которыми пользуется RedisStateStore: GET, SET (NX,
+PX, EX), DEL, PTTL, SCAN, а также PING, AUTH, SELECT и FLUSHALL. Срок
+жизни ключей проверяется при обращении, как в Redis. Lua не исполняется:
+EVAL понимает только скрипты блокировки из state_store.
+"""
+import fnmatch
+import socketserver
+import threading
+import time
+
+from state_store import RENEW_SCRIPT, UNLOCK_SCRIPT
+
+
+class FakeRedis:
+    def __init__(self):
+        # key -> (value, expires_at или None)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.commands = []
+        self.scripts = {UNLOCK_SCRIPT: self._unlock, RENEW_SCRIPT: self._renew}
+
+    def _alive(self, key):
+        item = self.data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return item
+
+    def execute(self, name, *args):
+        name = name.upper()
+        with self.lock:
+            self.commands.append(name)
+            if name == 'PING':
+                return 'PONG'
+            if name in ('AUTH', 'SELECT'):
+                return 'OK'
+            if name == 'FLUSHALL':
+                self.data.clear()
+                return 'OK'
+            if name == 'GET':
+                item = self._alive(args[0])
+                return item[0] if item else None
+            if name == 'SET':
+                return self._set(args)
+            if name == 'DEL':
+                return sum(1 for key in args if self._alive(key) and self.data.pop(key))
+            if name == 'PTTL':
+                item = self._alive(args[0])
+                if item is None:
+                    return -2
+                return -1 if item[1] is None else int((item[1] - time.monotonic()) * 1000)
+            if name == 'EVAL':
+                script, numkeys = args[0], int(args[1])
+                if script not in self.scripts:
+                    raise ValueError("NOSCRIPT unknown script")
+                return self.scripts[script](args[2:2 + numkeys], args[2 + numkeys:])
+            if name == 'SCAN':
+                pattern = '*'
+                options = [arg.upper() for arg in args[1::2]]
+                if 'MATCH' in options:
+                    pattern = args[2 + 2 * options.index('MATCH')]
+                keys = [key for key in list(self.data) if self._alive(key) and fnmatch.fnmatchcase(key, pattern)]
+                return [b'0', [key.encode('utf-8') for key in keys]]
+        raise ValueError(f"ERR unknown command '{name}'")
+
+    def _unlock(self, keys, argv):
+        item = self._alive(keys[0])
+        if item is None or item[0] != argv[0]:
+            return 0
+        del self.data[keys[0]]
+        return 1
+
+    def _renew(self, keys, argv):
+        item = self._alive(keys[0])
+        if item is None or item[0] != argv[0]:
+            return 0
+        self.data[keys[0]] = (item[0], time.monotonic() + int(argv[1]) / 1000)
+        return 1
+
+    def _set(self, args):
+        key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+        expires_at = None
+        if 'PX' in options:
+            expires_at = time.monotonic() + int(args[2 + options.index('PX') + 1]) / 1000
+        if 'EX' in options:
+            expires_at = time.monotonic() + int(args[2 + options.index('EX') + 1])
+        if 'NX' in options and self._alive(key):
+            return None
+        self.data[key] = (value, expires_at)
+        return 'OK'
+
+
+def encode(reply):
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, str):
+        return b'+%s\r\n' % reply.encode('utf-8')
+    if isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    return b'*%d\r\n' % len(reply) + b''.join(encode(item) for item in reply)
+
+
+class RESPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:-2])):
+                length = int(self.rfile.readline()[1:-2])
+                args.append(self.rfile.read(length + 2)[:-2])
+            name, args = args[0].decode('utf-8'), [arg.decode('utf-8') for arg in args[1:]]
+            try:
+                reply = self.server.redis.execute(name, *args)
+            except ValueError as e:
+                self.wfile.write(b'-%s\r\n' % str(e).encode('utf-8'))
+                continue
+            if isinstance(reply, str) and name.upper() == 'GET':
+                reply = reply.encode('utf-8')
+            self.wfile.write(encode(reply))
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """Сервер на свободном порту 127.0.0.1; url — адрес для create_state_store"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RESPHandler)
+        self.redis = FakeRedis()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
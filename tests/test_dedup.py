@@ -0,0 +1,36 @@
+"""UpdateDeduplicator: повторы и отметка на диске"""
+from dedup import UpdateDeduplicator
+
+
+def test_duplicate_after_restart(tmp_path):
+    path = str(tmp_path / 'hwm.json')
+    dedup = UpdateDeduplicator(state_path=path)
+    assert dedup.check(10)
+    assert not dedup.check(10)
+    dedup.persist()
+    assert not UpdateDeduplicator(state_path=path).check(10)
+
+
+def test_forgotten_update_is_processed_after_restart(tmp_path):
+    path = str(tmp_path / 'hwm.json')
+    dedup = UpdateDeduplicator(state_path=path)
+    for update_id in (10, 11, 12):
+        assert dedup.check(update_id)
+    # Очередь была полна: вебхук ответил 503, Telegram доставит 11 снова
+    dedup.forget(11)
+    dedup.persist()
+
+    restarted = UpdateDeduplicator(state_path=path)
+    assert not restarted.check(10)
+    assert restarted.check(11)
+    assert not restarted.check(11)
+
+
+def test_forgotten_update_is_accepted_once(tmp_path):
+    dedup = UpdateDeduplicator(state_path=str(tmp_path / 'hwm.json'))
+    assert dedup.check(5)
+    dedup.forget(5)
+    assert dedup.check(5)
+    assert not dedup.check(5)
+    dedup.persist()
+    assert not UpdateDeduplicator(state_path=str(tmp_path / 'hwm.json')).check(5)
@@ -0,0 +1,127 @@
+"""Обработчики диалога в обоих режимах работы бота.
+
+Один и тот же сценарий анкеты проходит через три входа: polling
+(DeliveryBot.process_new_updates), webhook Flask и webhook aiohttp
+(AsyncEngine). Ответы проверяются по запросам к поддельному Bot API.
+"""
+import asyncio
+import itertools
+import json
+import time
+
+import pytest
+
+update_ids = itertools.count(1000)
+chat_ids = itertools.count(10000)
+
+
+def make_update(chat_id, text):
+    update_id = next(update_ids)
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Тест'},
+            'text': text,
+        },
+    }
+
+
+# (текст пользователя, фрагмент ответа бота)
+SCENARIO = [
+    ('/start', 'Добро пожаловать'),
+    ('📦 Новая заявка', 'Введите ваше имя'),
+    ('Иван', 'Ваш номер телефона'),
+    ('позвоните мне', 'Не удалось распознать номер'),
+    ('8 (999) 123-45-67', 'Город назначения'),
+]
+
+
+def check_scenario(bot_api, chat_id, deliver):
+    for index, (text, expected) in enumerate(SCENARIO, start=1):
+        deliver(make_update(chat_id, text))
+        replies = bot_api.wait_for(chat_id, index)
+        assert len(replies) == index, replies
+        assert expected in replies[-1]
+
+
+def test_polling(bot_app, bot_api):
+    telebot = pytest.importorskip('telebot')
+    chat_id = next(chat_ids)
+
+    def deliver(update):
+        bot_app.bot.process_new_updates([telebot.types.Update.de_json(update)])
+
+    check_scenario(bot_api, chat_id, deliver)
+    assert bot_app.user_data[chat_id]['phone_e164'] == '+79991234567'
+
+
+def test_flask_webhook(bot_app, bot_api):
+    client = bot_app.app.test_client()
+    chat_id = next(chat_ids)
+
+    def deliver(update):
+        response = client.post('/webhook', data=json.dumps(update), content_type='application/json')
+        assert response.status_code == 200
+
+    check_scenario(bot_api, chat_id, deliver)
+
+
+def test_flask_webhook_rejects_bad_content_type(bot_app):
+    response = bot_app.app.test_client().post('/webhook', data='{}', content_type='text/plain')
+    assert response.status_code == 403
+
+
+def test_duplicate_update_is_processed_once(bot_app, bot_api):
+    client = bot_app.app.test_client()
+    chat_id = next(chat_ids)
+    update = make_update(chat_id, '/start')
+    for _ in range(3):
+        client.post('/webhook', data=json.dumps(update), content_type='application/json')
+    bot_api.wait_for(chat_id, 1)
+    bot_app.update_pool.join()
+    assert len(bot_api.texts(chat_id)) == 1
+
+
+def run_async_webhook(bot_app, updates):
+    """Отправляет обновления в aiohttp-webhook и ждёт окончания их обработки"""
+    pytest.importorskip('aiohttp')
+    from aiohttp.test_utils import TestClient, TestServer
+
+    import async_engine
+
+    async def scenario():
+        engine = async_engine.AsyncEngine(threads=4)
+        client = TestClient(TestServer(async_engine.create_web_app(engine)))
+        await client.start_server()
+        statuses = []
+        try:
+            for update in updates:
+                response = await client.post('/webhook', data=json.dumps(update),
+                                             headers={'Content-Type': 'application/json'})
+                statuses.append(response.status)
+                await engine.drain()
+        finally:
+            await client.close()
+            engine.executor.shutdown()
+        return statuses
+
+    return asyncio.run(scenario())
+
+
+def test_async_webhook(bot_app, bot_api):
+    chat_id = next(chat_ids)
+    for index, (text, expected) in enumerate(SCENARIO, start=1):
+        assert run_async_webhook(bot_app, [make_update(chat_id, text)]) == [200]
+        replies = bot_api.wait_for(chat_id, index)
+        assert expected in replies[-1]
+
+
+def test_async_webhook_keeps_chat_order(bot_app, bot_api):
+    chat_id = next(chat_ids)
+    updates = [make_update(chat_id, text) for text, _ in SCENARIO]
+    assert run_async_webhook(bot_app, updates) == [200] * len(updates)
+    replies = bot_api.wait_for(chat_id, len(SCENARIO))
+    assert [expected in reply for (_, expected), reply in zip(SCENARIO, replies)] == [True] * len(SCENARIO)
@@ -0,0 +1,160 @@
+"""Хранилища состояний: Redis (через tests/fake_redis.py), отметки об истёкших диалогах"""
+import threading
+import time
+
+import pytest
+
+from fake_redis import FakeRedisServer
+from state_store import RedisStateStore, UserData, create_state_store
+
+
+@pytest.fixture
+def redis_server():
+    server = FakeRedisServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def store(redis_server):
+    return create_state_store(redis_server.url, ttl=60)
+
+
+def test_set_get_delete(store):
+    assert store.get(1) is None
+    store.set(1, {'step': 'name', 'name': 'Иван'})
+    assert store.get(1) == {'step': 'name', 'name': 'Иван'}
+    store.delete(1)
+    assert store.get(1) is None
+
+
+def test_len_counts_only_dialog_keys(store, redis_server):
+    for chat_id in range(5):
+        store.set(chat_id, {'step': 'start'})
+    redis_server.redis.execute('SET', 'other:key', 'x')
+    assert len(store) == 5
+
+
+def test_key_lives_longer_than_dialog(store, redis_server):
+    store.set(1, {'step': 'start'}, ttl=10)
+    pttl = redis_server.redis.execute('PTTL', 'dialog:1')
+    assert (10 + store.expired_grace) * 1000 - 5000 < pttl <= (10 + store.expired_grace) * 1000
+
+
+def test_expired_dialog_is_reported(redis_server):
+    store = RedisStateStore(create_state_store(redis_server.url).redis, ttl=0.05)
+    store.set(1, {'step': 'phone', 'name': 'Иван'})
+    time.sleep(0.1)
+    assert store.get(1) is None
+    assert store.pop_expired(1)
+    assert not store.pop_expired(1)
+    assert redis_server.redis.execute('GET', 'dialog:1') is None
+
+
+@pytest.mark.parametrize('url', ['memory://', 'sqlite:///:memory:'])
+def test_expiry_mark_only_for_entered_data(url):
+    store = create_state_store(url, ttl=0.05)
+    store.set(1, {'step': 'start'})
+    store.set(2, {'step': 'phone', 'name': 'Иван'})
+    time.sleep(0.1)
+    assert store.sweep() == 2
+    assert not store.pop_expired(1)
+    assert store.pop_expired(2)
+
+
+def test_new_dialog_clears_expiry_mark():
+    store = create_state_store('memory://', ttl=0.05)
+    store.set(1, {'step': 'phone', 'name': 'Иван'})
+    time.sleep(0.1)
+    store.sweep()
+    # Пользователь начал и сохранил новый диалог: старая отметка не нужна
+    store.set(1, {'step': 'start'}, ttl=60)
+    assert not store.pop_expired(1)
+
+
+def test_key_expires_in_redis(redis_server):
+    store = RedisStateStore(create_state_store(redis_server.url).redis, ttl=0.05, expired_grace=0)
+    store.set(1, {'step': 'phone'})
+    time.sleep(0.1)
+    assert redis_server.redis.execute('GET', 'dialog:1') is None
+
+
+def test_lock_serializes_processes(redis_server):
+    # Два хранилища с отдельными соединениями — как два процесса бота
+    stores = [create_state_store(redis_server.url) for _ in range(2)]
+    inside = []
+    overlaps = []
+
+    def work(store):
+        for _ in range(20):
+            with store.lock(7):
+                inside.append(1)
+                overlaps.append(len(inside))
+                time.sleep(0.001)
+                inside.pop()
+
+    threads = [threading.Thread(target=work, args=(store,)) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(overlaps) == 40
+    assert max(overlaps) == 1
+
+
+def test_lock_timeout_fails_instead_of_running_unlocked(redis_server):
+    holder = create_state_store(redis_server.url)
+    waiter = RedisStateStore(create_state_store(redis_server.url).redis, lock_timeout=0.2)
+    ran = []
+    with holder.lock(7):
+        with pytest.raises(TimeoutError):
+            with waiter.lock(7):
+                ran.append(True)
+    assert ran == []
+    # После освобождения блокировка снова доступна
+    with waiter.lock(7):
+        ran.append(True)
+    assert ran == [True]
+
+
+def test_lock_outlives_its_lease_while_held(redis_server):
+    holder = RedisStateStore(create_state_store(redis_server.url).redis, lock_lease=0.3)
+    waiter = RedisStateStore(create_state_store(redis_server.url).redis, lock_timeout=0.2)
+    with holder.lock(7):
+        # Обработчик держит блокировку дольше lock_lease: её продлевают
+        time.sleep(0.6)
+        with pytest.raises(TimeoutError):
+            with waiter.lock(7):
+                pass
+    holder.close()
+
+
+def test_unlock_keeps_foreign_lock(store, redis_server):
+    with store.lock(7):
+        # Блокировка истекла, и её взял другой процесс
+        redis_server.redis.execute('SET', 'lock:dialog:7', 'foreign')
+    assert redis_server.redis.execute('GET', 'lock:dialog:7') == 'foreign'
+
+
+def test_lock_released_after_error(store, redis_server):
+    with pytest.raises(RuntimeError):
+        with store.lock(7):
+            raise RuntimeError("ошибка обработчика")
+    assert redis_server.redis.execute('GET', 'lock:dialog:7') is None
+
+
+def test_user_data_session_round_trip(store):
+    user_data = UserData(store)
+    with user_data.session(5):
+        user_data[5] = {'step': 'name'}
+        user_data[5]['name'] = 'Иван'
+    assert store.get(5) == {'step': 'name', 'name': 'Иван'}
+    with user_data.session(5):
+        del user_data[5]
+    assert store.get(5) is None
+
+
+def test_reconnects_after_connection_loss(store, redis_server):
+    store.set(1, {'step': 'start'})
+    store.redis._sock.close()
+    assert store.get(1) == {'step': 'start'}
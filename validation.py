@@ -0,0 +1,235 @@
+"""Разбор и нормализация ответов анкеты: телефон, вес, объём, бюджет.
+
+Каждый разборщик получает текст пользователя и возвращает словарь
+типизированных полей, которые сохраняются в состоянии рядом с исходным
+текстом, или None, если текст не удалось разобрать (тогда вопрос
+задаётся снова):
+    parse_phone("8 (999) 123-45-67")  -> {'phone_e164': '+79991234567'}
+    parse_weight("около 5 тонн")      -> {'weight_kg': 5000.0}
+    parse_volume("120х80х100 см")     -> {'volume_m3': 0.96}
+    parse_budget("50 тыс. руб")       -> {'budget_amount': 50000.0, 'budget_currency': 'RUB'}
+Ответ «нет» / «не знаю» для веса, объёма и бюджета допустим: типизированные
+поля тогда равны None. Для диапазона («5-7 т») берётся верхняя граница.
+Сокращения единиц можно писать с точками («куб. м», «тыс. руб.»).
+Неоднозначные множители бюджета («5 т», «5 m» — тысячи, тонны, метры?)
+принимаются только вместе с валютой, иначе вопрос задаётся снова.
+Все шаблоны компилируются при импорте.
+"""
+import re
+
+# Число: пробелы между разрядами, дробная часть через точку или запятую
+NUMBER = r'\d{1,3}(?:[ ]\d{3})+(?:[.,]\d+)?|\d+(?:[.,]\d+)?'
+
+
+def _number(name):
+    return rf'(?P<{name}>{NUMBER})'
+
+
+def _range(suffix=''):
+    # Верхняя граница диапазона необязательна
+    return rf'{_number("low" + suffix)}(?:\s*(?:-|–|—|до)\s*{_number("high" + suffix)})?'
+
+
+SPACES = re.compile(r'\s+')
+APPROX = re.compile(r'^(?:около|примерно|приблизительно|где-?то|порядка|~|≈|до|не более|не больше|максимум|макс\.?)\s*')
+APPROX_SUFFIX = re.compile(r'\s*(?:примерно|приблизительно|или около того)$')
+SKIP = re.compile(r'^(?:нет|не знаю|незнаю|неизвестно|не указан\w*|пропустить|-|—|\?|n/?a)$')
+
+PHONE_SEPARATORS = re.compile(r'[\s\-().]')
+PHONE = re.compile(r'^(\+|00)?(\d{7,15})$')
+
+WEIGHT_UNITS = (
+    (re.compile(r'^(?:кг|kg|килограмм\w*|кило)$'), 1.0),
+    (re.compile(r'^(?:т|t|тн|тонн\w*|тон)$'), 1000.0),
+    (re.compile(r'^(?:г|гр|g|грамм\w*)$'), 0.001),
+)
+WEIGHT = re.compile(rf'^{_range()}\s*(?P<unit>[a-zа-я]+)?\.?$')
+
+# Единица сравнивается без точек: «куб. м» и «м.куб» -> «куб м» и «м куб»
+VOLUME_UNITS = (
+    (re.compile(r'^(?:м3|м³|m3|куб\w*(?: ?м\w*)?|кубометр\w*|м куб\w*)$'), 1.0),
+    (re.compile(r'^(?:л|l|литр\w*)$'), 0.001),
+    (re.compile(r'^(?:см3|см³|cm3|куб ?см)$'), 0.000001),
+)
+VOLUME = re.compile(rf'^{_range()}\s*(?P<unit>[a-zа-я][a-zа-я0-9³. ]*?)?\.?$')
+# Габариты «Д х Ш х В»; без единиц считаются в сантиметрах
+LENGTH = r'(?:мм|см|м|mm|cm|m)'
+DIMENSIONS = re.compile(
+    rf'^{_number("a")}\s*{LENGTH}?\s*[xх×*]\s*{_number("b")}\s*{LENGTH}?\s*[xх×*]\s*{_number("c")}\s*'
+    rf'(?P<unit>{LENGTH})?\.?$'
+)
+LENGTH_UNITS = {'мм': 0.001, 'mm': 0.001, 'см': 0.01, 'cm': 0.01, 'м': 1.0, 'm': 1.0, None: 0.01}
+
+CURRENCIES = (
+    (re.compile(r'^(?:₽|руб\w*|р|rub|rur)$'), 'RUB'),
+    (re.compile(r'^(?:¥|元|юан\w*|cny|rmb)$'), 'CNY'),
+    (re.compile(r'^(?:\$|usd|долл\w*|бакс\w*)$'), 'USD'),
+    (re.compile(r'^(?:€|eur|евро)$'), 'EUR'),
+)
+MULTIPLIERS = (
+    (re.compile(r'^(?:тыс\w*|т|к|k)$'), 1000.0),
+    (re.compile(r'^(?:млн|миллион\w*|m)$'), 1000000.0),
+)
+# Без валюты «т» и «m» могут значить и тонны или метры: сумма не угадывается
+AMBIGUOUS_MULTIPLIERS = re.compile(r'^(?:т|m)$')
+BUDGET = re.compile(
+    rf'^(?P<prefix>[$¥€₽])?\s*{_range()}\s*(?P<mult>тыс\w*|т|к|k|млн|миллион\w*|m)?\.?\s*'
+    rf'(?P<currency>[$¥€₽元]|[a-zа-я]+)?\.?$'
+)
+CURRENCY_SYMBOLS = {'RUB': '₽', 'CNY': '¥', 'USD': '$', 'EUR': '€'}
+DEFAULT_CURRENCY = 'RUB'
+
+
+def _clean(text):
+    text = SPACES.sub(' ', str(text or '').replace('\u00a0', ' ')).strip().lower()
+    text = APPROX_SUFFIX.sub('', APPROX.sub('', text))
+    return text
+
+
+def _to_float(value):
+    return float(value.replace(' ', '').replace(',', '.'))
+
+
+def _upper_bound(match):
+    high = match.group('high')
+    return _to_float(high if high is not None else match.group('low'))
+
+
+def _unit(units, name, default):
+    if not name:
+        return default
+    name = SPACES.sub(' ', name.replace('.', ' ')).strip()
+    for pattern, factor in units:
+        if pattern.match(name):
+            return factor
+    return None
+
+
+def parse_phone(text):
+    """Телефон в формате E.164. Номер без кода страны считается российским"""
+    match = PHONE.match(PHONE_SEPARATORS.sub('', str(text or '')))
+    if not match:
+        return None
+    international, digits = match.groups()
+    if international:
+        # «+8 999 …» — частая ошибка вместо +7
+        if len(digits) == 11 and digits.startswith('89'):
+            digits = '7' + digits[1:]
+        return {'phone_e164': '+' + digits} if len(digits) >= 8 else None
+    if len(digits) == 11 and digits[0] in '78':
+        return {'phone_e164': '+7' + digits[1:]}
+    if len(digits) == 10 and digits[0] == '9':
+        return {'phone_e164': '+7' + digits}
+    # Китайский мобильный: 11 цифр, начинается с 1
+    if len(digits) == 11 and digits[0] == '1':
+        return {'phone_e164': '+86' + digits}
+    if len(digits) >= 11:
+        return {'phone_e164': '+' + digits}
+    return None
+
+
+def parse_weight(text):
+    """Вес в килограммах (кг, т, г; без единиц — кг)"""
+    text = _clean(text)
+    if SKIP.match(text):
+        return {'weight_kg': None}
+    match = WEIGHT.match(text)
+    if not match:
+        return None
+    factor = _unit(WEIGHT_UNITS, match.group('unit'), 1.0)
+    if factor is None:
+        return None
+    value = round(_upper_bound(match) * factor, 3)
+    return {'weight_kg': value} if value > 0 else None
+
+
+def parse_volume(text):
+    """Объём в м³ (м³, л, см³ или габариты; без единиц — м³)"""
+    text = _clean(text)
+    if SKIP.match(text):
+        return {'volume_m3': None}
+    match = DIMENSIONS.match(text)
+    if match:
+        length = LENGTH_UNITS[match.group('unit')]
+        value = 1.0
+        for name in ('a', 'b', 'c'):
+            value *= _to_float(match.group(name)) * length
+    else:
+        match = VOLUME.match(text)
+        if not match:
+            return None
+        factor = _unit(VOLUME_UNITS, match.group('unit'), 1.0)
+        if factor is None:
+            return None
+        value = _upper_bound(match) * factor
+    value = round(value, 6)
+    return {'volume_m3': value} if value > 0 else None
+
+
+def parse_budget(text):
+    """Бюджет: сумма и валюта (₽, ¥, $, €; без валюты — рубли)"""
+    text = _clean(text)
+    if SKIP.match(text):
+        return {'budget_amount': None, 'budget_currency': None}
+    match = BUDGET.match(text)
+    if not match:
+        return None
+    multiplier = _unit(MULTIPLIERS, match.group('mult'), 1.0)
+    currency_name = match.group('currency') or match.group('prefix')
+    if match.group('mult') and AMBIGUOUS_MULTIPLIERS.match(match.group('mult')) and not currency_name:
+        return None
+    currency = DEFAULT_CURRENCY
+    if currency_name:
+        currency = next((code for pattern, code in CURRENCIES if pattern.match(currency_name)), None)
+    if multiplier is None or currency is None:
+        return None
+    value = round(_upper_bound(match) * multiplier, 2)
+    return {'budget_amount': value, 'budget_currency': currency} if value > 0 else None
+
+
+VALIDATORS = {
+    'phone': parse_phone,
+    'weight': parse_weight,
+    'volume': parse_volume,
+    'budget': parse_budget,
+}
+
+
+def validate(name, text):
+    return VALIDATORS[name](text)
+
+
+def format_number(value):
+    """5000.0 -> '5 000', 0.96 -> '0.96', 0.0005 -> '0.0005'"""
+    # Малые объёмы (см³) показываются до миллионных, а не округляются до 0
+    decimals = 3 if abs(value) >= 0.01 else 6
+    text = f"{value:,.{decimals}f}".rstrip('0').rstrip('.')
+    return text.replace(',', ' ')
+
+
+def display(data, field, with_raw=False):
+    """Нормализованное значение поля анкеты для показа
+
+    Если разобрать не удалось, возвращается исходный текст. with_raw
+    добавляет исходный текст в скобках, когда он отличается.
+    """
+    raw = data.get(field, '')
+    value = raw
+    if field == 'phone':
+        value = data.get('phone_e164') or raw
+    elif field == 'weight' and data.get('weight_kg') is not None:
+        value = f"{format_number(data['weight_kg'])} кг"
+    elif field == 'volume' and data.get('volume_m3') is not None:
+        value = f"{format_number(data['volume_m3'])} м³"
+    elif field == 'budget' and data.get('budget_amount') is not None:
+        value = f"{format_number(data['budget_amount'])} {CURRENCY_SYMBOLS[data['budget_currency']]}"
+    if with_raw and raw and value != raw:
+        return f"{value} («{raw}»)"
+    return value
+
+
+def budget_cell(data):
+    """Бюджет для таблицы: «50000 RUB»; исходный текст, если разобрать не удалось"""
+    if data.get('budget_amount') is None:
+        return data.get('budget', '')
+    return f"{format_number(data['budget_amount']).replace(' ', '')} {data['budget_currency']}"
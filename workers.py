@@ -0,0 +1,95 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedWorkerPool:
+    """Пул потоков с сохранением порядка задач внутри одного ключа.
+
+    Задачи с одинаковым ключом (например, chat_id) всегда попадают в одну
+    и ту же очередь и выполняются последовательно; задачи разных ключей
+    выполняются параллельно. Очереди ограничены: при переполнении submit
+    ждёт не дольше timeout и возвращает False.
+    """
+
+    def __init__(self, name, workers=4, queue_size=1000):
+        self.name = name
+        self.workers = workers
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.busy = 0
+        self.last_latency = 0.0
+
+    def start(self):
+        for index, jobs in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(jobs,), name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, key, func, *args, timeout=None, **kwargs):
+        """Ставит задачу в очередь. Возвращает False, если очередь переполнена"""
+        jobs = self._queues[hash(key) % self.workers]
+        try:
+            jobs.put((time.monotonic(), func, args, kwargs), timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            logger.warning(f"⚠️ Очередь {self.name} переполнена, задача отклонена")
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def queue_depth(self):
+        return sum(jobs.qsize() for jobs in self._queues)
+
+    def max_queue_depth(self):
+        """Глубина самой загруженной очереди: каждая ограничена отдельно"""
+        return max(jobs.qsize() for jobs in self._queues)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_depth': self.queue_depth(),
+                'busy': self.busy,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'last_latency': self.last_latency,
+            }
+
+    def join(self, timeout=30):
+        """Ждёт, пока очереди опустеют (например, перед остановкой)"""
+        deadline = time.monotonic() + timeout
+        while (self.queue_depth() or self.busy) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _run(self, jobs):
+        while True:
+            enqueued_at, func, args, kwargs = jobs.get()
+            with self._lock:
+                self.busy += 1
+            try:
+                func(*args, **kwargs)
+                with self._lock:
+                    self.completed += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"❌ Ошибка задачи в {self.name}: {e}")
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.last_latency = time.monotonic() - enqueued_at